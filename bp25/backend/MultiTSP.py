@@ -1,70 +1,65 @@
 import networkx as nx
-from networkx import MultiDiGraph, shortest_path_length, shortest_path
+from networkx import MultiDiGraph, shortest_path_length
 from create_graph import create_graph
-import heapq
+from distance_matrix import DistanceCache, DistanceMatrix, nearest_neighbors
+from metrics import registry
+from route_store import RouteStore
+from routing_graph import CSRGraph, as_csr
 from math import *
+import multiprocessing
+import os
 import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Annealing steps used by the "matrix" solver mode, where each step is only a few array lookups.
+MATRIX_ANNEAL_STEPS = 100000
+# Annealing steps used by the "cache" solver mode: lookups are as cheap once a row is
+# cached, but every miss is a full single-source Dijkstra.
+CACHE_ANNEAL_STEPS = 20000
+
+# Length of every stop's candidate list in the "candidates" neighborhood (see anneal_neighborhood).
+CANDIDATE_NEIGHBORS = 10
+
+# Annealing schedule: the starting temperature is calibrated so that an average worsening
+# move is accepted with INITIAL_ACCEPTANCE, then decays geometrically to
+# FINAL_TEMPERATURE_RATIO of that by the end of the run. Large uphill moves almost never
+# pay off for the min-max objective, so the calibrated start is deliberately cold; only
+# moves much smaller than the typical delta get accepted.
+INITIAL_ACCEPTANCE = 1e-6
+FINAL_TEMPERATURE_RATIO = 1e-3
+CALIBRATION_MOVES = 200
+# Share of what is left of a time budget that calibration may spend sampling moves.
+CALIBRATION_BUDGET_SHARE = 0.1
+# Fallback when calibration sees no worsening moves (e.g. a single tiny route).
+DEFAULT_TEMPERATURE = 10
+# How often (in steps) the wall clock is read to update the temperature and check the budget.
+CLOCK_CHECK_EVERY = 64
+
+def nearest_unvisited_node(grf, start, visited):
+    """
+    Dijkstra from start to the closest building node not in visited.
+    Returns (node, distance, path) or None if no unvisited building is reachable.
 
-def nearest_unvisited_node(grf: MultiDiGraph, start, visited):
-    # Dijkstra: initialize distances and predecessors
-    distances = {node: float('infinity') for node in grf.nodes()}
-    # prev[node] will store the previous node along the shortest path
-    prev = {node: None for node in grf.nodes()}
-    distances[start] = 0
-    # Priority queue of (distance, node)
-    pq = [(0, start)]
-
-    while pq:
-        curr_dist, curr_node = heapq.heappop(pq)
-        try:
-            curr_node = int(curr_node)
-        except:
-            pass
-
-        # print(curr_dist, curr_node)
-
-        # If this node is a building and not yet visited, we've found a candidate.
-        if (curr_node not in visited) and (grf.nodes[curr_node].get("node_type") == "building"):
-            # Reconstruct path from start to curr_node:
-            path = []
-            node = curr_node
-            while node is not None:
-                path.append(node)
-                node = prev[node]
-            # The path is currently from curr_node back to start, so reverse it.
-            path.reverse()
-            return curr_node, curr_dist, path
-
-        # If we already found a shorter distance to curr_node, skip.
-        if curr_dist > distances[curr_node]:
-            continue
-
-        for next_node in grf.neighbors(curr_node):
-            edge_data = grf.get_edge_data(curr_node, next_node)[0]
-            # Assume each edge has a key 'length'
-
-            new_dist = curr_dist + edge_data['length']
-            if new_dist < distances[next_node]:
-                distances[next_node] = new_dist
-                prev[next_node] = curr_node
-                try:
-                    heapq.heappush(pq, (new_dist, str(next_node)))
-                except:
-                    # print(new_dist, next_node)
-                    pass
-    # If no unvisited building is found:
-    return None
-
-
-def get_init_solution(grf: MultiDiGraph, starting_pts):
+    grf should be a CSRGraph (see routing_graph); a MultiDiGraph is compiled on
+    the fly, which is fine for one-off calls but wasteful inside a loop.
+    """
+    return as_csr(grf).nearest_unvisited(start, visited)
+
+
+def get_init_solution(grf, starting_pts, buildings=None):
     """
     Greedy initialization for multi-party TSP.
     starting_pts: list of nodes that serve as initial starting points for separate routes.
+    buildings: the building nodes to cover; all building nodes of the graph by default.
 
     The algorithm works by maintaining one route per starting point.
     At each iteration, the route with the smallest current length is chosen,
     and extended by connecting (via the shortest path) its last node to the nearest unvisited building.
     """
+    # Compile once; every nearest_unvisited_node call below reuses its buffers.
+    grf = as_csr(grf)
+
     # Initialize routes and route lengths.
     # routes: dict mapping starting_pt to list of nodes in that route.
     routes = {pt: [pt] for pt in starting_pts}
@@ -72,9 +67,11 @@ def get_init_solution(grf: MultiDiGraph, starting_pts):
     route_lengths = {pt: 0 for pt in starting_pts}
 
     # All nodes with node_type "building" that we want to cover.
-    building_nodes = {node for node in grf.nodes() if grf.nodes[node].get("node_type") == "building"}
-    # Mark starting points as visited.
+    building_nodes = {node for node, is_building in zip(grf.nodes, grf.is_building) if is_building}
+    # Mark starting points as visited, and buildings that are not ours to cover.
     visited = set(starting_pts)
+    if buildings is not None:
+        visited |= building_nodes - set(buildings)
 
     # Continue until all building nodes are visited or no extension is possible.
     while visited != building_nodes:
@@ -104,176 +101,677 @@ def get_init_solution(grf: MultiDiGraph, starting_pts):
     return routes, route_lengths, pure_routes
 
 def dist(G, a, b):
+    if isinstance(G, CSRGraph):
+        return G.distance(a, b)
     try:
         return shortest_path_length(G, source=a, target=b, weight='length')
     except:
         return 1e18
 
 
-def anneal(G, routes, route_lengths, T):
+def anneal(G, store, T, dist_fn=dist):
     """
-    Performs one annealing step on a set of routes.
+    Performs one annealing step on the routes in a RouteStore.
     There are two types of moves:
       1. Intra-route reversal (with probability 0.2)
-      2. Node transfer (with probability 0.8)
+      2. Node transfer (with probability 0.8), either a relocation within the
+         longest route or a move from the longest route into another one
 
-    The route_lengths dictionary is updated in a delta fashion.
+    The route lengths in the store are updated in a delta fashion. Stop lookups
+    are O(1), moving stops is O(n) in the route length (list pop/insert) and
+    finding the longest route is O(log k) amortized in the number of routes.
+    dist_fn(G, a, b) returns the path length between two route stops; pass a
+    DistanceMatrix to turn every lookup into an array access.
+
+    Returns (move, delta, accepted) for the evaluated move, where move is one of
+    "reversal", "relocate" or "transfer", or None if no move was possible.
     """
+    stop = store.stop
 
     # --- Intra-route reversal move ---
     if random.random() < 0.2:
         # Choose a random route key.
-        route_key = random.choice(list(routes.keys()))
-        route = routes[route_key]
-        L = len(route)
+        route_key = random.choice(store.keys())
+        L = store.route_len(route_key)
         # Only proceed if the route has at least 4 nodes (to allow nontrivial reversal while keeping endpoints fixed)
-        if L >= 4:
-            # Choose indices l and r such that 0 < l < r < L-1.
-            l = random.randint(1, L - 3)
-            r = random.randint(l + 1, L - 2)
-
-            # For the reversal move, only two edges are affected:
-            #   * The edge from route[l-1] to route[l] will be removed.
-            #   * The edge from route[r] to route[r+1] will be removed.
-            # And they will be replaced by:
-            #   * An edge from route[l-1] to route[r].
-            #   * An edge from route[l] to route[r+1].
-            removed = dist(G, route[l - 1], route[l]) + dist(G, route[r], route[r + 1])
-            added = dist(G, route[l - 1], route[r]) + dist(G, route[l], route[r + 1])
-            delta = added - removed  # Delta change in the route's length
-
-            # Update: Accept if improvement (delta < 0) or with probability exp(-delta/T)
-            if delta < 0 or random.random() < exp(-delta / T):
-                # Reverse the subsegment from index l to r.
-                routes[route_key][l:r + 1] = routes[route_key][l:r + 1][::-1]
-                # Update the stored route length.
-                route_lengths[route_key] += delta
-                # [Explanation: New length = old length + (added - removed)]
-
-        # Identify the route with the largest current length (source route for removal).
-        largest_key = max(route_lengths, key=lambda k: route_lengths[k])
-        # Choose destination route: with 70% probability, pick a random route; otherwise, use the largest route.
-        if random.random() < 0.7:
-            dest_key = random.choice(list(routes.keys()))
-        else:
-            dest_key = largest_key
-
-        # Two cases: if the move is within the same route (intra-route relocation) or between different routes.
-        if dest_key == largest_key:
-            # --- Intra-route relocation ---
-            src_route = routes[largest_key]
-            L = len(src_route)
-            if L < 3:
-                return  # Not enough nodes to perform a meaningful move.
-            # Choose a random index in the interior (not endpoints) to remove.
-            orig_idx = random.randint(1, L - 2)
-            node_to_move = src_route[orig_idx]
-            # Create a temporary route with the node removed.
-            new_route = src_route[:orig_idx] + src_route[orig_idx + 1:]
-
-            # Choose an insertion index in new_route (again, not at endpoints).
-            if len(new_route) < 3:
-                return  # Safety check.
-            dest_idx = random.randint(1, len(new_route) - 1)
-
-            # Compute delta for removal from the original route:
-            # Removed edges: (src[orig_idx-1] -> src[orig_idx]) and (src[orig_idx] -> src[orig_idx+1])
-            removed_source = dist(G, src_route[orig_idx - 1], src_route[orig_idx]) + \
-                             dist(G, src_route[orig_idx], src_route[orig_idx + 1])
-            # Added edge: (src[orig_idx-1] -> src[orig_idx+1])
-            added_source = dist(G, src_route[orig_idx - 1], src_route[orig_idx + 1])
-            delta_remove = added_source - removed_source  # (Typically negative if removal shortens the route)
-
-            # Compute delta for insertion into new_route:
-            # In new_route, the edge currently from new_route[dest_idx-1] to new_route[dest_idx] will be removed,
-            # and replaced by two edges: (new_route[dest_idx-1] -> node_to_move) and (node_to_move -> new_route[dest_idx]).
-            removed_dest = dist(G, new_route[dest_idx - 1], new_route[dest_idx])
-            added_dest = dist(G, new_route[dest_idx - 1], node_to_move) + \
-                         dist(G, node_to_move, new_route[dest_idx])
-            delta_insert = added_dest - removed_dest
-
-            # Total change in route length.
-            delta = delta_remove + delta_insert
-
-            # Accept the move if it improves or with probability exp(-delta/T).
-            if delta < 0 or random.random() < exp(-delta / T):
-                # Update the route: insert the node at the new position.
-                routes[largest_key] = new_route[:dest_idx] + [node_to_move] + new_route[dest_idx:]
-                # Update the route length.
-                route_lengths[largest_key] += delta
-        else:
-            # --- Inter-route move ---
-            source_route = routes[largest_key]
-            if len(source_route) < 3:
-                return  # Not enough nodes to remove.
-            # Choose a random node index (not endpoints) to remove from the source (largest) route.
-            orig_idx = random.randint(1, len(source_route) - 2)
-            node_to_move = source_route[orig_idx]
-            # Compute delta for removal from the source route:
-            removed_source = dist(G, source_route[orig_idx - 1], source_route[orig_idx]) + \
-                             dist(G, source_route[orig_idx], source_route[orig_idx + 1])
-            added_source = dist(G, source_route[orig_idx - 1], source_route[orig_idx + 1])
-            delta_remove = added_source - removed_source
-
-            # For the destination route:
-            dest_route = routes[dest_key]
-            if len(dest_route) < 2:
-                dest_idx = 1
+        if L < 4:
+            return None
+        # Choose indices l and r such that 0 < l < r < L-1.
+        l = random.randint(1, L - 3)
+        r = random.randint(l + 1, L - 2)
+
+        # For the reversal move, only two edges are affected:
+        #   * The edge from route[l-1] to route[l] will be removed.
+        #   * The edge from route[r] to route[r+1] will be removed.
+        # And they will be replaced by:
+        #   * An edge from route[l-1] to route[r].
+        #   * An edge from route[l] to route[r+1].
+        before_l, at_l = stop(route_key, l - 1), stop(route_key, l)
+        at_r, after_r = stop(route_key, r), stop(route_key, r + 1)
+        removed = dist_fn(G, before_l, at_l) + dist_fn(G, at_r, after_r)
+        added = dist_fn(G, before_l, at_r) + dist_fn(G, at_l, after_r)
+        delta = added - removed  # Delta change in the route's length
+
+        # Update: Accept if improvement (delta < 0) or with probability exp(-delta/T)
+        accepted = delta < 0 or random.random() < exp(-delta / T)
+        if accepted:
+            # Reverse the subsegment from index l to r.
+            store.reverse(route_key, l, r)
+            # Update the stored route length.
+            store.add_length(route_key, delta)
+            # [Explanation: New length = old length + (added - removed)]
+        return "reversal", delta, accepted
+
+    # Identify the route with the largest current length (source route for removal).
+    largest_key = store.longest()
+    # Choose destination route: with 70% probability, pick a random route; otherwise, use the largest route.
+    if random.random() < 0.7:
+        dest_key = random.choice(store.keys())
+    else:
+        dest_key = largest_key
+
+    # Two cases: if the move is within the same route (intra-route relocation) or between different routes.
+    if dest_key == largest_key:
+        # --- Intra-route relocation ---
+        L = store.route_len(largest_key)
+        if L < 3:
+            return None  # Not enough nodes to perform a meaningful move.
+        # Choose a random index in the interior (not endpoints) to remove.
+        orig_idx = random.randint(1, L - 2)
+        node_to_move = stop(largest_key, orig_idx)
+
+        # Choose an insertion index in the route without the node (again, not at endpoints).
+        if L - 1 < 3:
+            return None  # Safety check.
+        dest_idx = random.randint(1, L - 2)
+
+        # Compute delta for removal from the original route:
+        # Removed edges: (src[orig_idx-1] -> src[orig_idx]) and (src[orig_idx] -> src[orig_idx+1])
+        prev_node, next_node = stop(largest_key, orig_idx - 1), stop(largest_key, orig_idx + 1)
+        removed_source = dist_fn(G, prev_node, node_to_move) + dist_fn(G, node_to_move, next_node)
+        # Added edge: (src[orig_idx-1] -> src[orig_idx+1])
+        added_source = dist_fn(G, prev_node, next_node)
+        delta_remove = added_source - removed_source  # (Typically negative if removal shortens the route)
+
+        # Compute delta for insertion into the route without the node (new_route):
+        # the edge from new_route[dest_idx-1] to new_route[dest_idx] will be removed,
+        # and replaced by two edges: (new_route[dest_idx-1] -> node_to_move) and (node_to_move -> new_route[dest_idx]).
+        # new_route[i] is src[i] before orig_idx and src[i+1] from it on.
+        before = stop(largest_key, dest_idx - 1 if dest_idx - 1 < orig_idx else dest_idx)
+        after = stop(largest_key, dest_idx if dest_idx < orig_idx else dest_idx + 1)
+        removed_dest = dist_fn(G, before, after)
+        added_dest = dist_fn(G, before, node_to_move) + dist_fn(G, node_to_move, after)
+        delta_insert = added_dest - removed_dest
+
+        # Total change in route length.
+        delta = delta_remove + delta_insert
+
+        # Accept the move if it improves or with probability exp(-delta/T).
+        accepted = delta < 0 or random.random() < exp(-delta / T)
+        if accepted:
+            # Update the route: move the node to the new position.
+            store.insert(largest_key, dest_idx, store.pop(largest_key, orig_idx))
+            # Update the route length.
+            store.add_length(largest_key, delta)
+        return "relocate", delta, accepted
+
+    # --- Inter-route move ---
+    L = store.route_len(largest_key)
+    if L < 3:
+        return None  # Not enough nodes to remove.
+    # Choose a random node index (not endpoints) to remove from the source (largest) route.
+    orig_idx = random.randint(1, L - 2)
+    node_to_move = stop(largest_key, orig_idx)
+    # Compute delta for removal from the source route:
+    prev_node, next_node = stop(largest_key, orig_idx - 1), stop(largest_key, orig_idx + 1)
+    removed_source = dist_fn(G, prev_node, node_to_move) + dist_fn(G, node_to_move, next_node)
+    added_source = dist_fn(G, prev_node, next_node)
+    delta_remove = added_source - removed_source
+
+    # For the destination route:
+    dest_len = store.route_len(dest_key)
+    if dest_len < 2:
+        # Only the starting point so far: append after it.
+        dest_idx = 1
+        removed_dest = 0
+        added_dest = dist_fn(G, stop(dest_key, 0), node_to_move)
+    else:
+        dest_idx = random.randint(1, dest_len - 1)
+        # Compute delta for insertion into the destination route:
+        before, after = stop(dest_key, dest_idx - 1), stop(dest_key, dest_idx)
+        removed_dest = dist_fn(G, before, after)
+        added_dest = dist_fn(G, before, node_to_move) + dist_fn(G, node_to_move, after)
+    delta_insert = added_dest - removed_dest
+
+    # Total delta change.
+    delta = delta_remove + delta_insert
+
+    accepted = delta < 0 or random.random() < exp(-delta / T)
+    if accepted:
+        # Update route lengths:
+        store.add_length(largest_key, delta_remove)
+        store.add_length(dest_key, delta_insert)
+        # Move the node from the source route to dest_idx in the destination route.
+        store.insert(dest_key, dest_idx, store.pop(largest_key, orig_idx))
+    return "transfer", delta, accepted
+
+def _leg_length(G, dist_fn, a, b):
+    """dist_fn(G, a, b), or 0 when b is None (a is the end of its route)."""
+    return dist_fn(G, a, b) if b is not None else 0
+
+def _chain_length(G, dist_fn, stops):
+    return sum(dist_fn(G, a, b) for a, b in zip(stops, stops[1:]))
+
+def anneal_neighborhood(G, store, T, candidates, dist_fn=dist):
+    """
+    Performs one annealing step like anneal, but every move starts from a stop and
+    one of its candidates, i.e. its nearest stops by network distance, and tries
+    to make them neighbors on a route:
+      1. 2-opt (probability 0.2): reverse the stretch of a route between a stop and
+         a candidate on the same route
+      2. or-opt (0.35): move a segment of 1-3 stops of the longest route to just
+         after a candidate, on any route
+      3. 2-opt* (0.2): exchange the tails of the longest route and another route so
+         that the candidate follows the stop
+      4. cross-exchange (0.25): swap a segment of 1-3 stops after the stop with a
+         segment of 1-3 stops starting at the candidate on another route
+
+    candidates maps every stop to its candidate list (see nearest_neighbors).
+    Acceptance and the returned (move, delta, accepted) work as in anneal; delta is
+    the change of the total length of the routes involved. A proposal that does not
+    apply (e.g. the candidate is on the wrong route) returns None.
+    """
+    stop = store.stop
+    r = random.random()
+
+    # --- 2-opt within one route ---
+    if r < 0.2:
+        key = random.choice(store.keys())
+        L = store.route_len(key)
+        if L < 4:
+            return None
+        i = random.randint(1, L - 2)
+        a = stop(key, i)
+        b = random.choice(candidates[a]) if candidates.get(a) else None
+        if b is None or store.route_of.get(b) != key:
+            return None
+        lo, hi = sorted((i, store.index(key, b)))
+        if hi <= lo + 1:
+            return None
+        # Edges (lo, lo+1) and (hi, hi+1) become (lo, hi) and (lo+1, hi+1).
+        after = stop(key, hi + 1) if hi + 1 < L else None
+        removed = dist_fn(G, stop(key, lo), stop(key, lo + 1)) + _leg_length(G, dist_fn, stop(key, hi), after)
+        added = dist_fn(G, stop(key, lo), stop(key, hi)) + _leg_length(G, dist_fn, stop(key, lo + 1), after)
+        delta = added - removed
+        accepted = delta < 0 or random.random() < exp(-delta / T)
+        if accepted:
+            store.reverse(key, lo + 1, hi)
+            store.add_length(key, delta)
+        return "2-opt", delta, accepted
+
+    # The other moves take a stop (never the starting point) off the longest route.
+    src = store.longest()
+    L = store.route_len(src)
+    if L < 2:
+        return None
+    i = random.randint(1, L - 1)
+    a = stop(src, i)
+    b = random.choice(candidates[a]) if candidates.get(a) else None
+    if b is None or b not in store.route_of:
+        return None
+    dst = store.route_of[b]
+    j = store.index(dst, b)
+
+    # --- or-opt: move stops i..i+s-1 to just after b ---
+    if r < 0.55:
+        s = random.randint(1, min(3, L - i))
+        if dst == src and i - 1 <= j <= i + s - 1:
+            return None  # b is in the segment or already right before it.
+        segment = store.routes[src][i:i + s]
+        prev, first, last = stop(src, i - 1), segment[0], segment[-1]
+        nxt = stop(src, i + s) if i + s < L else None
+        # The segment's own length moves with it; it cancels out of the total delta.
+        inside = _chain_length(G, dist_fn, segment)
+        delta_remove = _leg_length(G, dist_fn, prev, nxt) - dist_fn(G, prev, first) - \
+            _leg_length(G, dist_fn, last, nxt) - inside
+        b_next = stop(dst, j + 1) if j + 1 < store.route_len(dst) else None
+        delta_insert = dist_fn(G, b, first) + _leg_length(G, dist_fn, last, b_next) - \
+            _leg_length(G, dist_fn, b, b_next) + inside
+        delta = delta_remove + delta_insert
+        accepted = delta < 0 or random.random() < exp(-delta / T)
+        if accepted:
+            store.move_segment(src, i, i + s - 1, dst, b)
+            if dst == src:
+                store.add_length(src, delta)
             else:
-                dest_idx = random.randint(1, len(dest_route) - 1)
-            # Compute delta for insertion into the destination route:
-            removed_dest = dist(G, dest_route[dest_idx - 1], dest_route[dest_idx])
-            added_dest = dist(G, dest_route[dest_idx - 1], node_to_move) + \
-                         dist(G, node_to_move, dest_route[dest_idx])
-            delta_insert = added_dest - removed_dest
-
-            # Total delta change.
-            delta = delta_remove + delta_insert
-
-            if delta < 0 or random.random() < exp(-delta / T):
-                # Update route lengths:
-                route_lengths[largest_key] += delta_remove
-                route_lengths[dest_key] += delta_insert
-                # Remove the node from the source route.
-                del routes[largest_key][orig_idx]
-                # Insert the node into the destination route at dest_idx.
-                routes[dest_key].insert(dest_idx, node_to_move)
-
-def gen_route_from_pure(G, pure_routes):
+                store.add_length(src, delta_remove)
+                store.add_length(dst, delta_insert)
+        return "or-opt", delta, accepted
+
+    if dst == src or j == 0:
+        return None
+    B = store.route_len(dst)
+
+    # --- 2-opt*: src keeps ..a and takes b.., dst keeps ..b_prev and takes a_next.. ---
+    if r < 0.75:
+        a_next = stop(src, i + 1) if i + 1 < L else None
+        b_prev = stop(dst, j - 1)
+        removed = _leg_length(G, dist_fn, a, a_next) + dist_fn(G, b_prev, b)
+        added = dist_fn(G, a, b) + _leg_length(G, dist_fn, b_prev, a_next)
+        delta = added - removed
+        accepted = delta < 0 or random.random() < exp(-delta / T)
+        if accepted:
+            a_tail = _chain_length(G, dist_fn, store.routes[src][i + 1:])
+            b_tail = _chain_length(G, dist_fn, store.routes[dst][j:])
+            store.add_length(src, dist_fn(G, a, b) + b_tail - _leg_length(G, dist_fn, a, a_next) - a_tail)
+            store.add_length(dst, _leg_length(G, dist_fn, b_prev, a_next) + a_tail - dist_fn(G, b_prev, b) - b_tail)
+            store.swap_tails(src, i + 1, dst, j)
+        return "2-opt*", delta, accepted
+
+    # --- cross-exchange: swap src[i+1..i+s1] with dst[j..j+s2-1] ---
+    if i + 1 >= L:
+        return None
+    s1 = random.randint(1, min(3, L - 1 - i))
+    s2 = random.randint(1, min(3, B - j))
+    a_segment = store.routes[src][i + 1:i + 1 + s1]
+    b_segment = store.routes[dst][j:j + s2]
+    a_after = stop(src, i + 1 + s1) if i + 1 + s1 < L else None
+    b_before = stop(dst, j - 1)
+    b_after = stop(dst, j + s2) if j + s2 < B else None
+    a_inside = _chain_length(G, dist_fn, a_segment)
+    b_inside = _chain_length(G, dist_fn, b_segment)
+    delta_src = dist_fn(G, a, b_segment[0]) + b_inside + _leg_length(G, dist_fn, b_segment[-1], a_after) - \
+        dist_fn(G, a, a_segment[0]) - a_inside - _leg_length(G, dist_fn, a_segment[-1], a_after)
+    delta_dst = dist_fn(G, b_before, a_segment[0]) + a_inside + _leg_length(G, dist_fn, a_segment[-1], b_after) - \
+        dist_fn(G, b_before, b_segment[0]) - b_inside - _leg_length(G, dist_fn, b_segment[-1], b_after)
+    delta = delta_src + delta_dst
+    accepted = delta < 0 or random.random() < exp(-delta / T)
+    if accepted:
+        store.swap_segments(src, i + 1, i + s1, dst, j, j + s2 - 1)
+        store.add_length(src, delta_src)
+        store.add_length(dst, delta_dst)
+    return "cross-exchange", delta, accepted
+
+def gen_route_from_pure(G, pure_routes, dist_fn=None):
+    """
+    Expand the stops into node paths. Legs from a source whose predecessors a
+    DistanceCache dist_fn still holds are read off them (see
+    DistanceCache.path_with_length); the others are searched on G, which stops at
+    the target instead of settling the whole graph.
+    """
+    G = as_csr(G)
+    cache = dist_fn if isinstance(dist_fn, DistanceCache) else None
+
+    def path_with_length(a, b):
+        if cache is not None and cache.has_paths_from(a):
+            return cache.path_with_length(a, b)
+        return G.path_with_length(a, b)
+
     routes = {k : [] for k in pure_routes}
     route_lengths = {k : 0 for k in pure_routes}
     for i in pure_routes:
         for j in range(len(pure_routes[i]) - 1):
-            routes[i].extend(shortest_path(G, source=pure_routes[i][j], target=pure_routes[i][j+1]))
+            path, length = path_with_length(pure_routes[i][j], pure_routes[i][j+1])
+            routes[i].extend(path)
             if j != len(pure_routes[i]) - 1:
                 routes[i].pop()
-            route_lengths[i] += dist(G, pure_routes[i][j], pure_routes[i][j+1])
+            route_lengths[i] += length
     return routes, route_lengths
 
-def simulated_annealing(G, pure_routes, route_lengths, T=10):
-    c = 0.9
-    for i in range(1000):
-        if i % 100 == 0:
-            print(i)
-            print(route_lengths)
-            T *= c
-        anneal(G, pure_routes, route_lengths, T)
-    return pure_routes, route_lengths
-
-def get_actual_solution(G, starting_pts):
-    routes, route_lengths, pure_routes = get_init_solution(G, starting_pts)
-    old_max = max(route_lengths.values())
-    new_pure_routes, new_route_lengths = simulated_annealing(G, pure_routes, route_lengths)
-    new_max = max(route_lengths.values())
+def anneal_step(G, store, T, dist_fn=dist, candidates=None):
+    """One anneal step, or one anneal_neighborhood step when candidate lists are given."""
+    if candidates is None:
+        return anneal(G, store, T, dist_fn)
+    return anneal_neighborhood(G, store, T, candidates, dist_fn)
 
-    new_routes, _ = gen_route_from_pure(G, new_pure_routes)
-    for pt in starting_pts:
-        new_pure_routes[pt].append(pt)
-        lst = new_routes[pt][-1]
-        new_routes[pt].pop()
-        new_routes[pt].extend(shortest_path(G, lst, pt))
+def calibrate_temperature(G, pure_routes, route_lengths, dist_fn=dist, n_moves=CALIBRATION_MOVES,
+                          candidates=None, time_budget=None):
+    """
+    Starting temperature at which an average worsening move is accepted with
+    probability INITIAL_ACCEPTANCE. The deltas are sampled by running n_moves
+    unconditionally accepted moves on a scratch copy of the routes (candidate moves
+    when candidates are given, see anneal_neighborhood), or fewer once time_budget
+    seconds have passed.
+    """
+    start = time.perf_counter()
+    store = RouteStore(pure_routes, route_lengths)
+    uphill = []
+    for _ in range(n_moves):
+        if time_budget is not None and time.perf_counter() - start >= time_budget:
+            break
+        result = anneal_step(G, store, float('inf'), dist_fn, candidates)
+        # Ignore moves through unreachable pairs (dist() returns 1e18 for those).
+        if result is not None and 0 < result[1] < 1e17:
+            uphill.append(result[1])
+    if not uphill:
+        return DEFAULT_TEMPERATURE
+    return -(sum(uphill) / len(uphill)) / log(INITIAL_ACCEPTANCE)
+
+def simulated_annealing(G, pure_routes, route_lengths, T=None, n_iter=1000, dist_fn=dist,
+                        final_ratio=FINAL_TEMPERATURE_RATIO, time_budget=None, stagnation=None,
+                        callback=None, progress_every=1000, candidates=None):
+    """
+    Anneal a copy of pure_routes (held in a RouteStore) and return the best solution
+    seen, i.e. the one with the smallest maximum route length, as (pure_routes, route_lengths).
+
+    The run stops after n_iter steps, after time_budget seconds, or once `stagnation`
+    steps pass without improving the best maximum, whichever comes first; None
+    disables a criterion. T is the starting temperature, calibrated from sampled
+    move deltas when None. It decays geometrically to T * final_ratio over the run,
+    where progress is the fraction of steps or of the time budget used, whichever
+    is further along. With candidates, moves come from anneal_neighborhood instead
+    of anneal.
+
+    callback(event) is called with a dict every progress_every steps
+    (type "progress"), whenever the best solution improves (type "improvement",
+    including the best pure_routes, a snapshot that is never modified afterwards)
+    and once at the end (type "done").
+    """
+    if n_iter is None and time_budget is None and stagnation is None:
+        raise ValueError("simulated_annealing needs n_iter, time_budget or stagnation to stop")
+    if T is None:
+        T = calibrate_temperature(G, pure_routes, route_lengths, dist_fn, candidates=candidates)
+    T0 = T
+
+    start = time.perf_counter()
+    elapsed = 0.0
+    store = RouteStore(pure_routes, route_lengths)
+    best_max = store.max_length()
+    best_routes = store.snapshot()
+    best_lengths = dict(route_lengths)
+    last_improvement = 0
+    evaluated = accepted = 0
+    # Per move type: [evaluated, accepted], flushed to the metrics registry at the end.
+    move_counts = {}
+
+    def event(kind, i):
+        info = {
+            "type": kind,
+            "iteration": i,
+            "elapsed": elapsed,
+            "temperature": T,
+            "best_max": best_max,
+            "current_max": store.max_length(),
+            "acceptance_rate": accepted / evaluated if evaluated else 0.0,
+            "route_lengths": dict(best_lengths),
+        }
+        if kind != "progress":
+            info["pure_routes"] = best_routes
+        callback(info)
+
+    i = 0
+    while n_iter is None or i < n_iter:
+        if i % CLOCK_CHECK_EVERY == 0:
+            elapsed = time.perf_counter() - start
+            if time_budget is not None and elapsed >= time_budget:
+                break
+            progress = max(i / n_iter if n_iter else 0.0,
+                           elapsed / time_budget if time_budget else 0.0)
+            T = T0 * final_ratio ** min(progress, 1.0)
+        if callback is not None and progress_every and i % progress_every == 0:
+            event("progress", i)
+
+        result = anneal_step(G, store, T, dist_fn, candidates)
+        i += 1
+        if result is not None:
+            evaluated += 1
+            counts = move_counts.get(result[0])
+            if counts is None:
+                counts = move_counts[result[0]] = [0, 0]
+            counts[0] += 1
+            if result[2]:
+                accepted += 1
+                counts[1] += 1
+                current_max = store.max_length()
+                if current_max < best_max:
+                    best_max = current_max
+                    best_routes = store.snapshot()
+                    best_lengths = dict(store.lengths)
+                    last_improvement = i
+                    if callback is not None:
+                        event("improvement", i)
+
+        if stagnation is not None and i - last_improvement >= stagnation:
+            break
 
-    print(new_max / old_max)
+    elapsed = time.perf_counter() - start
+    registry.incr('anneal.steps', i)
+    registry.incr('anneal.moves.evaluated', evaluated)
+    registry.incr('anneal.moves.accepted', accepted)
+    for move, (move_evaluated, move_accepted) in move_counts.items():
+        registry.incr(f'anneal.moves.{move}.evaluated', move_evaluated)
+        registry.incr(f'anneal.moves.{move}.accepted', move_accepted)
+    if callback is not None:
+        event("done", i)
+    # best_routes went out with the events; callers (close_routes) modify what they get back.
+    return {key: list(stops) for key, stops in best_routes.items()}, best_lengths
+
+# Read-only solver state of a worker process, set once by _init_chain_worker.
+_chain_graph = None
+_chain_dist_fn = None
+_chain_candidates = None
+
+def _init_chain_worker(G, dist_fn, candidates=None):
+    global _chain_graph, _chain_dist_fn, _chain_candidates
+    _chain_graph = G
+    _chain_dist_fn = dist_fn
+    _chain_candidates = candidates
+
+def worker_context():
+    """
+    Multiprocessing context of the solver's process pools. Never fork: the pools are
+    started from Flask and job threads, and a child forked while another thread holds
+    a lock (the metrics registry's, say) waits on it forever. forkserver forks workers
+    from a clean single-threaded server process (spawn where it is missing); either
+    way the pool initializer sends the shared state once per worker, not per task.
+    The forkserver imports the modules whose functions the pools run up front, so its
+    workers start with them loaded instead of importing them one by one.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    # Same package prefix as this module, so "bp25.backend." when imported that way.
+    package = __name__[:-len("MultiTSP")]
+    context.set_forkserver_preload([package + name for name in ("MultiTSP", "decomposition", "batch")])
+    return context
+
+def _run_chain(pure_routes, route_lengths, T, n_iter, final_ratio, time_budget, stagnation, seed):
+    # Forked workers start with identical RNG state, so every chain reseeds.
+    random.seed(seed)
+    return simulated_annealing(_chain_graph, pure_routes, route_lengths, T=T, n_iter=n_iter,
+                               dist_fn=_chain_dist_fn, final_ratio=final_ratio,
+                               time_budget=time_budget, stagnation=stagnation,
+                               candidates=_chain_candidates)
+
+def parallel_simulated_annealing(G, pure_routes, route_lengths, chains=None, T=None, n_iter=1000,
+                                 dist_fn=dist, exchange_every=None, final_ratio=FINAL_TEMPERATURE_RATIO,
+                                 time_budget=None, stagnation=None, callback=None, candidates=None):
+    """
+    Run `chains` independent annealing chains from the same starting solution in a
+    process pool and return the one with the smallest maximum route length.
+
+    G, dist_fn and candidates are handed to each worker once through the pool initializer
+    (see worker_context), so tasks only carry the routes.
+    With exchange_every set (and a step limit), the chains run in rounds of that many
+    steps and all of them restart from the best solution found so far after every
+    round. time_budget bounds the whole run: every round gets what is left of it and
+    no round starts once it is spent. stagnation applies to every chain; callback
+    receives an "improvement" event whenever a round improves on the best solution.
+    """
+    if chains is None:
+        chains = os.cpu_count() or 1
+    if T is None:
+        T = calibrate_temperature(G, pure_routes, route_lengths, dist_fn, candidates=candidates)
+    if n_iter is None or exchange_every is None or exchange_every >= n_iter:
+        rounds = [(0, n_iter)]
+    else:
+        rounds = [(done, min(exchange_every, n_iter - done)) for done in range(0, n_iter, exchange_every)]
+
+    context = worker_context()
+    start = time.perf_counter()
+    best_routes, best_lengths = pure_routes, route_lengths
+    with ProcessPoolExecutor(max_workers=chains, mp_context=context,
+                             initializer=_init_chain_worker, initargs=(G, dist_fn, candidates)) as pool:
+        for done, steps in rounds:
+            round_budget = None
+            if time_budget is not None:
+                round_budget = time_budget - (time.perf_counter() - start)
+                if round_budget <= 0:
+                    break
+            # Continue the global cooling schedule where the previous round stopped.
+            if n_iter is None:
+                round_T, round_ratio = T, final_ratio
+            else:
+                round_T = T * final_ratio ** (done / n_iter)
+                round_ratio = final_ratio ** (steps / n_iter)
+            futures = [pool.submit(_run_chain, best_routes, best_lengths, round_T, steps, round_ratio,
+                                   round_budget, stagnation, random.randrange(2 ** 32))
+                       for _ in range(chains)]
+            results = [future.result() for future in futures]
+            round_routes, round_lengths = min(results, key=lambda result: max(result[1].values()))
+            if max(round_lengths.values()) < max(best_lengths.values()) and callback is not None:
+                callback({
+                    "type": "improvement",
+                    "iteration": done + (steps or 0),
+                    "elapsed": time.perf_counter() - start,
+                    "best_max": max(round_lengths.values()),
+                    "route_lengths": dict(round_lengths),
+                    # A copy: the routes returned from here are closed in place by close_routes.
+                    "pure_routes": {key: list(stops) for key, stops in round_routes.items()},
+                })
+            best_routes, best_lengths = round_routes, round_lengths
+
+    return best_routes, best_lengths
+
+def build_dist_fn(G, starting_pts, mode="dijkstra", stops=None):
+    """
+    Distance function for the annealer on compiled graph G: dist itself for
+    mode="dijkstra", a DistanceMatrix over all building nodes and starting points
+    (or just `stops`) for mode="matrix", or a lazily filled, memory-bounded
+    DistanceCache over the same nodes for mode="cache".
+    """
+    if stops is None:
+        stops = list(starting_pts) + [n for n, is_building in zip(G.nodes, G.is_building) if is_building]
+    if mode == "matrix":
+        return DistanceMatrix.from_graph(G, stops)
+    if mode == "cache":
+        return DistanceCache(G, stops)
+    if mode == "dijkstra":
+        return dist
+    raise ValueError(f"Unknown solver mode: {mode}")
+
+def build_candidates(G, starting_pts, dist_fn, neighborhood="random", k=CANDIDATE_NEIGHBORS, stops=None):
+    """
+    Candidate lists for anneal_neighborhood (None for neighborhood="random"): the k
+    nearest stops of every building and starting point (or of `stops`), read off
+    dist_fn when it is a DistanceMatrix and computed with batched Dijkstra runs otherwise.
+    """
+    if neighborhood == "random":
+        return None
+    if neighborhood != "candidates":
+        raise ValueError(f"Unknown neighborhood: {neighborhood}")
+    if isinstance(dist_fn, DistanceMatrix):
+        return dist_fn.nearest_neighbors(k)
+    if stops is None:
+        stops = list(starting_pts) + [n for n, is_building in zip(G.nodes, G.is_building) if is_building]
+    return nearest_neighbors(G, stops, k)
+
+def default_anneal_steps(mode):
+    if mode == "matrix":
+        return MATRIX_ANNEAL_STEPS
+    return CACHE_ANNEAL_STEPS if mode == "cache" else 1000
+
+def close_routes(G, pure_routes, dist_fn=None):
+    """
+    Send every route back to its starting point (appended to pure_routes in place)
+    and expand the stops into full node paths (see gen_route_from_pure).
+    """
+    for pt in pure_routes:
+        pure_routes[pt].append(pt)
+    # gen_route_from_pure leaves off the final node of every leg, including the last one.
+    routes, _ = gen_route_from_pure(G, pure_routes, dist_fn)
+    for pt in routes:
+        routes[pt].append(pt)
+    return routes
+
+def get_actual_solution(G, starting_pts, mode="dijkstra", n_iter=None, chains=1, exchange_every=None,
+                        time_budget=None, stagnation=None, callback=None, dist_fn=None,
+                        neighborhood="random"):
+    """
+    Greedy initialization followed by simulated annealing.
+    mode="dijkstra" runs a shortest path query for every distance the annealer needs.
+    mode="matrix" precomputes a DistanceMatrix over all building nodes and starting
+    points once, after which every move is evaluated with array lookups; this is
+    what makes runs of MATRIX_ANNEAL_STEPS steps affordable.
+    mode="cache" keeps rows of that matrix in a bounded LRU cache instead, for
+    areas where the full matrix does not fit in memory (see DistanceCache).
+    chains > 1 runs that many annealing chains in parallel processes and keeps the
+    best (see parallel_simulated_annealing).
+    time_budget (seconds) counts from the call: the greedy solution and the distance
+    function are always built, then calibration gets CALIBRATION_BUDGET_SHARE of what
+    is left and the anneal the rest (see simulated_annealing); with a time budget and
+    no n_iter, steps are unlimited. stagnation (steps without improvement) bounds the
+    anneal as well.
+    dist_fn skips building the distance function when the caller already has one
+    (see build_dist_fn); G must then be the CSRGraph it was built on.
+    callback receives an "init" event with the greedy solution as soon as it exists,
+    before the distance function is built, and then the annealer's events.
+    neighborhood="random" proposes anneal's uniformly random moves; "candidates"
+    proposes anneal_neighborhood's moves between each stop and its CANDIDATE_NEIGHBORS
+    nearest stops.
+    """
+    start = time.perf_counter()
+
+    def remaining_budget():
+        return None if time_budget is None else max(0.0, time_budget - (time.perf_counter() - start))
+
+    # Route on the compiled graph from here on; G itself is left untouched.
+    G = as_csr(G)
+    with registry.timer('phase.greedy'):
+        routes, route_lengths, pure_routes = get_init_solution(G, starting_pts)
+    old_max = max(route_lengths.values())
+    if callback is not None:
+        callback({
+            "type": "init",
+            "best_max": old_max,
+            "route_lengths": dict(route_lengths),
+            "pure_routes": pure_routes,
+        })
+
+    if dist_fn is None:
+        with registry.timer('phase.distances'):
+            dist_fn = build_dist_fn(G, starting_pts, mode)
+    if n_iter is None and time_budget is None:
+        n_iter = default_anneal_steps(mode)
+    with registry.timer('phase.candidates'):
+        candidates = build_candidates(G, starting_pts, dist_fn, neighborhood)
+
+    anneal_start = time.perf_counter()
+    calibration_budget = remaining_budget()
+    if calibration_budget is not None:
+        calibration_budget *= CALIBRATION_BUDGET_SHARE
+    T = calibrate_temperature(G, pure_routes, route_lengths, dist_fn, candidates=candidates,
+                              time_budget=calibration_budget)
+    if chains > 1:
+        new_pure_routes, new_route_lengths = parallel_simulated_annealing(
+            G, pure_routes, route_lengths, chains=chains, T=T, n_iter=n_iter, dist_fn=dist_fn,
+            exchange_every=exchange_every, time_budget=remaining_budget(), stagnation=stagnation,
+            callback=callback, candidates=candidates)
+    else:
+        new_pure_routes, new_route_lengths = simulated_annealing(
+            G, pure_routes, route_lengths, T=T, n_iter=n_iter, dist_fn=dist_fn,
+            time_budget=remaining_budget(), stagnation=stagnation, callback=callback,
+            candidates=candidates)
+    registry.observe('phase.anneal', time.perf_counter() - anneal_start)
+    new_max = max(new_route_lengths.values())
+
+    with registry.timer('phase.path_expansion'):
+        new_routes = close_routes(G, new_pure_routes, dist_fn)
+
+    registry.gauge('anneal.improvement_ratio', new_max / old_max if old_max else 1.0)
+    if isinstance(dist_fn, DistanceCache):
+        for name, value in dist_fn.stats().items():
+            registry.gauge(f'distance_cache.{name}', value)
     return new_routes, new_pure_routes, new_route_lengths
 
 # Example usage:
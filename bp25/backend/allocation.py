@@ -0,0 +1,221 @@
+import random
+
+from graph_cache import cached_create_graph, cached_hierarchy
+from hazards import remove_hazard_nodes
+from decomposition import get_decomposed_solution
+from metrics import registry
+from MultiTSP import get_actual_solution
+from routing_graph import CSRGraph
+from serialize import generate_route_colors, serialize_graph
+from tiles import tiled_graph
+
+# Number of response teams (routes) when the request does not say otherwise.
+DEFAULT_NUM_ROUTES = 5
+# Above this many buildings the default solver is "cache": the dense "matrix" takes
+# 8 bytes per pair of buildings, 200 MB at this size.
+MATRIX_MAX_BUILDINGS = 5000
+
+# Accepted values of the string options in a request body.
+OPTION_CHOICES = {
+    'solver': ('matrix', 'dijkstra', 'cache'),
+    'neighborhood': ('random', 'candidates'),
+    'decomposition': ('voronoi',),
+}
+# Numeric options in a request body, all positive, and whether they must be integers.
+INTEGER_OPTIONS = {'anneal_steps': True, 'chains': True, 'exchange_every': True,
+                   'time_budget': False, 'stagnation': True}
+
+
+def num_routes_error(value):
+    """Error message for a num_routes that is given but not a positive integer, else None."""
+    if value is None:
+        return None
+    try:
+        num_routes = int(value)
+    except (TypeError, ValueError):
+        return "num_routes must be an integer"
+    return None if num_routes >= 1 else "num_routes must be at least 1"
+
+
+def options_error(data):
+    """Error message for the first option in the request body solver_options cannot use, else None."""
+    for name, choices in OPTION_CHOICES.items():
+        value = data.get(name)
+        if value is not None and value not in choices:
+            return f"{name} must be one of: {', '.join(choices)}"
+    for name, integer in INTEGER_OPTIONS.items():
+        value = data.get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)) or not value > 0:
+            return f"{name} must be a positive {'integer' if integer else 'number'}"
+    return None
+
+
+def solver_options(data, buildings=0):
+    """
+    Annealing options shared by every endpoint that solves, read from a request body
+    options_error accepts; buildings (the graph's building count) picks the default solver.
+    """
+    return {
+        # "matrix" precomputes building-to-building distances; "dijkstra" queries the graph per move;
+        # "cache" keeps a memory-bounded LRU of distance rows for areas too large for "matrix"
+        'mode': data.get('solver') or ('matrix' if buildings <= MATRIX_MAX_BUILDINGS else 'cache'),
+        'n_iter': data.get('anneal_steps'),
+        # Number of annealing chains run in parallel processes; the best one is returned
+        'chains': data.get('chains', 1),
+        'exchange_every': data.get('exchange_every'),
+        # Stop annealing after this many seconds and/or this many steps without improvement
+        'time_budget': data.get('time_budget'),
+        'stagnation': data.get('stagnation'),
+        # "candidates" draws moves from every building's nearest neighbors instead of uniformly
+        'neighborhood': data.get('neighborhood', 'random'),
+        # "voronoi" splits the buildings among the starting points and solves every part on its own
+        'decomposition': data.get('decomposition'),
+    }
+
+
+class Allocation:
+    """
+    Everything a solved allocation request produced: the (hazard-masked) graph,
+    its compiled CSRGraph and the routes. pure_routes and routes are closed, i.e.
+    they end back at their starting point.
+    """
+
+    def __init__(self, graph, csr, starting_pts, routes, pure_routes, route_lengths, route_colors):
+        self.graph = graph
+        self.csr = csr
+        self.starting_pts = starting_pts
+        self.routes = routes
+        self.pure_routes = pure_routes
+        self.route_lengths = route_lengths
+        self.route_colors = route_colors
+
+
+def prepare_graph(data):
+    """Build (or load) the graph for the request's bbox and mask its fires and hazard polygons."""
+    with registry.timer('phase.graph'):
+        # "tiles" stitches the graph from stored fixed-size tiles, so shifted bboxes reuse prior work
+        if data.get('graph_store') == 'tiles':
+            graph = tiled_graph(data['bbox'])
+        else:
+            graph = cached_create_graph(data['bbox'])
+
+    # Remove nodes that are too close to fires or inside hazard polygons
+    fires = data.get('fires', [])
+    # Optional GeoJSON Polygon/MultiPolygon geometries to keep routes out of
+    hazard_polygons = data.get('hazard_polygons', [])
+    if fires or hazard_polygons:
+        with registry.timer('phase.hazard_masking'):
+            nodes_to_remove = remove_hazard_nodes(graph, fires, polygons=hazard_polygons)
+        registry.incr('hazards.removed_nodes', len(nodes_to_remove))
+        registry.gauge('graph.hazard_removed_nodes', len(nodes_to_remove))
+
+    registry.gauge('graph.nodes', graph.number_of_nodes())
+    registry.gauge('graph.edges', graph.number_of_edges())
+    return graph
+
+
+def choose_starting_points(graph, num_routes=None):
+    """
+    Routes start from fire station depots that survived hazard masking; the
+    remaining routes (or surplus depots, if there are more) are picked at random.
+    num_routes defaults to DEFAULT_NUM_ROUTES.
+    """
+    building_nodes = [n for n, dat in graph.nodes(data=True) if dat.get('node_type') == 'building']
+    return pick_starting_points(building_nodes, graph.graph.get('fire_stations', []), num_routes)
+
+
+def pick_starting_points(building_nodes, fire_stations, num_routes=None):
+    """choose_starting_points for a given list of building nodes."""
+    num_routes = DEFAULT_NUM_ROUTES if num_routes is None else int(num_routes)
+    taken = set(building_nodes)
+    depots = list(dict.fromkeys(station['depot'] for station in fire_stations if station.get('depot') in taken))
+    if len(depots) >= num_routes:
+        return random.sample(depots, num_routes)
+    taken = set(depots)
+    others = [n for n in building_nodes if n not in taken]
+    return depots + random.sample(others, min(num_routes - len(depots), len(others)))
+
+
+def solve_allocation(graph, data, starting_pts, route_colors=None, callback=None):
+    """
+    Solve routes from starting_pts on a prepared graph and return an Allocation.
+    callback receives get_actual_solution's (or get_decomposed_solution's) events;
+    route_colors defaults to new random ones.
+    """
+    if not starting_pts:
+        return Allocation(graph, None, [], {}, {}, {}, {})
+
+    with registry.timer('phase.compile'):
+        csr = CSRGraph(graph)
+    buildings = sum(csr.is_building)
+    registry.gauge('graph.buildings', buildings)
+    # Answer point-to-point queries with a contraction hierarchy cached next to the graph;
+    # a tiled graph has no cache entry of its own to keep one in
+    if data.get('hierarchy') and data.get('graph_store') != 'tiles':
+        hierarchy = cached_hierarchy(data['bbox'], csr)
+        if hierarchy is not None:
+            csr.attach_hierarchy(hierarchy)
+
+    options = solver_options(data, buildings)
+    decomposition = options.pop('decomposition')
+    if decomposition is None:
+        # Get routes using MultiTSP
+        routes, pure_routes, route_lengths = get_actual_solution(csr, starting_pts, callback=callback, **options)
+    elif decomposition == 'voronoi':
+        # Partitions are solved in parallel with one chain each
+        chains = options.pop('chains')
+        options.pop('exchange_every')
+        routes, pure_routes, route_lengths = get_decomposed_solution(
+            csr, starting_pts, callback=callback, workers=chains if chains > 1 else None, **options)
+    else:
+        raise ValueError(f"Unknown decomposition: {decomposition}")
+
+    routes_converted = {}
+    pure_routes_converted = {}
+    route_lengths_converted = {}
+
+    for key in routes:
+        python_key = float(key) if hasattr(key, 'dtype') else key
+        routes_converted[python_key] = routes[key]
+        pure_routes_converted[python_key] = pure_routes[key]
+        route_lengths_converted[python_key] = route_lengths[key]
+
+    if route_colors is None:
+        route_colors = generate_route_colors(routes_converted.keys())
+    return Allocation(graph, csr, starting_pts, routes_converted, pure_routes_converted,
+                      route_lengths_converted, route_colors)
+
+
+def run_allocation(data, callback=None):
+    """Run the whole allocation pipeline for a request body and return an Allocation."""
+    graph = prepare_graph(data)
+    return solve_allocation(graph, data, choose_starting_points(graph, data.get('num_routes')), callback=callback)
+
+
+def allocation_response(data, allocation):
+    """
+    The JSON body /api/process-allocation returns for a solved Allocation.
+    Fire stations come with the graph (see create_graph.fetch_features).
+    """
+    bbox = data['bbox']
+    fire_stations = allocation.graph.graph.get('fire_stations', [])
+    location_name = data.get('location_name', 'Unknown location')
+    graph = allocation.graph
+
+    # "columnar" returns nodes/edges as parallel arrays instead of one object each
+    with registry.timer('phase.serialization'):
+        graph_data = serialize_graph(graph, allocation.routes, allocation.route_colors,
+                                     columnar=data.get('format') == 'columnar')
+
+    return {
+        "status": "success",
+        "message": f"Processed allocation for {location_name}",
+        "bbox": bbox,
+        "nodes_count": len(graph.nodes),
+        "edges_count": len(graph.edges),
+        "routes_count": len(allocation.routes),
+        "fire_stations": fire_stations,
+        "graph_data": graph_data
+    }
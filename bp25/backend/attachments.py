@@ -0,0 +1,125 @@
+import numpy as np
+
+# Side arrays of a BuildingAttachments, as stored in a graph cache entry.
+ARRAY_NAMES = ('building', 'street_u', 'street_v', 'fraction', 'proj_x', 'proj_y', 'street_length')
+
+
+class BuildingAttachments:
+    """
+    Where every building meets the street network, kept next to the graph
+    (in G.graph['building_attachments']) instead of as graph elements.
+
+    Attachment i says that building[i] is reached from the street
+    street_u[i] - street_v[i] (street_length[i] long), at `fraction` of the way
+    from street_u to street_v, whose closest point to the building is
+    (proj_x, proj_y). The graph itself only holds the building node (for its
+    centroid) and the unsplit street; CSRGraph splices the buildings into their
+    streets as virtual chain nodes when it compiles the graph (see splice), and
+    serialize_graph draws the projection point and the building-to-street edges
+    for the frontend.
+    """
+
+    def __init__(self, building, street_u, street_v, fraction, proj_x, proj_y, street_length):
+        self.building = np.asarray(building, dtype=np.int64)
+        self.street_u = np.asarray(street_u, dtype=np.int64)
+        self.street_v = np.asarray(street_v, dtype=np.int64)
+        self.fraction = np.asarray(fraction, dtype=np.float64)
+        self.proj_x = np.asarray(proj_x, dtype=np.float64)
+        self.proj_y = np.asarray(proj_y, dtype=np.float64)
+        self.street_length = np.asarray(street_length, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.building)
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in ARRAY_NAMES}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(*(np.asarray(arrays[name]) for name in ARRAY_NAMES))
+
+    def extend(self, other):
+        """A new BuildingAttachments with the attachments of both."""
+        return BuildingAttachments(*(np.concatenate([getattr(self, name), getattr(other, name)])
+                                     for name in ARRAY_NAMES))
+
+    def _present(self, index):
+        """
+        Mask of the attachments whose building and at least one street end are in
+        `index`, and their (building, street_u, street_v) indices, -1 for a missing end.
+        """
+        b, u, v = (np.array([index.get(x, -1) for x in ids.tolist()], dtype=np.int64)
+                   for ids in (self.building, self.street_u, self.street_v))
+        present = (b >= 0) & ((u >= 0) | (v >= 0))
+        return present, (b[present], u[present], v[present])
+
+    def streets(self, index):
+        """(building, street_u, street_v) indices from `index` of the attachments splice uses, -1 for a missing end."""
+        return self._present(index)[1]
+
+    def splice(self, index, rows, cols, weights):
+        """
+        Splice the buildings into the compiled edge list (rows, cols, weights of
+        node indices from `index`): every street u <-> v with buildings b1..bk
+        (by fraction) is replaced by the chain u <-> b1 <-> ... <-> bk <-> v, each
+        link weighted by its share of the street's length in that direction.
+        A street that lost one end, e.g. to hazard masking, keeps its buildings
+        reachable from the other one: the chain stops at the last building, with
+        links weighted by street_length. Attachments whose building or both street
+        ends are gone, or whose street was closed, are skipped. Returns the new arrays.
+        """
+        n = len(index)
+        present, (b, u, v) = self._present(index)
+        if not present.any():
+            return rows, cols, weights
+        fraction = self.fraction[present]
+        whole = (u >= 0) & (v >= 0)
+        # Chains are grouped by street ids, which stay distinct when an end is missing.
+        street_u, street_v = self.street_u[present], self.street_v[present]
+
+        # Shortest parallel edge per direction of every street.
+        codes = rows * n + cols
+        order = np.lexsort((weights, codes))
+        first = np.r_[True, codes[order][1:] != codes[order][:-1]]
+        street_weight = dict(zip(codes[order][first].tolist(), weights[order][first].tolist()))
+        forward = np.array([street_weight.get(code, np.nan) for code in np.where(whole, u * n + v, -1).tolist()])
+        backward = np.array([street_weight.get(code, np.nan) for code in np.where(whole, v * n + u, -1).tolist()])
+        # A street closed in one direction is still walked both ways, as before splitting.
+        forward = np.where(np.isnan(forward), backward, forward)
+        backward = np.where(np.isnan(backward), forward, backward)
+        forward = np.where(whole, forward, self.street_length[present])
+        backward = np.where(whole, backward, self.street_length[present])
+        on_street = ~np.isnan(forward)
+        b, u, v, fraction, whole = b[on_street], u[on_street], v[on_street], fraction[on_street], whole[on_street]
+        forward, backward = forward[on_street], backward[on_street]
+        street_u, street_v = street_u[on_street], street_v[on_street]
+        if not len(b):
+            return rows, cols, weights
+
+        order = np.lexsort((fraction, street_v, street_u))
+        b, u, v, fraction, whole = b[order], u[order], v[order], fraction[order], whole[order]
+        forward, backward = forward[order], backward[order]
+        street_u, street_v = street_u[order], street_v[order]
+        first = np.r_[True, (street_u[1:] != street_u[:-1]) | (street_v[1:] != street_v[:-1])]
+        last = np.r_[first[1:], True]
+
+        # Link into every building from the previous chain node, plus the link from each last building to v.
+        prev_node = np.where(first, u, np.r_[-1, b[:-1]])
+        prev_fraction = np.where(first, 0.0, np.r_[0.0, fraction[:-1]])
+        share = np.maximum(fraction - prev_fraction, 0.0)
+        end_share = np.maximum(1.0 - fraction[last], 0.0)
+        link_a = np.concatenate([prev_node, b[last]])
+        link_b = np.concatenate([b, v[last]])
+        link_forward = np.concatenate([share * forward, end_share * forward[last]])
+        link_backward = np.concatenate([share * backward, end_share * backward[last]])
+        # No links to the missing end of a street that lost one.
+        linked = (link_a >= 0) & (link_b >= 0)
+        link_a, link_b = link_a[linked], link_b[linked]
+        link_forward, link_backward = link_forward[linked], link_backward[linked]
+
+        street = first & whole
+        streets = np.unique(np.concatenate([u[street] * n + v[street], v[street] * n + u[street]]))
+        keep = ~np.isin(codes, streets)
+        return (np.concatenate([rows[keep], link_a, link_b]),
+                np.concatenate([cols[keep], link_b, link_a]),
+                np.concatenate([weights[keep], link_forward, link_backward]))
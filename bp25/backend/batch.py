@@ -0,0 +1,157 @@
+"""
+Several allocation scenarios for one bbox, solved on one shared graph
+(/api/process-allocation/batch).
+
+The graph is built, masked with the request's own fires and hazard polygons and
+compiled once. Every scenario then only adds a mask: its fires and hazard
+polygons are looked up on the shared graph and cut out of the compiled arrays
+(CSRGraph.without). Scenarios with the same mask share the masked graph and its
+distance structure, which is built once up front; a mask used by a single
+scenario gets its distance structure in the worker solving that scenario. The
+scenarios are solved in parallel processes that receive all of it once through
+the pool initializer, like the chains of parallel_simulated_annealing.
+"""
+import os
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from allocation import pick_starting_points, prepare_graph, solver_options
+from decomposition import get_decomposed_solution
+from hazards import hazard_nodes
+from metrics import registry
+from MultiTSP import build_dist_fn, get_actual_solution, worker_context
+from routing_graph import CSRGraph
+from serialize import generate_route_colors, serialize_graph, serialize_routes
+
+# Upper bound on the scenarios of one batch request.
+MAX_SCENARIOS = 32
+
+# Read-only state of a worker process, set once by _init_scenario_worker.
+_scenario_graphs = None
+_scenario_dist_fns = None
+_scenario_options = None
+
+
+def _init_scenario_worker(graphs, dist_fns, options):
+    global _scenario_graphs, _scenario_dist_fns, _scenario_options
+    _scenario_graphs = graphs
+    # Copied, so distance structures a worker builds stay in that worker.
+    _scenario_dist_fns = list(dist_fns)
+    _scenario_options = options
+
+
+def _solve_scenario(mask, starting_pts, seed):
+    """Solve one scenario on masked graph `mask`; returns (routes, route_lengths, seconds)."""
+    # Forked workers start with identical RNG state, so every scenario reseeds.
+    random.seed(seed)
+    start = time.perf_counter()
+    if not starting_pts:
+        return {}, {}, 0.0
+    graph = _scenario_graphs[mask]
+    options = dict(_scenario_options)
+    if options.pop('decomposition') == 'voronoi':
+        routes, _, route_lengths = get_decomposed_solution(graph, starting_pts, workers=1, **options)
+    else:
+        if _scenario_dist_fns[mask] is None:
+            _scenario_dist_fns[mask] = build_dist_fn(graph, [], options['mode'])
+        routes, _, route_lengths = get_actual_solution(graph, starting_pts, dist_fn=_scenario_dist_fns[mask],
+                                                       **options)
+    return routes, route_lengths, time.perf_counter() - start
+
+
+def scenario_starting_points(graph, scenario, fire_stations):
+    """
+    The scenario's starting_points (node ids; those that are not buildings of the
+    masked graph are skipped), or num_routes points picked like a single request's.
+    """
+    if scenario.get('starting_points') is not None:
+        node_ids = {str(node): node for node in graph.nodes}
+        starts = [node_ids.get(str(node)) for node in scenario['starting_points']]
+        return list(dict.fromkeys(node for node in starts
+                                  if node is not None and graph.is_building[graph.index[node]]))
+    buildings = [node for node, is_building in zip(graph.nodes, graph.is_building) if is_building]
+    return pick_starting_points(buildings, fire_stations, scenario.get('num_routes'))
+
+
+def solve_batch(data, workers=None):
+    """
+    Solve data['scenarios'] for data['bbox'] and return the response body. Every
+    scenario may set fires, hazard_polygons (on top of the request's own),
+    num_routes and starting_points; the solver options are the request's, with
+    every scenario solved by a single chain in one of `workers` processes (one
+    per CPU by default).
+    """
+    scenarios = data['scenarios']
+    graph = prepare_graph(data)
+    with registry.timer('phase.compile'):
+        csr = CSRGraph(graph)
+
+    options = solver_options(data, sum(csr.is_building))
+    options.pop('chains')
+    options.pop('exchange_every')
+    if options['decomposition'] not in (None, 'voronoi'):
+        raise ValueError(f"Unknown decomposition: {options['decomposition']}")
+
+    with registry.timer('phase.scenario_masks'):
+        masks = {}
+        scenario_masks = []
+        for scenario in scenarios:
+            removed = frozenset(hazard_nodes(graph, scenario.get('fires', []),
+                                             polygons=scenario.get('hazard_polygons', [])))
+            scenario_masks.append(masks.setdefault(removed, len(masks)))
+        graphs = [csr.without(removed) if removed else csr for removed in masks]
+
+    uses = Counter(scenario_masks)
+    with registry.timer('phase.distances'):
+        dist_fns = [build_dist_fn(graphs[mask], [], options['mode'])
+                    if uses[mask] > 1 and options['decomposition'] is None else None
+                    for mask in range(len(graphs))]
+
+    fire_stations = graph.graph.get('fire_stations', [])
+    tasks = [(mask, scenario_starting_points(graphs[mask], scenario, fire_stations), random.randrange(2 ** 32))
+             for scenario, mask in zip(scenarios, scenario_masks)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(tasks))
+    with registry.timer('phase.scenario_solve'):
+        if workers <= 1:
+            _init_scenario_worker(graphs, dist_fns, options)
+            results = [_solve_scenario(*task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context(),
+                                     initializer=_init_scenario_worker, initargs=(graphs, dist_fns, options)) as pool:
+                futures = [pool.submit(_solve_scenario, *task) for task in tasks]
+                results = [future.result() for future in futures]
+    registry.gauge('batch.scenarios', len(scenarios))
+    registry.gauge('batch.masks', len(masks))
+
+    removed_by_mask = list(masks)
+    scenarios_data = []
+    for i, (scenario, (mask, starting_pts, _), (routes, route_lengths, seconds)) in \
+            enumerate(zip(scenarios, tasks, results), 1):
+        route_colors = generate_route_colors(routes.keys())
+        scenarios_data.append({
+            "name": scenario.get('name', f"Scenario {i}"),
+            "starting_points": [str(node) for node in starting_pts],
+            "removed_nodes": [str(node) for node in removed_by_mask[mask]],
+            "routes_count": len(routes),
+            "routes": serialize_routes(routes, route_colors),
+            "route_lengths": {str(k): v for k, v in route_lengths.items()},
+            "max_route_length": max(route_lengths.values(), default=0.0),
+            "solve_seconds": seconds,
+        })
+
+    with registry.timer('phase.serialization'):
+        graph_data = serialize_graph(graph, {}, {}, columnar=data.get('format') == 'columnar')
+    return {
+        "status": "success",
+        "message": f"Processed {len(scenarios)} scenarios for {data.get('location_name', 'Unknown location')}",
+        "bbox": data['bbox'],
+        "nodes_count": len(graph.nodes),
+        "edges_count": len(graph.edges),
+        "fire_stations": fire_stations,
+        "graph_data": graph_data,
+        "scenarios": scenarios_data,
+    }
@@ -0,0 +1,250 @@
+"""
+Offline benchmarks for the routing pipeline on seeded synthetic graphs.
+
+The graphs have the same schema create_graph produces (street nodes with
+positive ids, building nodes with negative ids and node_type 'building',
+attached to their streets by the real snap_buildings), so no OSM download is
+involved and every run with the same seed sees the same input.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --sizes small medium --output after.json --compare bench.json
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import networkx as nx
+
+from contraction import ContractionHierarchy
+from create_graph import snap_buildings
+from distance_matrix import DistanceMatrix
+from MultiTSP import (anneal, anneal_neighborhood, build_candidates, calibrate_temperature,
+                      gen_route_from_pure, get_init_solution, nearest_unvisited_node)
+from route_store import RouteStore
+from routing_graph import CSRGraph
+from serialize import generate_route_colors, serialize_graph
+
+# name -> (street grid side, buildings)
+SIZES = {
+    'small': (10, 200),
+    'medium': (20, 1000),
+    'large': (40, 4000),
+}
+
+# Street grid spacing in degrees (~100 m) and the south-west corner of the grid.
+GRID_SPACING = 0.001
+ORIGIN = (-118.14, 34.13)
+METERS_PER_DEGREE = 111_000
+
+NUM_ROUTES = 5
+NEAREST_QUERIES = 200
+ANNEAL_STEPS = 20000
+
+
+def synthetic_graph(grid_size, n_buildings, seed=0):
+    """
+    A grid_size x grid_size street grid (jittered, both directions, lengths in meters)
+    with n_buildings building nodes scattered over it and snapped like create_graph does.
+    """
+    rnd = random.Random(seed)
+    G = nx.MultiDiGraph(crs='epsg:4326')
+
+    def street_id(i, j):
+        return i * grid_size + j + 1
+
+    for i in range(grid_size):
+        for j in range(grid_size):
+            jitter_x, jitter_y = (rnd.uniform(-0.2, 0.2) * GRID_SPACING for _ in range(2))
+            G.add_node(street_id(i, j), x=ORIGIN[0] + j * GRID_SPACING + jitter_x,
+                       y=ORIGIN[1] + i * GRID_SPACING + jitter_y)
+
+    edges = []
+    for i in range(grid_size):
+        for j in range(grid_size):
+            for di, dj in ((0, 1), (1, 0)):
+                if i + di < grid_size and j + dj < grid_size:
+                    u, v = street_id(i, j), street_id(i + di, j + dj)
+                    dx = G.nodes[u]['x'] - G.nodes[v]['x']
+                    dy = G.nodes[u]['y'] - G.nodes[v]['y']
+                    length = (dx * dx + dy * dy) ** 0.5 * METERS_PER_DEGREE
+                    edges.append((u, v, {'length': length}))
+                    edges.append((v, u, {'length': length}))
+    G.add_edges_from(edges)
+
+    extent = (grid_size - 1) * GRID_SPACING
+    building_ids = list(range(-1, -n_buildings - 1, -1))
+    G.add_nodes_from((b, {'x': ORIGIN[0] + rnd.uniform(0, extent), 'y': ORIGIN[1] + rnd.uniform(0, extent),
+                          'node_type': 'building'}) for b in building_ids)
+    snap_buildings(G, building_ids)
+    return G
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def anneal_throughput(csr, pure_routes, route_lengths, dist_fn, steps, candidates=None):
+    """Steps/sec and accepted improving moves/sec of anneal (or anneal_neighborhood) at the calibrated temperature."""
+    T = calibrate_temperature(csr, pure_routes, route_lengths, dist_fn, candidates=candidates)
+    store = RouteStore(pure_routes, route_lengths)
+    improving = 0
+    start = time.perf_counter()
+    for _ in range(steps):
+        if candidates is None:
+            result = anneal(csr, store, T, dist_fn)
+        else:
+            result = anneal_neighborhood(csr, store, T, candidates, dist_fn)
+        if result is not None and result[2] and result[1] < 0:
+            improving += 1
+    seconds = time.perf_counter() - start
+    return {
+        'steps_per_sec': steps / seconds,
+        'improvements_per_sec': improving / seconds,
+        'final_max': store.max_length(),
+    }
+
+
+def run_size(name, grid_size, n_buildings, seed=0, repeat=3):
+    """Benchmark every pipeline stage on one synthetic graph; returns a dict of metrics."""
+    random.seed(seed)
+    G, snap_seconds = timed(synthetic_graph, grid_size, n_buildings, seed)
+    csr, compile_seconds = timed(CSRGraph, G)
+    buildings = [n for n, is_building in zip(csr.nodes, csr.is_building) if is_building]
+    starting_pts = random.sample(buildings, NUM_ROUTES)
+
+    # Half the buildings visited, as midway through get_init_solution.
+    visited = set(random.sample(buildings, len(buildings) // 2))
+    sources = [random.choice(buildings) for _ in range(NEAREST_QUERIES)]
+    start = time.perf_counter()
+    for source in sources:
+        nearest_unvisited_node(csr, source, visited | {source})
+    nearest_seconds = (time.perf_counter() - start) / NEAREST_QUERIES
+
+    pairs = [(csr.index[random.choice(buildings)], csr.index[random.choice(buildings)])
+             for _ in range(NEAREST_QUERIES)]
+    start = time.perf_counter()
+    for a, b in pairs:
+        csr._dijkstra(a, target=b)
+    dijkstra_query_seconds = (time.perf_counter() - start) / NEAREST_QUERIES
+    hierarchy, hierarchy_seconds = timed(ContractionHierarchy.build, csr)
+    start = time.perf_counter()
+    for a, b in pairs:
+        hierarchy.distance(a, b)
+    hierarchy_query_seconds = (time.perf_counter() - start) / NEAREST_QUERIES
+
+    init_seconds = min(timed(get_init_solution, csr, starting_pts)[1] for _ in range(repeat))
+    routes, route_lengths, pure_routes = get_init_solution(csr, starting_pts)
+
+    matrix, matrix_seconds = timed(DistanceMatrix.from_graph, csr, starting_pts + buildings)
+    candidates, candidates_seconds = timed(build_candidates, csr, starting_pts, matrix, 'candidates')
+
+    random.seed(seed)
+    anneal_random = anneal_throughput(csr, pure_routes, route_lengths, matrix, ANNEAL_STEPS)
+    random.seed(seed)
+    anneal_candidates = anneal_throughput(csr, pure_routes, route_lengths, matrix, ANNEAL_STEPS, candidates)
+
+    gen_seconds = min(timed(gen_route_from_pure, csr, pure_routes)[1] for _ in range(repeat))
+
+    route_colors = generate_route_colors(routes)
+    serialized = {}
+    for fmt in ('rows', 'columnar'):
+        graph_data, seconds = timed(serialize_graph, G, routes, route_colors, columnar=fmt == 'columnar')
+        body, dump_seconds = timed(json.dumps, graph_data)
+        serialized[fmt] = {'seconds': seconds, 'json_seconds': dump_seconds, 'bytes': len(body)}
+
+    return {
+        'size': name,
+        'grid_size': grid_size,
+        'buildings': n_buildings,
+        'nodes': G.number_of_nodes(),
+        'edges': G.number_of_edges(),
+        'synthetic_graph_seconds': snap_seconds,
+        'compile_seconds': compile_seconds,
+        'nearest_unvisited_node_seconds': nearest_seconds,
+        'dijkstra_query_seconds': dijkstra_query_seconds,
+        'hierarchy_build_seconds': hierarchy_seconds,
+        'hierarchy_query_seconds': hierarchy_query_seconds,
+        'get_init_solution_seconds': init_seconds,
+        'distance_matrix_seconds': matrix_seconds,
+        'candidates_seconds': candidates_seconds,
+        'anneal_random': anneal_random,
+        'anneal_candidates': anneal_candidates,
+        'gen_route_from_pure_seconds': gen_seconds,
+        'serialize': serialized,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _flatten(metrics, prefix=''):
+    flat = {}
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(old, new):
+    """Print new/old ratios of every numeric metric the two result files share, per size."""
+    old_sizes = {result['size']: result for result in old['results']}
+    for result in new['results']:
+        baseline = old_sizes.get(result['size'])
+        if baseline is None:
+            continue
+        print(f"{result['size']} ({old.get('revision')} -> {new.get('revision')}):")
+        old_flat, new_flat = _flatten(baseline), _flatten(result)
+        for key, value in new_flat.items():
+            if key in old_flat and old_flat[key]:
+                print(f"  {key:45s} {old_flat[key]:14.6g} {value:14.6g}  x{value / old_flat[key]:.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=list(SIZES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.sizes:
+        grid_size, n_buildings = SIZES[name]
+        print(f"Benchmarking {name} ({grid_size}x{grid_size} grid, {n_buildings} buildings)")
+        results.append(run_size(name, grid_size, n_buildings, seed=args.seed, repeat=args.repeat))
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+import hashlib
+import heapq
+import os
+
+import numpy as np
+
+from metrics import registry
+
+# Nodes a witness search may settle before giving up (and adding the shortcut anyway).
+WITNESS_SETTLE_LIMIT = 64
+
+# File names of a hierarchy inside a graph cache entry.
+ARRAY_NAMES = ('rank', 'up_indptr', 'up_node', 'up_weight', 'up_middle',
+               'down_indptr', 'down_node', 'down_weight', 'down_middle', 'shape', 'fingerprint')
+
+
+def graph_fingerprint(graph):
+    """SHA-256 of the CSR arrays of CSRGraph `graph`, as 32 uint8 values."""
+    digest = hashlib.sha256()
+    for array in (graph.indptr, graph.indices, graph.weights):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return np.frombuffer(digest.digest(), dtype=np.uint8)
+
+
+def _witness_distances(out_adj, source, skip, bound):
+    """Distances from source within `bound`, not passing through `skip`, of at most WITNESS_SETTLE_LIMIT nodes."""
+    dist = {source: 0.0}
+    pq = [(0.0, source)]
+    settled = 0
+    while pq and settled < WITNESS_SETTLE_LIMIT:
+        d, u = heapq.heappop(pq)
+        if d > dist[u]:
+            continue
+        if d > bound:
+            break
+        settled += 1
+        for v, w in out_adj[u].items():
+            if v == skip:
+                continue
+            nd = d + w
+            if nd < dist.get(v, float('infinity')):
+                dist[v] = nd
+                heapq.heappush(pq, (nd, v))
+    return dist
+
+
+def _shortcuts(out_adj, in_adj, v):
+    """The shortcuts contracting v needs: (u, w, length) for every u -> v -> w without a shorter witness."""
+    shortcuts = []
+    outgoing = out_adj[v]
+    for u, wu in in_adj[v].items():
+        if u == v:
+            continue
+        targets = [(w, wu + ww) for w, ww in outgoing.items() if w != u and w != v]
+        if not targets:
+            continue
+        witness = _witness_distances(out_adj, u, v, max(length for _, length in targets))
+        for w, length in targets:
+            if witness.get(w, float('infinity')) > length:
+                shortcuts.append((u, w, length))
+    return shortcuts
+
+
+def _to_csr(n, edges):
+    """(node, other, weight, middle) lists as CSR arrays grouped by node."""
+    edges.sort(key=lambda edge: edge[0])
+    counts = np.bincount(np.array([e[0] for e in edges], dtype=np.int64), minlength=n)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return (indptr,
+            np.array([e[1] for e in edges], dtype=np.int64),
+            np.array([e[2] for e in edges], dtype=np.float64),
+            np.array([e[3] for e in edges], dtype=np.int64))
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy over a CSRGraph, for point-to-point distance and path
+    queries that settle a few hundred nodes instead of most of the graph.
+
+    Nodes are contracted one at a time, least important first (fewest shortcuts
+    added minus edges removed, plus already contracted neighbors, with lazy
+    updates); contracting v adds a shortcut u -> w for every u -> v -> w that
+    has no shorter witness path avoiding v. A query is then a bidirectional
+    Dijkstra that only goes up the hierarchy: forward from the source over
+    "up" edges to higher ranked nodes, backward from the target over "down"
+    edges that arrive from higher ranked nodes. Shortcuts remember the node
+    they bypass, so paths are unpacked recursively into original edges.
+
+    Everything is indexed like the CSRGraph it was built from (node indices,
+    not ids) and stored as flat arrays, so it can be saved next to a graph cache
+    entry and memory-mapped back (see graph_cache.cached_hierarchy).
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.n, self.edges = (int(x) for x in arrays['shape'])
+        # Python lists are much faster than numpy scalars inside the search loops.
+        self._rank = arrays['rank'].tolist()
+        self._up = self._adjacency(arrays, 'up')
+        self._down = self._adjacency(arrays, 'down')
+
+    @staticmethod
+    def _adjacency(arrays, prefix):
+        indptr = arrays[f'{prefix}_indptr'].tolist()
+        node = arrays[f'{prefix}_node'].tolist()
+        weight = arrays[f'{prefix}_weight'].tolist()
+        middle = arrays[f'{prefix}_middle'].tolist()
+        return [list(zip(node[indptr[i]:indptr[i + 1]], weight[indptr[i]:indptr[i + 1]],
+                         middle[indptr[i]:indptr[i + 1]]))
+                for i in range(len(indptr) - 1)]
+
+    @classmethod
+    def build(cls, graph):
+        """Contract every node of CSRGraph `graph`."""
+        n = len(graph)
+        out_adj = [{} for _ in range(n)]
+        in_adj = [{} for _ in range(n)]
+        middle = {}
+        indptr, indices, weights = graph._indptr, graph._indices, graph._weights
+        for u in range(n):
+            for e in range(indptr[u], indptr[u + 1]):
+                v = indices[e]
+                if v != u:
+                    out_adj[u][v] = weights[e]
+                    in_adj[v][u] = weights[e]
+
+        contracted_neighbors = [0] * n
+
+        def priority(v, shortcuts):
+            return len(shortcuts) - len(out_adj[v]) - len(in_adj[v]) + contracted_neighbors[v]
+
+        pq = [(priority(v, _shortcuts(out_adj, in_adj, v)), v) for v in range(n)]
+        heapq.heapify(pq)
+        rank = [0] * n
+        up_edges, down_edges = [], []
+        shortcuts_added = 0
+        next_rank = 0
+        while pq:
+            _, v = heapq.heappop(pq)
+            # Lazy update: contract v only if it is still the least important node.
+            shortcuts = _shortcuts(out_adj, in_adj, v)
+            current = priority(v, shortcuts)
+            if pq and current > pq[0][0]:
+                heapq.heappush(pq, (current, v))
+                continue
+
+            for u, w, length in shortcuts:
+                if length < out_adj[u].get(w, float('infinity')):
+                    out_adj[u][w] = length
+                    in_adj[w][u] = length
+                    middle[(u, w)] = v
+                    shortcuts_added += 1
+
+            rank[v] = next_rank
+            next_rank += 1
+            # Every edge left at v leads to a node contracted later, i.e. up the hierarchy.
+            for w, length in out_adj[v].items():
+                up_edges.append((v, w, length, middle.get((v, w), -1)))
+                del in_adj[w][v]
+                contracted_neighbors[w] += 1
+            for u, length in in_adj[v].items():
+                down_edges.append((v, u, length, middle.get((u, v), -1)))
+                del out_adj[u][v]
+                contracted_neighbors[u] += 1
+            out_adj[v] = {}
+            in_adj[v] = {}
+
+        registry.incr('hierarchy.shortcuts', shortcuts_added)
+        up = _to_csr(n, up_edges)
+        down = _to_csr(n, down_edges)
+        arrays = {'rank': np.array(rank, dtype=np.int64),
+                  'shape': np.array([n, len(graph._indices)], dtype=np.int64),
+                  'fingerprint': graph_fingerprint(graph)}
+        for prefix, (indptr, node, weight, mid) in (('up', up), ('down', down)):
+            arrays[f'{prefix}_indptr'] = indptr
+            arrays[f'{prefix}_node'] = node
+            arrays[f'{prefix}_weight'] = weight
+            arrays[f'{prefix}_middle'] = mid
+        return cls(arrays)
+
+    def save(self, path, prefix='ch_'):
+        """Write the arrays as <prefix><name>.npy files into directory `path`."""
+        for name in ARRAY_NAMES:
+            tmp = os.path.join(path, f'.{prefix}{name}.npy')
+            np.save(tmp, self.arrays[name])
+            os.replace(tmp, os.path.join(path, f'{prefix}{name}.npy'))
+
+    @classmethod
+    def load(cls, path, prefix='ch_'):
+        """Read a hierarchy written by save, or return None if `path` has none."""
+        files = {name: os.path.join(path, f'{prefix}{name}.npy') for name in ARRAY_NAMES}
+        if not all(os.path.isfile(f) for f in files.values()):
+            return None
+        return cls({name: np.load(f, mmap_mode='r') for name, f in files.items()})
+
+    def matches(self, graph):
+        """Whether this hierarchy was built from CSRGraph `graph`: same shape and CSR arrays (see graph_fingerprint)."""
+        return self.n == len(graph) and self.edges == len(graph._indices) and \
+            np.array_equal(self.arrays['fingerprint'], graph_fingerprint(graph))
+
+    def _search(self, s, t):
+        """
+        Bidirectional upward Dijkstra between node indices s and t. Returns the
+        distance (infinity if unreachable), the meeting node and the parents of
+        both searches as {node: (parent, middle)}.
+        """
+        inf = float('infinity')
+        dist_f, dist_b = {s: 0.0}, {t: 0.0}
+        parent_f, parent_b = {s: None}, {t: None}
+        pq_f, pq_b = [(0.0, s)], [(0.0, t)]
+        best, meet = (0.0, s) if s == t else (inf, -1)
+        settled = 0
+        searches = ((pq_f, dist_f, parent_f, dist_b, self._up), (pq_b, dist_b, parent_b, dist_f, self._down))
+        while pq_f or pq_b:
+            for pq, dist, parent, other, adjacency in searches:
+                if not pq:
+                    continue
+                d, u = heapq.heappop(pq)
+                if d > dist[u]:
+                    continue
+                # Neither direction can improve once its queue is past the best meeting.
+                if d >= best:
+                    pq.clear()
+                    continue
+                settled += 1
+                if u in other and d + other[u] < best:
+                    best, meet = d + other[u], u
+                for v, w, mid in adjacency[u]:
+                    nd = d + w
+                    if nd < dist.get(v, inf):
+                        dist[v] = nd
+                        parent[v] = (u, mid)
+                        heapq.heappush(pq, (nd, v))
+        registry.incr('hierarchy.queries')
+        registry.incr('hierarchy.settled', settled)
+        return best, meet, parent_f, parent_b
+
+    def distance(self, s, t):
+        """Shortest path length from node index s to node index t (infinity if unreachable)."""
+        return self._search(s, t)[0]
+
+    def path(self, s, t):
+        """Shortest path from node index s to t as (list of node indices, length), or None if unreachable."""
+        best, meet, parent_f, parent_b = self._search(s, t)
+        if meet == -1:
+            return None
+        # Hierarchy edges from s up to the meeting node, then down to t, as (from, to, middle).
+        up, node = [], meet
+        while parent_f[node] is not None:
+            prev, mid = parent_f[node]
+            up.append((prev, node, mid))
+            node = prev
+        up.reverse()
+        node = meet
+        while parent_b[node] is not None:
+            nxt, mid = parent_b[node]
+            up.append((node, nxt, mid))
+            node = nxt
+
+        path = [s]
+        stack = up[::-1]
+        while stack:
+            a, b, mid = stack.pop()
+            if mid == -1:
+                path.append(b)
+            else:
+                stack.append((mid, b, self._middle(mid, b)))
+                stack.append((a, mid, self._middle(a, mid)))
+        return path, best
+
+    def _middle(self, a, b):
+        """Node the hierarchy edge a -> b bypasses (-1 for an original edge)."""
+        # An edge is stored at its lower ranked end: as an up edge of a or a down edge of b.
+        if self._rank[a] < self._rank[b]:
+            edges, other = self._up[a], b
+        else:
+            edges, other = self._down[b], a
+        return min((w, mid) for v, w, mid in edges if v == other)[1]
@@ -2,151 +2,201 @@ import osmnx as ox
 import networkx as nx
 import geopandas as gpd
 import matplotlib.pyplot as plt
-from shapely.geometry import Point, LineString
+import numpy as np
+import shapely
+from osmnx._errors import InsufficientResponseError
 from scipy.spatial import cKDTree
 import warnings
 
+from attachments import BuildingAttachments
+from metrics import registry
+from osm_import import mercator_centroids, open_store
+
 # Suppress specific runtime warnings from Shapely
 warnings.filterwarnings("ignore", category=RuntimeWarning, module="shapely")
 
-def get_closest_perp(G, point):
+# Every OSM feature the graph needs, fetched together in one query.
+FEATURE_TAGS = {'building': True, 'amenity': 'fire_station'}
+
+def edge_geometries(G):
     """
-    Given a graph G and a shapely Point, find the nearest edge to the point,
-    compute the projection of the point onto that edge, and return the line (as a LineString)
-    connecting the point to its projection on the edge.
+    Return the (u, v, key) of every edge of G and a parallel array of LineStrings.
+    Edges without a 'geometry' attribute get a straight line between their endpoints.
     """
-    # Get the nearest edge (u, v, key) to the point using OSMnx's built-in function.
-    u, v, key = ox.distance.nearest_edges(G, point.x, point.y)
-
-    # Retrieve the edge geometry. If the edge has no geometry attribute, create a LineString from node coordinates.
-    edge_data = G.edges[u, v, key]
-    if 'geometry' in edge_data:
-        edge_geom = edge_data['geometry']
-    else:
-        point_u = Point(G.nodes[u]['x'], G.nodes[u]['y'])
-        point_v = Point(G.nodes[v]['x'], G.nodes[v]['y'])
-        edge_geom = LineString([point_u, point_v])
-
-    # Compute the projection of the point onto the edge geometry.
-    projected_distance = edge_geom.project(point)
-    projection_point = edge_geom.interpolate(projected_distance)
-
-    # Create the perpendicular line segment from the point (building centroid) to the projection point.
-    perpendicular_line = LineString([point, projection_point])
-
-    # return u, v, key, perpendicular_line, projection_point, edge_geom
-    return perpendicular_line, projection_point, u, v
-
-
-def add_perp(G_combined, building_node_id):
+    edges = list(G.edges(keys=True, data=True))
+    edge_ids = [(u, v, key) for u, v, key, _ in edges]
+    geoms = np.empty(len(edges), dtype=object)
+    missing = []
+    endpoints = []
+    for i, (u, v, _, data) in enumerate(edges):
+        geom = data.get('geometry')
+        if geom is None:
+            missing.append(i)
+            endpoints.append([[G.nodes[u]['x'], G.nodes[u]['y']], [G.nodes[v]['x'], G.nodes[v]['y']]])
+        else:
+            geoms[i] = geom
+
+    if missing:
+        geoms[missing] = shapely.linestrings(np.array(endpoints, dtype=np.float64))
+    return edge_ids, geoms
+
+
+def snap_buildings(G_combined, building_node_ids):
     """
-    Given a combined graph (with building nodes added) and a building node ID,
-    compute the perpendicular edge to the nearest street edge and add it to the graph.
+    Attach every building node to its nearest street edge in one batch.
+
+    One STRtree is built over the street edge geometries, every building centroid
+    is matched with a single vectorized nearest query, and all projections onto the
+    matched edges are computed with shapely's array functions. The graph itself is
+    not edited: the attachments (street, position along it, projection point) are
+    added to G_combined.graph['building_attachments'] (see BuildingAttachments), and
+    CSRGraph routes through them.
     """
-    # Retrieve the building node's coordinates.
-    building_data = G_combined.nodes[building_node_id]
-    building_point = Point(building_data['x'], building_data['y'])
-
-    # Find nearest street edge and compute the perpendicular line.
-    perp_line, proj_point, u, v = get_closest_perp(G_combined, building_point)
-
-    # Create a new node for the projection point.
-    # Use a unique id (e.g., a negative number or use a naming scheme).
-    projection_node_id = f"proj_{building_node_id}"
-    G_combined.add_node(projection_node_id, x=proj_point.x, y=proj_point.y, node_type='projection')
-
-    G_combined.remove_edge(u, v)
-    if G_combined.has_edge(v, u):
-        G_combined.remove_edge(v, u)
-    distU = ((proj_point.x - G_combined.nodes[u]["x"]) ** 2 + (proj_point.y - G_combined.nodes[u]["y"]) ** 2) ** 0.5
-    distV = ((proj_point.x - G_combined.nodes[v]["x"]) ** 2 + (proj_point.y - G_combined.nodes[v]["y"]) ** 2) ** 0.5
-
-    G_combined.add_edge(projection_node_id, v, length=distV)
-    G_combined.add_edge(v, projection_node_id, length=distV)
-    G_combined.add_edge(projection_node_id, u, length=distU)
-    G_combined.add_edge(u, projection_node_id, length=distU)
-
-    return building_node_id, projection_node_id, perp_line.length, perp_line
+    if not building_node_ids:
+        return
+
+    edge_ids, edge_geoms = edge_geometries(G_combined)
+
+    bx = np.array([G_combined.nodes[b]['x'] for b in building_node_ids], dtype=np.float64)
+    by = np.array([G_combined.nodes[b]['y'] for b in building_node_ids], dtype=np.float64)
+    points = shapely.points(bx, by)
+
+    tree = shapely.STRtree(edge_geoms)
+    point_idx, edge_idx = tree.query_nearest(points, all_matches=False)
+    nearest = np.full(len(building_node_ids), -1, dtype=np.int64)
+    nearest[point_idx] = edge_idx
+    snapped = nearest >= 0
+    nearest = nearest[snapped]
+
+    # Buildings matched to either direction (or a parallel key) of the same street are
+    # measured along the geometry of the first edge matched for that street.
+    first_edge_of_street = {}
+    street_edge = np.array([first_edge_of_street.setdefault(frozenset(edge_ids[e][:2]), e) for e in nearest],
+                           dtype=np.int64)
+
+    geoms = edge_geoms[street_edge]
+    offsets = shapely.line_locate_point(geoms, points[snapped])
+    proj_points = shapely.line_interpolate_point(geoms, offsets)
+    street_lengths = shapely.length(geoms)
+    fractions = np.divide(offsets, street_lengths, out=np.zeros_like(offsets), where=street_lengths > 0)
+
+    attachments = BuildingAttachments(
+        building=[b for b, ok in zip(building_node_ids, snapped) if ok],
+        street_u=[edge_ids[e][0] for e in street_edge.tolist()],
+        street_v=[edge_ids[e][1] for e in street_edge.tolist()],
+        fraction=np.clip(fractions, 0.0, 1.0),
+        proj_x=shapely.get_x(proj_points),
+        proj_y=shapely.get_y(proj_points),
+        street_length=[G_combined.edges[edge_ids[e]].get('length', np.nan) for e in street_edge.tolist()],
+    )
+    existing = G_combined.graph.get('building_attachments')
+    G_combined.graph['building_attachments'] = attachments if existing is None else existing.extend(attachments)
+
+
+def add_reverse_edges(G):
+    """
+    Make every street walkable both ways: add v -> u for every u -> v that has no
+    reverse, with the same length and the geometry reversed.
+    """
+    edges_to_add = []
+    for u, v, data in G.edges(data=True):
+        if not G.has_edge(v, u):
+            reverse = dict(data)
+            if 'geometry' in reverse:
+                reverse['geometry'] = shapely.reverse(reverse['geometry'])
+            edges_to_add.append((v, u, reverse))
+    G.add_edges_from(edges_to_add)
 
 
-def create_graph(bounding_coords):
+def fetch_streets(bounding_coords, simplify=True, retain_all=False, truncate_by_edge=False):
+    """Street network (all road types) within (north, south, east, west), walkable both ways."""
     north, south, east, west = bounding_coords[0], bounding_coords[1], bounding_coords[2], bounding_coords[3]
+    store = open_store()
+    with registry.timer('phase.osm_fetch_streets'):
+        if store is not None and store.covers(bounding_coords):
+            G = store.streets(bounding_coords, simplify=simplify, retain_all=retain_all,
+                              truncate_by_edge=truncate_by_edge)
+        else:
+            G = ox.graph_from_bbox((west, south, east, north), network_type='all', simplify=simplify,
+                                   retain_all=retain_all, truncate_by_edge=truncate_by_edge)
+    add_reverse_edges(G)
+    return G
+
+
+def fetch_features(bounding_coords):
+    """
+    Buildings and fire stations within (north, south, east, west), from a single
+    query for FEATURE_TAGS: the building footprints as a GeoDataFrame with a
+    'centroid' column, and the fire stations as {'id', 'lat', 'lng', 'name'} dicts.
+    """
+    north, south, east, west = bounding_coords[0], bounding_coords[1], bounding_coords[2], bounding_coords[3]
+    store = open_store()
+    if store is not None and store.covers(bounding_coords):
+        # The store only keeps centroids, which it computed the same way.
+        with registry.timer('phase.osm_fetch_features'):
+            return store.buildings(bounding_coords), store.fire_stations(bounding_coords)
+    with registry.timer('phase.osm_fetch_features'):
+        features = ox.features_from_bbox((west, south, east, north), tags=FEATURE_TAGS)
+
+    # Centroids in a projected CRS (web mercator), back in lng/lat
+    x, y = mercator_centroids(features.geometry.values)
+    features['centroid'] = gpd.GeoSeries(shapely.points(x, y), index=features.index, crs=features.crs)
+
+    stations = features[features['amenity'] == 'fire_station'] if 'amenity' in features else features.iloc[:0]
+    fire_stations = [{'id': str(idx), 'lat': point.y, 'lng': point.x,
+                      'name': name if isinstance(name, str) else 'Fire Station'}
+                     for idx, point, name in zip(stations.index, stations['centroid'],
+                                                 stations.get('name', [None] * len(stations)))]
+    if 'building' not in features:
+        raise InsufficientResponseError('No buildings found within the bbox')
+    buildings = features[features['building'].notna()]
+    return buildings, fire_stations
+
+
+def snap_fire_stations(G, fire_stations):
+    """
+    Give every fire station a 'depot': the building node closest to it, which routes
+    can start from (allocation.choose_starting_points prefers them).
+    """
+    buildings = [n for n, data in G.nodes(data=True) if data.get('node_type') == 'building']
+    if not buildings or not fire_stations:
+        return
+    # Equirectangular approximation; fine at the scale of a bbox.
+    scale = np.cos(np.radians(np.mean([station['lat'] for station in fire_stations])))
+    tree = cKDTree([(G.nodes[b]['x'] * scale, G.nodes[b]['y']) for b in buildings])
+    _, nearest = tree.query([(station['lng'] * scale, station['lat']) for station in fire_stations])
+    for station, i in zip(fire_stations, np.atleast_1d(nearest).tolist()):
+        station['depot'] = buildings[i]
 
-    # Download the street network (all road types) using correct parameter order
-    G = ox.graph_from_bbox((west, south, east, north), network_type='all')
-
-    edges_to_add = []
-
-    for edge in G.edges:
-        if not G.has_edge(edge[1], edge[0]):
-            edges_to_add.append((edge[1], edge[0], edge[2]))
 
-    for edge in edges_to_add:
-        G.add_edge(edge[0], edge[1], length=edge[2])
+def create_graph(bounding_coords):
+    # Download the street network (all road types)
+    G = fetch_streets(bounding_coords)
 
     # print(G.nodes)
     # print("Downloaded street network.")
 
-    # Download building footprints in the same area as a GeoDataFrame
-    buildings = ox.features_from_bbox((west, south, east, north), tags={'building': True})
+    # Download building footprints and fire stations in the same area with one query
+    buildings, fire_stations = fetch_features(bounding_coords)
     # print(buildings.geometry.centroid)
     # print("Downloaded building footprints.")
 
-    # Download fire stations in the same area as a GeoDataFrame
-    # fire_stations = ox.features_from_bbox((west, south, east, north), tags={'amenity': 'fire_station'})
-    # fire_station_coords = set((row.geometry.centroid.x, row.geometry.centroid.y) for idx, row in fire_stations.iterrows())
-
-    # Determine an appropriate UTM CRS for the buildings
-    buildings_crs = buildings.to_crs(3857)
-    buildings_crs['centroid'] = buildings_crs.geometry.centroid
-    buildings['centroid'] = buildings_crs['centroid'].to_crs(buildings.crs)
-    # print("Reprojected centroids back to original CRS.")
-
-    # Create a copy of G so we can add building nodes
-    G_combined = G.copy()
-
-    next_id = -1
-
-    # Create a list to hold building node ids for further processing
-    next_id = -1  # Using negative numbers for building nodes so they don't conflict with OSM node IDs
-    building_node_ids = []
-    edges_to_add = []
-
-    # iterrr = 0
-    # For each building centroid, add it as a node and connect it to the nearest street node
-    for idx, row in buildings.iterrows():
-        # iterrr += 1
-        # if (iterrr % 100 == 0):
-        #     print(iterrr)
-        centroid = row['centroid']
-
-        # Check if the building is a fire station
-        # if (centroid.x, centroid.y) in fire_station_coords:
-        #     node_type = 'fire_station'
-        # else:
-        #     node_type = 'building'
-        node_type = 'building'
-
-        # Create a unique node id (e.g., negative id)
-        bnode = next_id
-        next_id -= 1  # decrement for next unique id
-        building_node_ids.append(bnode)
-
-        # Add the building centroid as a node with attributes: geometry, x, y, and a custom tag
-        G_combined.add_node(bnode, x=centroid.x, y=centroid.y, node_type=node_type)
-        building_node_id, projection_node_id, leng, perp_line = add_perp(G_combined, bnode)
-        edges_to_add.append((building_node_id, projection_node_id, leng, perp_line))
-
-
-    for building_node_id, projection_node_id, leng, perp_line in edges_to_add:
-        G_combined.add_edge(building_node_id, projection_node_id,
-                            length=1e-10,
-                            geometry=perp_line,
-                            is_perpendicular_edge=True)
-        G_combined.add_edge(projection_node_id, building_node_id,
-                            length=1e-10,
-                            geometry=perp_line,
-                            is_perpendicular_edge=True)
+    # fetch_streets returns a fresh graph, so building nodes are added to it directly
+    G_combined = G
+
+    # Building centroids become nodes -1, -2, ... (negative so they don't conflict with OSM node ids),
+    # inserted in bulk from the coordinate arrays; they are connected to the streets in one batch below
+    x = shapely.get_x(buildings['centroid'].values).tolist()
+    y = shapely.get_y(buildings['centroid'].values).tolist()
+    building_node_ids = list(range(-1, -len(x) - 1, -1))
+    G_combined.add_nodes_from((bnode, {'x': bx, 'y': by, 'node_type': 'building'})
+                              for bnode, bx, by in zip(building_node_ids, x, y))
+
+    with registry.timer('phase.snapping'):
+        snap_buildings(G_combined, building_node_ids)
+    # Fire stations travel with the graph (and its cache entry), snapped to their depot buildings
+    snap_fire_stations(G_combined, fire_stations)
+    G_combined.graph['fire_stations'] = fire_stations
 
     # print([n for n in G_combined.neighbors(-1)])
     # print("Added building centroids as nodes and connected them to the street network.")
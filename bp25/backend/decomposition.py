@@ -0,0 +1,349 @@
+"""
+Cluster-first, route-second solving for areas too large to anneal as a whole.
+
+The buildings are split among the starting points by a network Voronoi
+partition (every building goes to the starting point it is closest to by path
+length, plus a per-start offset that evens out the partition sizes), every partition is solved as its own single-route problem in a
+process pool, and a boundary rebalancing pass then moves buildings near the
+partition borders from the longest route into a neighboring one while that
+shortens the longest route. No distance is ever computed between buildings of
+different partitions, except for the few the rebalancing pass looks at.
+"""
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import csr_matrix, hstack, vstack
+from scipy.sparse.csgraph import dijkstra
+
+from metrics import registry
+from MultiTSP import (build_candidates, build_dist_fn, close_routes, default_anneal_steps, dist,
+                      get_init_solution, simulated_annealing, worker_context)
+from routing_graph import as_csr
+
+# Rounds of offset adjustment towards equally sized partitions, the first step as a
+# fraction of the median building-to-start distance, and its decay per round.
+BALANCE_ITERATIONS = 40
+BALANCE_STEP = 0.1
+BALANCE_DECAY = 0.93
+# Boundary buildings of a route tried per rebalancing move, closest to the border first.
+REBALANCE_CANDIDATES = 16
+# Upper bound on the buildings the rebalancing pass moves.
+REBALANCE_MOVES = 1000
+
+
+def _weighted_owners(csgraph, sources, offsets):
+    """
+    Position in `sources` of the owner of every node in the additively weighted
+    network Voronoi diagram (the source minimizing offsets[i] + distance), with
+    -1 where no source is reachable, and the distance to that owner.
+    """
+    n = csgraph.shape[0]
+    k = len(sources)
+    # A virtual root with an edge of weight offsets[i] to every source: a node's owner
+    # is the source its shortest path from the root goes through.
+    root_edges = csr_matrix((offsets, (np.zeros(k, dtype=np.int64), sources)), shape=(1, n + 1))
+    augmented = vstack([hstack([csgraph, csr_matrix((n, 1))]), root_edges]).tocsr()
+    dist, predecessors = dijkstra(augmented, directed=True, indices=n, return_predecessors=True)
+    registry.incr('dijkstra.scipy_sources')
+
+    up = np.where(predecessors < 0, n, predecessors)
+    up[sources] = sources
+    # Pointer jumping: every round doubles how far up the shortest path tree each entry points.
+    while True:
+        jumped = up[up]
+        if np.array_equal(jumped, up):
+            break
+        up = jumped
+    position = np.full(n + 1, -1, dtype=np.int64)
+    position[sources] = np.arange(k)
+    return position[up][:n], dist[:n]
+
+
+def voronoi_partition(G, starting_pts, buildings=None, iterations=BALANCE_ITERATIONS):
+    """
+    Assign every node of compiled graph G to a starting point by network distance
+    and return an array with the position in starting_pts of every node's owner
+    (-1 where none is reachable).
+
+    Without `buildings` this is the plain network Voronoi diagram (nearest starting
+    point). With them, the starting points get additive offsets that are adjusted
+    for `iterations` rounds (one scipy Dijkstra each) towards equal numbers of
+    buildings per partition, so that no part ends up with a far longer route than
+    the boundary rebalancing can even out; the most balanced round is returned.
+    """
+    csgraph = G.to_scipy()
+    sources = np.array([G.index[pt] for pt in starting_pts], dtype=np.int64)
+    offsets = np.zeros(len(sources))
+    owners, dist = _weighted_owners(csgraph, sources, offsets)
+    if buildings is None or not iterations:
+        return owners
+
+    targets = np.array([G.index[b] for b in buildings], dtype=np.int64)
+    reachable = np.isfinite(dist[targets])
+    if not reachable.any():
+        return owners
+    # Offsets move in steps of the typical distance from a building to its starting point.
+    scale = float(np.median(dist[targets][reachable]))
+    best, best_largest = owners, None
+    for i in range(iterations + 1):
+        counts = np.bincount(owners[targets][owners[targets] >= 0], minlength=len(sources))
+        if best_largest is None or counts.max() < best_largest:
+            best, best_largest = owners, counts.max()
+        if i == iterations:
+            break
+        offsets += BALANCE_STEP * scale * (counts / counts.mean() - 1) * BALANCE_DECAY ** i
+        offsets -= offsets.min()
+        owners, _ = _weighted_owners(csgraph, sources, offsets)
+    return best
+
+
+def boundary_neighbors(G, owners, buildings):
+    """
+    For every building, its network distance to the nearest border between two
+    partitions and the partitions (positions in starting_pts) that meet there.
+    Returns (distance, neighbors) dicts; buildings with no border in reach are left out.
+    """
+    rows = np.repeat(np.arange(len(G)), np.diff(G.indptr))
+    cols = G.indices
+    crossing = (owners[rows] != owners[cols]) & (owners[rows] >= 0) & (owners[cols] >= 0)
+    across = {}
+    for u, v in zip(rows[crossing].tolist(), cols[crossing].tolist()):
+        across.setdefault(u, {owners[u]}).add(owners[v])
+        across.setdefault(v, {owners[v]}).add(owners[u])
+    if not across:
+        return {}, {}
+
+    border = list(across)
+    # Buildings are reached from the border, so search the reversed graph.
+    border_dist, _, nearest = dijkstra(G.to_scipy().T.tocsr(), directed=True, indices=border,
+                                       min_only=True, return_predecessors=True)
+    registry.incr('dijkstra.scipy_sources', len(border))
+    distances, neighbors = {}, {}
+    for building in buildings:
+        i = G.index[building]
+        if nearest[i] < 0:
+            continue
+        distances[building] = float(border_dist[i])
+        neighbors[building] = {int(owner) for owner in across[int(nearest[i])]}
+    return distances, neighbors
+
+
+_partition_graph = None
+
+def _init_partition_worker(G):
+    global _partition_graph
+    _partition_graph = G
+
+def _solve_partition(start, buildings, mode, n_iter, time_budget, stagnation, neighborhood, seed):
+    """
+    Greedy initialization and annealing of the single route from start through
+    buildings. Returns the route's stops and the length of each of its legs.
+    """
+    # Forked workers start with identical RNG state, so every partition reseeds.
+    random.seed(seed)
+    G = _partition_graph
+    _, route_lengths, pure_routes = get_init_solution(G, [start], buildings)
+    stops = pure_routes[start]
+    dist_fn = build_dist_fn(G, [start], mode, stops=stops)
+    candidates = build_candidates(G, [start], dist_fn, neighborhood, stops=stops)
+    pure_routes, _ = simulated_annealing(G, pure_routes, route_lengths, n_iter=n_iter, dist_fn=dist_fn,
+                                         time_budget=time_budget, stagnation=stagnation,
+                                         candidates=candidates)
+    stops = pure_routes[start]
+    return stops, [dist_fn(G, a, b) for a, b in zip(stops, stops[1:])]
+
+
+def solve_partitions(G, partitions, mode="matrix", n_iter=None, workers=None, time_budget=None,
+                     stagnation=None, neighborhood="random"):
+    """
+    Solve every partition (starting point -> its buildings) independently, in a
+    process pool of `workers` processes (one per CPU by default) when there is
+    more than one. G is handed to the workers through the pool initializer, as in
+    parallel_simulated_annealing. Returns (pure_routes, legs).
+    """
+    tasks = [(start, buildings, mode, n_iter, time_budget, stagnation, neighborhood, random.randrange(2 ** 32))
+             for start, buildings in partitions.items()]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        _init_partition_worker(G)
+        results = [_solve_partition(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context(),
+                                 initializer=_init_partition_worker, initargs=(G,)) as pool:
+            futures = [pool.submit(_solve_partition, *task) for task in tasks]
+            results = [future.result() for future in futures]
+
+    pure_routes = {start: stops for start, (stops, _) in zip(partitions, results)}
+    legs = {start: route_legs for start, (_, route_legs) in zip(partitions, results)}
+    return pure_routes, legs
+
+
+def rebalance(G, pure_routes, legs, border_dist, border_neighbors, starting_pts,
+              candidates=REBALANCE_CANDIDATES, max_moves=REBALANCE_MOVES):
+    """
+    Move buildings near the partition borders from longer routes into shorter
+    neighboring ones while that lowers the maximum route length, modifying
+    pure_routes and legs in place.
+
+    Every move tries the routes longest first: it looks at the route's `candidates`
+    buildings closest to a border and inserts the best of them at its cheapest
+    position in a shorter route of a partition meeting there, if both resulting
+    routes are shorter than the source route was. Load thus also flows through
+    routes that are not the longest, towards short routes that do not border the
+    longest one. The distances to and from a candidate come from one forward and
+    one reverse scipy Dijkstra, kept for the rest of the pass. Returns the number
+    of buildings moved.
+    """
+    csgraph = G.to_scipy()
+    reverse = csgraph.T.tocsr()
+    rows = {}
+    route_of = {stop: start for start, stops in pure_routes.items() for stop in stops[1:]}
+    lengths = {start: sum(route_legs) for start, route_legs in legs.items()}
+    by_border = sorted(border_dist, key=border_dist.get)
+
+    def distance_rows(buildings):
+        missing = [b for b in buildings if b not in rows]
+        if missing:
+            indices = [G.index[b] for b in missing]
+            forward = dijkstra(csgraph, directed=True, indices=indices)
+            backward = dijkstra(reverse, directed=True, indices=indices)
+            registry.incr('dijkstra.scipy_sources', 2 * len(indices))
+            for b, from_b, to_b in zip(missing, forward, backward):
+                rows[b] = (from_b, to_b)
+
+    def best_move(source):
+        limit = lengths[source]
+        chosen = [b for b in by_border if route_of.get(b) == source][:candidates]
+        distance_rows(chosen)
+
+        best = None
+        route = pure_routes[source]
+        for b in chosen:
+            from_b, to_b = rows[b]
+            p = route.index(b)
+            if p + 1 < len(route):
+                bridge = dist(G, route[p - 1], route[p + 1])
+                removed = legs[source][p - 1] + legs[source][p] - bridge
+            else:
+                bridge = None
+                removed = legs[source][p - 1]
+            new_source = limit - removed
+
+            for owner in border_neighbors[b]:
+                dest = starting_pts[owner]
+                if dest == source or lengths[dest] >= limit:
+                    continue
+                stops = pure_routes[dest]
+                idx = np.array([G.index[stop] for stop in stops], dtype=np.int64)
+                # Inserting after stop q costs d(q, b) + d(b, q + 1) - d(q, q + 1), or d(last, b) at the end.
+                costs = to_b[idx].copy()
+                costs[:-1] += from_b[idx[1:]] - np.asarray(legs[dest], dtype=np.float64)
+                q = int(np.argmin(costs))
+                new_dest = lengths[dest] + float(costs[q])
+                new_max = max(new_source, new_dest)
+                if new_max < limit and not np.isinf(costs[q]) and (best is None or new_max < best[0]):
+                    best = (new_max, b, p, bridge, dest, q, new_source, new_dest)
+        return best
+
+    moved = 0
+    while moved < max_moves:
+        for source in sorted(lengths, key=lengths.get, reverse=True):
+            best = best_move(source)
+            if best is not None:
+                break
+        else:
+            break
+        _, b, p, bridge, dest, q, new_source, new_dest = best
+        from_b, to_b = rows[b]
+
+        route = pure_routes[source]
+        del route[p]
+        route_legs = legs[source]
+        if bridge is None:
+            del route_legs[p - 1]
+        else:
+            route_legs[p - 1:p + 1] = [bridge]
+        lengths[source] = new_source
+
+        stops = pure_routes[dest]
+        insert = [float(to_b[G.index[stops[q]]])]
+        if q + 1 < len(stops):
+            insert.append(float(from_b[G.index[stops[q + 1]]]))
+        legs[dest][q:q + 1] = insert
+        stops.insert(q + 1, b)
+        lengths[dest] = new_dest
+        route_of[b] = dest
+        moved += 1
+
+    registry.incr('rebalance.moves', moved)
+    return moved
+
+
+def get_decomposed_solution(G, starting_pts, mode="matrix", n_iter=None, workers=None, time_budget=None,
+                            stagnation=None, callback=None, neighborhood="random"):
+    """
+    Cluster-first, route-second counterpart of get_actual_solution: Voronoi
+    partition, every partition annealed on its own in parallel (mode, n_iter,
+    time_budget, stagnation and neighborhood apply per partition, see
+    get_actual_solution), then boundary rebalancing. Returns the same
+    (routes, pure_routes, route_lengths), with routes and pure_routes closed.
+
+    callback receives an "init" event with the merged partition solutions and an
+    "improvement" event if rebalancing shortened the longest route.
+    """
+    G = as_csr(G)
+    buildings = [n for n, is_building in zip(G.nodes, G.is_building) if is_building]
+    starts = set(starting_pts)
+
+    with registry.timer('phase.partition'):
+        owners = voronoi_partition(G, starting_pts, buildings)
+        partitions = {pt: [] for pt in starting_pts}
+        for building in buildings:
+            owner = owners[G.index[building]]
+            if owner >= 0 and building not in starts:
+                partitions[starting_pts[owner]].append(building)
+    sizes = [len(members) for members in partitions.values()]
+    registry.gauge('decomposition.partitions', len(sizes))
+    registry.gauge('decomposition.largest_partition', max(sizes))
+    registry.gauge('decomposition.smallest_partition', min(sizes))
+
+    if n_iter is None and time_budget is None:
+        n_iter = default_anneal_steps(mode)
+    with registry.timer('phase.partition_solve'):
+        pure_routes, legs = solve_partitions(G, partitions, mode=mode, n_iter=n_iter, workers=workers,
+                                             time_budget=time_budget, stagnation=stagnation,
+                                             neighborhood=neighborhood)
+    start = time.perf_counter()
+    old_max = max(sum(route_legs) for route_legs in legs.values())
+    if callback is not None:
+        callback({
+            "type": "init",
+            "best_max": old_max,
+            "route_lengths": {pt: sum(route_legs) for pt, route_legs in legs.items()},
+            "pure_routes": {pt: list(stops) for pt, stops in pure_routes.items()},
+        })
+
+    with registry.timer('phase.rebalance'):
+        border_dist, border_neighbors = boundary_neighbors(G, owners, buildings)
+        moved = rebalance(G, pure_routes, legs, border_dist, border_neighbors, starting_pts)
+    route_lengths = {pt: sum(route_legs) for pt, route_legs in legs.items()}
+    new_max = max(route_lengths.values())
+    if moved and callback is not None:
+        callback({
+            "type": "improvement",
+            "iteration": moved,
+            "elapsed": time.perf_counter() - start,
+            "best_max": new_max,
+            "route_lengths": dict(route_lengths),
+            "pure_routes": {pt: list(stops) for pt, stops in pure_routes.items()},
+        })
+
+    with registry.timer('phase.path_expansion'):
+        routes = close_routes(G, pure_routes)
+    registry.gauge('decomposition.rebalance_ratio', new_max / old_max if old_max else 1.0)
+    return routes, pure_routes, route_lengths
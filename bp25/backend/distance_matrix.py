@@ -0,0 +1,260 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+from networkx import NetworkXNoPath
+from scipy.sparse.csgraph import dijkstra
+
+from metrics import registry
+from routing_graph import as_csr
+
+# Same sentinel dist() in MultiTSP returns for unreachable pairs, so the
+# annealer's delta arithmetic behaves identically in both solver modes.
+UNREACHABLE = 1e18
+
+# Memory bound of a DistanceCache (its rows and predecessors), in bytes.
+DISTANCE_CACHE_MAX_BYTES = int(os.environ.get('BP25_DISTANCE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+
+class DistanceMatrix:
+    """
+    Dense all-pairs shortest path lengths between a fixed set of nodes
+    (building nodes and starting points). Built once per solve so that
+    every annealing move is an O(1) lookup instead of a Dijkstra run.
+
+    Instances are callable with the same signature as MultiTSP.dist, so
+    they can be passed straight in as the annealer's distance function.
+    """
+
+    def __init__(self, nodes, matrix):
+        self.nodes = list(nodes)
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.matrix = matrix
+
+    @classmethod
+    def from_graph(cls, G, nodes, batch_size=256):
+        """
+        Run one single-source Dijkstra per node in `nodes` over the whole graph
+        and keep only the columns for `nodes`. Sources are processed in batches
+        so the intermediate (batch x |V|) array stays bounded.
+        G may be a networkx graph or an already compiled CSRGraph.
+        """
+        nodes = list(dict.fromkeys(nodes))
+        matrix = np.empty((len(nodes), len(nodes)), dtype=np.float64)
+        for start, rows in _distance_rows(G, nodes, batch_size):
+            matrix[start:start + len(rows)] = rows
+
+        matrix[np.isinf(matrix)] = UNREACHABLE
+        return cls(nodes, matrix)
+
+    def __call__(self, G, a, b):
+        return self.matrix.item(self.index[a], self.index[b])
+
+    def __contains__(self, node):
+        return node in self.index
+
+    def nearest_neighbors(self, k, batch_size=256):
+        """Same as the module-level nearest_neighbors, read off the matrix."""
+        neighbors = {}
+        for start in range(0, len(self.nodes), batch_size):
+            neighbors.update(_nearest_from_rows(self.nodes, start, self.matrix[start:start + batch_size], k))
+        return neighbors
+
+
+def _distance_rows(G, nodes, batch_size):
+    """
+    Yield (first row, rows) blocks of the distances from every node in `nodes`
+    to every node in `nodes`, one batched scipy Dijkstra per block.
+    """
+    compiled = as_csr(G)
+    csgraph = compiled.to_scipy()
+    targets = np.array([compiled.index[node] for node in nodes], dtype=np.int64)
+    for start in range(0, len(nodes), batch_size):
+        sources = targets[start:start + batch_size]
+        rows = dijkstra(csgraph, directed=True, indices=sources)
+        registry.incr('dijkstra.scipy_sources', len(sources))
+        yield start, rows[:, targets]
+
+
+def _nearest_from_rows(nodes, start, rows, k):
+    neighbors = {}
+    if len(nodes) < 2:
+        return {node: [] for node in nodes[start:start + len(rows)]}
+    k = min(k, len(nodes) - 1)
+    rows = np.array(rows, dtype=np.float64)
+    rows[np.arange(len(rows)), np.arange(start, start + len(rows))] = np.inf
+    nearest = np.argpartition(rows, k - 1, axis=1)[:, :k]
+    for r, candidates in enumerate(nearest):
+        candidates = candidates[np.argsort(rows[r, candidates], kind='stable')]
+        neighbors[nodes[start + r]] = [nodes[c] for c in candidates.tolist() if rows[r, c] < UNREACHABLE]
+    return neighbors
+
+
+def stale_entries(G, region, sources, targets, rows, batch_size=256):
+    """
+    Mask of the entries of distance rows `rows` (from node indices `sources` to
+    `targets` of compiled G) that can change when the node indices `region` are
+    cut out of G. A path from a to b through the region is at least
+    d(a, region) + d(region, b) long, so a shorter finite entry keeps its value.
+    Costs two Dijkstra runs (to and from the region) instead of one per row.
+    """
+    stale = np.zeros(np.shape(rows), dtype=bool)
+    if not len(region) or not stale.size:
+        return stale
+    csgraph = G.to_scipy()
+    region = np.asarray(region, dtype=np.int64)
+    to_region = dijkstra(csgraph.T.tocsr(), directed=True, indices=region, min_only=True)[sources]
+    from_region = dijkstra(csgraph, directed=True, indices=region, min_only=True)[targets]
+    registry.incr('dijkstra.scipy_sources', 2)
+    for start in range(0, len(sources), batch_size):
+        block = rows[start:start + batch_size]
+        bound = to_region[start:start + batch_size, None] + from_region[None, :]
+        # Slack for the rounding of summing the same path in a different order.
+        stale[start:start + batch_size] = (bound <= block * (1 + 1e-9) + 1e-6) & (block < UNREACHABLE)
+    return stale
+
+
+def nearest_neighbors(G, nodes, k, batch_size=256):
+    """
+    For every node in `nodes`, the (up to) k other nodes of `nodes` closest to it
+    by network distance, closest first; unreachable ones are left out. Computed
+    in Dijkstra batches like DistanceMatrix.from_graph, but only O(len(nodes) * k)
+    is kept, so it also works where the full matrix does not fit.
+    """
+    nodes = list(dict.fromkeys(nodes))
+    neighbors = {}
+    for start, rows in _distance_rows(G, nodes, batch_size):
+        neighbors.update(_nearest_from_rows(nodes, start, rows, k))
+    return neighbors
+
+
+class DistanceCache:
+    """
+    Lazily filled, memory-bounded alternative to DistanceMatrix for areas where
+    a dense building matrix does not fit.
+
+    A lookup for (a, b) that misses runs one single-source Dijkstra from a and
+    keeps the whole row of distances from a to every node in `nodes`, so the
+    following lookups from a (the annealer keeps revisiting the same neighbors)
+    are array reads. The search's predecessors are kept as well, so path() /
+    path_with_length() from a recent source need no search at all.
+
+    max_bytes bounds both: the predecessors of at most max_paths sources take up
+    to half of it, and the rows fill the rest, evicted least recently used first.
+
+    without() carries the cache over to a masked copy of the graph, invalidating
+    only the entries the removed nodes can change.
+
+    Callable with the same signature as MultiTSP.dist.
+    """
+
+    def __init__(self, G, nodes, max_bytes=DISTANCE_CACHE_MAX_BYTES, max_paths=8):
+        self.graph = as_csr(G)
+        self.csgraph = self.graph.to_scipy()
+        self.nodes = list(dict.fromkeys(nodes))
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.targets = np.array([self.graph.index[node] for node in self.nodes], dtype=np.int64)
+        self.max_bytes = max_bytes
+        # A float64 distance and an int32 predecessor for every graph node per source.
+        path_bytes = 12 * max(1, len(self.graph))
+        self.max_paths = max(1, min(max_paths, max_bytes // 2 // path_bytes))
+        self.max_rows = max(1, (max_bytes - self.max_paths * path_bytes) // max(1, 8 * len(self.nodes)))
+        self._rows = OrderedDict()
+        self._predecessors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _search(self, a):
+        """Single-source Dijkstra from a; caches its row and predecessors."""
+        dist, predecessors = dijkstra(self.csgraph, directed=True, indices=self.graph.index[a],
+                                      return_predecessors=True)
+        registry.incr('dijkstra.scipy_sources')
+        row = dist[self.targets]
+        row[np.isinf(row)] = UNREACHABLE
+        self._rows[a] = row
+        self._rows.move_to_end(a)
+        while len(self._rows) > self.max_rows:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+        self._predecessors[a] = (dist, predecessors)
+        while len(self._predecessors) > self.max_paths:
+            self._predecessors.popitem(last=False)
+        return row
+
+    def __call__(self, G, a, b):
+        row = self._rows.get(a)
+        distance = row.item(self.index[b]) if row is not None else float('nan')
+        # NaN: no row from a yet, or an entry without() invalidated.
+        if distance != distance:
+            self.misses += 1
+            return self._search(a).item(self.index[b])
+        self.hits += 1
+        self._rows.move_to_end(a)
+        return distance
+
+    def without(self, old_graph, new_graph, region):
+        """
+        The cache for compiled graph new_graph, made from old_graph (self.graph) by
+        cutting out the node indices `region` (see CSRGraph.without). Cached rows
+        are kept with the entries stale_entries flags set to NaN, so only a lookup
+        of one of those searches its source again; the predecessors, which index
+        old_graph, are dropped. Nodes that are not in new_graph are dropped.
+        """
+        cache = DistanceCache(new_graph, [node for node in self.nodes if node in new_graph],
+                              max_bytes=self.max_bytes, max_paths=self.max_paths)
+        sources = [a for a in self._rows if a in new_graph]
+        if not sources or not cache.nodes:
+            return cache
+        kept = np.array([self.index[node] for node in cache.nodes], dtype=np.int64)
+        rows = np.array([self._rows[a][kept] for a in sources])
+        stale = stale_entries(old_graph, region, [old_graph.index[a] for a in sources], self.targets[kept], rows)
+        rows[stale] = np.nan
+        registry.incr('distance_cache.stale_entries', int(stale.sum()))
+        # Copies, so evicting a row frees it.
+        cache._rows.update((a, row.copy()) for a, row in zip(sources, rows))
+        return cache
+
+    def __contains__(self, node):
+        return node in self.index
+
+    def has_paths_from(self, a):
+        """Whether path() / path_with_length() from a need no search."""
+        return a in self._predecessors
+
+    def path_with_length(self, a, b):
+        """Shortest path from a to b (any graph nodes) and its length, like CSRGraph.path_with_length."""
+        entry = self._predecessors.get(a)
+        if entry is None:
+            self.misses += 1
+            self._search(a)
+            entry = self._predecessors[a]
+        else:
+            self.hits += 1
+            self._predecessors.move_to_end(a)
+        dist, predecessors = entry
+
+        j = self.graph.index[b]
+        if np.isinf(dist[j]):
+            raise NetworkXNoPath(f"No path between {a} and {b}.")
+        path = []
+        while j >= 0:
+            path.append(j)
+            j = predecessors[j]
+        path.reverse()
+        return self.graph.node_path(path), float(dist[self.graph.index[b]])
+
+    def path(self, a, b):
+        return self.path_with_length(a, b)[0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "rows": len(self._rows),
+            "max_rows": self.max_rows,
+            "paths": len(self._predecessors),
+        }
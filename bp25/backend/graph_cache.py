@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import networkx as nx
+import numpy as np
+import shapely
+
+from attachments import BuildingAttachments
+from contraction import ContractionHierarchy
+from create_graph import create_graph
+from metrics import registry
+
+# Bump whenever create_graph changes what it produces, so stale entries are never served.
+PIPELINE_VERSION = 6
+
+# Bounding boxes are rounded to this many decimals (~11 m) before keying and building.
+BBOX_DECIMALS = 4
+
+CACHE_DIR = os.environ.get(
+    'BP25_GRAPH_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'graph_cache'))
+CACHE_MAX_BYTES = int(os.environ.get('BP25_GRAPH_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+
+def round_bbox(bbox):
+    return tuple(round(float(c), BBOX_DECIMALS) for c in bbox)
+
+
+def cache_key(bbox):
+    """Content address of the graph for a bbox: hash of the rounded bbox and the pipeline version."""
+    payload = json.dumps({'bbox': round_bbox(bbox), 'version': PIPELINE_VERSION})
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def save_graph(G, path):
+    """
+    Write G as a directory of flat .npy arrays plus a small meta.json.
+    Only what the routing pipeline reads is kept: node x/y/node_type (node ids
+    are OSM and building integers), edge key/length/geometry, the building
+    attachments and the fire stations.
+    """
+    os.makedirs(path, exist_ok=True)
+    nodes = list(G.nodes())
+    index = {node: i for i, node in enumerate(nodes)}
+
+    node_types = [None]
+    type_codes = []
+    for node in nodes:
+        node_type = G.nodes[node].get('node_type')
+        if node_type not in node_types:
+            node_types.append(node_type)
+        type_codes.append(node_types.index(node_type))
+
+    edges = list(G.edges(keys=True, data=True))
+    geoms = [data.get('geometry') for _, _, _, data in edges]
+    has_geom = np.array([g is not None for g in geoms], dtype=bool)
+    coords, owners = shapely.get_coordinates(
+        np.array([g for g in geoms if g is not None], dtype=object), return_index=True)
+    counts = np.zeros(len(edges), dtype=np.int64)
+    counts[has_geom] = np.bincount(owners, minlength=int(has_geom.sum()))
+    offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    arrays = {
+        'node_id': np.array(nodes, dtype=np.int64),
+        'node_x': np.array([G.nodes[n].get('x', np.nan) for n in nodes], dtype=np.float64),
+        'node_y': np.array([G.nodes[n].get('y', np.nan) for n in nodes], dtype=np.float64),
+        'node_type': np.array(type_codes, dtype=np.int8),
+        'edge_u': np.array([index[u] for u, _, _, _ in edges], dtype=np.int64),
+        'edge_v': np.array([index[v] for _, v, _, _ in edges], dtype=np.int64),
+        'edge_key': np.array([k for _, _, k, _ in edges], dtype=np.int64),
+        'edge_length': np.array([d.get('length', np.nan) for _, _, _, d in edges], dtype=np.float64),
+        'geom_offsets': offsets,
+        'geom_coords': np.ascontiguousarray(coords, dtype=np.float64),
+    }
+    attachments = G.graph.get('building_attachments')
+    if attachments is not None:
+        arrays.update({f'attach_{name}': arr for name, arr in attachments.arrays().items()})
+    for name, arr in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), arr)
+
+    meta = {
+        'version': PIPELINE_VERSION,
+        'crs': str(G.graph.get('crs')) if G.graph.get('crs') is not None else None,
+        'node_types': node_types,
+        'graph_attrs': {k: v for k, v in G.graph.items()
+                        if k != 'crs' and isinstance(v, (str, int, float, bool))},
+        'fire_stations': G.graph.get('fire_stations'),
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_arrays(path):
+    """Memory-map every array of a cache entry; nothing is read until it is used."""
+    return {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r')
+            for name in os.listdir(path) if name.endswith('.npy')}
+
+
+def load_graph(path):
+    """Rebuild the MultiDiGraph written by save_graph."""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    arrays = load_arrays(path)
+
+    nodes = arrays['node_id'].tolist()
+    node_types = meta['node_types']
+
+    G = nx.MultiDiGraph(**meta['graph_attrs'])
+    if meta['crs'] is not None:
+        G.graph['crs'] = meta['crs']
+    if meta.get('fire_stations') is not None:
+        G.graph['fire_stations'] = meta['fire_stations']
+
+    def node_attrs(x, y, code):
+        attrs = {'x': x, 'y': y}
+        if node_types[code] is not None:
+            attrs['node_type'] = node_types[code]
+        return attrs
+
+    G.add_nodes_from(
+        (node, node_attrs(x, y, code))
+        for node, x, y, code in zip(nodes, arrays['node_x'].tolist(), arrays['node_y'].tolist(),
+                                    arrays['node_type'].tolist()))
+
+    offsets = arrays['geom_offsets']
+    counts = np.diff(offsets)
+    has_geom = counts > 0
+    geoms = np.empty(len(counts), dtype=object)
+    if has_geom.any():
+        owners = np.repeat(np.arange(int(has_geom.sum())), counts[has_geom])
+        geoms[has_geom] = shapely.linestrings(np.asarray(arrays['geom_coords']), indices=owners)
+
+    def edge_attrs(length, geom):
+        attrs = {}
+        if not np.isnan(length):
+            attrs['length'] = length
+        if geom is not None:
+            attrs['geometry'] = geom
+        return attrs
+
+    G.add_edges_from(
+        (nodes[u], nodes[v], key, edge_attrs(length, geom))
+        for u, v, key, length, geom in zip(
+            arrays['edge_u'].tolist(), arrays['edge_v'].tolist(), arrays['edge_key'].tolist(),
+            arrays['edge_length'].tolist(), geoms))
+
+    if 'attach_building' in arrays:
+        G.graph['building_attachments'] = BuildingAttachments.from_arrays(
+            {name[len('attach_'):]: arr for name, arr in arrays.items() if name.startswith('attach_')})
+    return G
+
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """Delete least recently used entries until the cache fits in max_bytes."""
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        meta = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta):
+            entries.append((os.path.getmtime(meta), _entry_size(path), path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def cached_create_graph(bbox, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """
+    create_graph with a persistent on-disk cache in front of it.
+    A hit skips the OSM download and building snapping entirely.
+    """
+    bbox = round_bbox(bbox)
+    path = os.path.join(cache_dir, cache_key(bbox))
+    meta = os.path.join(path, 'meta.json')
+
+    if os.path.isfile(meta):
+        try:
+            with registry.timer('phase.graph_cache_load'):
+                G = load_graph(path)
+            # mtime of meta.json is the LRU clock used by evict().
+            os.utime(meta)
+            registry.incr('graph_cache.hits')
+            return G
+        except Exception as e:
+            print(f"Discarding unreadable graph cache entry {path}: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+
+    registry.incr('graph_cache.misses')
+    G = create_graph(bbox)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+        save_graph(G, tmp)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            # Another request stored the same key first.
+            shutil.rmtree(tmp, ignore_errors=True)
+        evict(cache_dir, max_bytes)
+    except Exception as e:
+        print(f"Error writing graph cache entry {path}: {e}")
+
+    return G
+
+
+def cached_hierarchy(bbox, graph, cache_dir=CACHE_DIR):
+    """
+    ContractionHierarchy for CSRGraph `graph` of bbox, kept in bbox's graph cache entry:
+    loaded from there, built and stored on first use otherwise. Returns None if `graph`
+    is not the entry's graph: if its nodes differ, e.g. after hazard masking removed
+    some, or if it does not match the stored hierarchy (see ContractionHierarchy.matches).
+    """
+    path = os.path.join(cache_dir, cache_key(round_bbox(bbox)))
+    if not os.path.isfile(os.path.join(path, 'meta.json')):
+        return None
+
+    hierarchy = ContractionHierarchy.load(path)
+    if hierarchy is not None:
+        if not hierarchy.matches(graph):
+            # It was built from this entry's graph, so `graph` is another one.
+            return None
+        registry.incr('hierarchy_cache.hits')
+        return hierarchy
+    if not np.array_equal(np.load(os.path.join(path, 'node_id.npy'), mmap_mode='r'), graph.nodes):
+        return None
+
+    registry.incr('hierarchy_cache.misses')
+    with registry.timer('phase.hierarchy_build'):
+        hierarchy = ContractionHierarchy.build(graph)
+    try:
+        hierarchy.save(path)
+    except OSError as e:
+        print(f"Error writing contraction hierarchy to {path}: {e}")
+    return hierarchy
@@ -0,0 +1,66 @@
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+from shapely.geometry import shape
+
+# Nodes closer than this to a fire (in degrees, same units as node x/y) are removed.
+DANGER_RADIUS = 0.0005
+
+
+def fire_coordinates(fires):
+    """
+    Parse the API's fire list ({'latitude': ..., 'longitude': ...}, values may be
+    strings) into an (n, 2) array of (lng, lat), skipping fires without a position.
+    """
+    coords = []
+    for fire in fires:
+        fire_lat = fire.get('latitude')
+        fire_lng = fire.get('longitude')
+        if fire_lat is None or fire_lng is None:
+            continue
+        coords.append((float(fire_lng), float(fire_lat)))
+    return np.array(coords, dtype=np.float64).reshape(-1, 2)
+
+
+def hazard_nodes(graph, fires=(), radius=DANGER_RADIUS, polygons=()):
+    """
+    Return the ids of all nodes within `radius` of any fire or inside any hazard polygon.
+
+    Node coordinates are indexed once in a KD-tree and every fire is looked up in a
+    single query_ball_point call. Polygons are GeoJSON geometries (Polygon or
+    MultiPolygon, [lng, lat] order) and are tested with one vectorized contains call.
+    """
+    node_ids = []
+    xs = []
+    ys = []
+    for node_id, node_data in graph.nodes(data=True):
+        if 'x' not in node_data or 'y' not in node_data:
+            continue
+        node_ids.append(node_id)
+        xs.append(node_data['x'])
+        ys.append(node_data['y'])
+    if not node_ids:
+        return []
+    xs = np.array(xs, dtype=np.float64)
+    ys = np.array(ys, dtype=np.float64)
+
+    hit = np.zeros(len(node_ids), dtype=bool)
+
+    fire_coords = fire_coordinates(fires)
+    if len(fire_coords) > 0:
+        tree = cKDTree(np.column_stack([xs, ys]))
+        for indices in tree.query_ball_point(fire_coords, r=radius):
+            hit[indices] = True
+
+    if polygons:
+        area = shapely.union_all([shape(polygon) for polygon in polygons])
+        hit |= shapely.contains_xy(area, xs, ys)
+
+    return [node_id for node_id, is_hit in zip(node_ids, hit) if is_hit]
+
+
+def remove_hazard_nodes(graph, fires=(), radius=DANGER_RADIUS, polygons=()):
+    """Remove every hazardous node (see hazard_nodes) from graph in one bulk operation."""
+    nodes_to_remove = hazard_nodes(graph, fires, radius, polygons)
+    graph.remove_nodes_from(nodes_to_remove)
+    return nodes_to_remove
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from allocation import allocation_response, choose_starting_points, prepare_graph, solve_allocation
+from graph_cache import round_bbox
+
+# Allocation requests solved at the same time; further jobs wait in the queue.
+JOB_WORKERS = 2
+# Finished jobs (and their results) are kept this many seconds for polling.
+JOB_TTL = 3600
+# Upper bound on remembered jobs; the oldest finished ones are dropped beyond it.
+MAX_JOBS = 256
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once it has been cancelled."""
+
+
+def request_key(data):
+    """
+    Identity of an allocation request for deduplication: every field of the body,
+    with the bbox rounded the same way the graph cache rounds it.
+    """
+    payload = dict(data, bbox=round_bbox(data['bbox']))
+    payload.pop('location_name', None)
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class Job:
+    """One submitted allocation request and what is known about it so far."""
+
+    def __init__(self, data, key):
+        self.id = uuid.uuid4().hex
+        self.data = data
+        self.key = key
+        self.status = QUEUED
+        self.phase = None
+        # Seconds spent in every finished pipeline phase, in order.
+        self.timings = {}
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        # Submissions sharing this job (see JobManager.submit) that have not cancelled it.
+        self.submitters = 1
+        self.future = None
+        self.created = time.time()
+        self.finished = None
+
+    def check_cancelled(self, info=None):
+        """Also usable as solver callback, so a running solve stops at its next event."""
+        if self.cancelled:
+            raise JobCancelled()
+
+    def run_phase(self, name, fn, *args, **kwargs):
+        self.check_cancelled()
+        self.phase = name
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    def summary(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'phase': self.phase,
+            # Set as soon as cancellation is requested; status follows once the job stops.
+            'cancel_requested': self.cancelled,
+            'submitters': self.submitters,
+            'timings': dict(self.timings),
+            'created': self.created,
+            'finished': self.finished,
+            'error': self.error,
+        }
+
+
+class JobManager:
+    """
+    Runs allocation jobs in a bounded thread pool. Submitting a request identical to
+    one that is still queued or running returns the existing job instead of a new one;
+    such a shared job is only cancelled once every submitter has cancelled it.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, ttl=JOB_TTL, max_jobs=MAX_JOBS):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='allocation-job')
+        self._jobs = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.finished is not None]
+        for job in finished:
+            if now - job.finished > self.ttl:
+                del self._jobs[job.id]
+        finished = sorted((job for job in finished if job.id in self._jobs), key=lambda job: job.finished)
+        while len(self._jobs) > self.max_jobs and finished:
+            del self._jobs[finished.pop(0).id]
+
+    def _run(self, job):
+        data = job.data
+        try:
+            job.status = RUNNING
+            graph = job.run_phase('graph', prepare_graph, data)
+            starting_pts = choose_starting_points(graph, data.get('num_routes'))
+            allocation = job.run_phase('solve', solve_allocation, graph, data, starting_pts,
+                                       callback=job.check_cancelled)
+            job.result = job.run_phase('serialize', allocation_response, data, allocation)
+            job.status = DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.phase = None
+            job.finished = time.time()
+            with self._lock:
+                if self._in_flight.get(job.key) is job:
+                    del self._in_flight[job.key]
+
+    def submit(self, data):
+        """Queue data for solving; returns (job, deduplicated)."""
+        key = request_key(data)
+        with self._lock:
+            job = self._in_flight.get(key)
+            if job is not None:
+                job.submitters += 1
+                return job, True
+            job = Job(data, key)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job
+            self._expire()
+        job.future = self._pool.submit(self._run, job)
+        return job, False
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Withdraw one submitter from a queued or running job and cancel it once none are
+        left; returns the job, or None if unknown.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.finished is None and job.submitters > 0:
+                job.submitters -= 1
+                if job.submitters == 0:
+                    job.cancelled = True
+                    if self._in_flight.get(job.key) is job:
+                        del self._in_flight[job.key]
+        if job.cancelled and job.future is not None and job.future.cancel():
+            # Never started, so _run will not record the end.
+            job.status = CANCELLED
+            job.finished = time.time()
+        return job
@@ -0,0 +1,83 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Thread-safe, in-process counters, gauges and phase timers for the backend.
+
+    Counters only go up (Dijkstra heap pops, anneal moves evaluated/accepted by
+    type, ...), gauges keep the last value set (graph sizes, improvement ratio)
+    and timers aggregate the durations of a named phase (count, total, max, last).
+    Everything is process-local: work done in annealing worker processes is not
+    counted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0}
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            timer['last'] = seconds
+
+    @contextmanager
+    def timer(self, name):
+        """Time the body of a with block as one observation of phase `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+        Everything as a JSON-ready dict. Counter pairs '<x>.evaluated' / '<x>.accepted'
+        also appear as an acceptance rate under 'rates'.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            timers = {name: dict(timer, mean=timer['total'] / timer['count'])
+                      for name, timer in self.timers.items()}
+        rates = {}
+        for name, evaluated in counters.items():
+            if name.endswith('.evaluated') and evaluated:
+                prefix = name[:-len('.evaluated')]
+                rates[prefix] = counters.get(prefix + '.accepted', 0) / evaluated
+        return {
+            'uptime': time.time() - self.started,
+            'counters': counters,
+            'gauges': gauges,
+            'timers': timers,
+            'rates': rates,
+        }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timers.clear()
+            self.started = time.time()
+
+
+# The backend's shared registry, exposed by /api/metrics.
+registry = Metrics()
@@ -0,0 +1,415 @@
+"""
+Offline OSM store: import a local .osm (XML) or .osm.pbf extract once, then serve
+street networks, building centroids and fire stations for any bbox inside it without
+network access.
+
+    python osm_import.py california-latest.osm.pbf --output osm_store
+
+The store is a directory of flat arrays (street segments and building centroids,
+each sorted by INDEX_CELL_SIZE grid cell with per-cell offsets) plus a meta.json that
+also lists the fire stations.
+With BP25_OSM_STORE pointing at it, create_graph.fetch_streets / fetch_features
+(and so create_graph and the tile store) read from it instead of querying
+Overpass whenever it covers the requested bbox.
+
+XML is streamed with iterparse; .pbf needs the optional pyosmium package.
+Building multipolygon relations are not imported, only building ways and nodes.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+from array import array
+
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+import osmnx as ox
+import pandas as pd
+import shapely
+from osmnx._errors import InsufficientResponseError
+
+from metrics import registry
+
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+# Side (degrees) of the grid cells the store is indexed by.
+INDEX_CELL_SIZE = 0.01
+
+STORE_VERSION = 2
+
+OSM_STORE_DIR = os.environ.get('BP25_OSM_STORE')
+
+# highway values osmnx's network_type='all' leaves out.
+EXCLUDED_HIGHWAYS = {'abandoned', 'construction', 'no', 'planned', 'platform', 'proposed', 'raceway', 'razed'}
+ONEWAY_FORWARD = {'yes', 'true', '1'}
+ONEWAY_REVERSE = {'-1', 'reverse'}
+
+# OSM element types, for building node ids that are unique across element types.
+ELEMENT_CODES = {'node': 1, 'way': 2, 'relation': 3}
+EARTH_RADIUS = 6_371_009
+# Sphere of web mercator (EPSG:3857).
+MERCATOR_RADIUS = 6_378_137
+
+
+def building_node_id(element, osmid):
+    """Stable negative node id of an OSM building element (create_graph numbers buildings -1, -2, ...)."""
+    return -(int(osmid) * 4 + ELEMENT_CODES[element])
+
+
+def is_street(tags):
+    return ('highway' in tags and tags['highway'] not in EXCLUDED_HIGHWAYS and tags.get('area') != 'yes'
+            and tags.get('access') != 'private' and tags.get('service') != 'private')
+
+
+def is_building(tags):
+    return tags.get('building', 'no') != 'no'
+
+
+def is_fire_station(tags):
+    return tags.get('amenity') == 'fire_station'
+
+
+def fire_station_record(element, osmid, x, y, tags):
+    """A fire station as create_graph.fetch_features describes it."""
+    return {'id': str((element, osmid)), 'lat': float(y), 'lng': float(x), 'name': tags.get('name', 'Fire Station')}
+
+
+class _Collector:
+    """Accumulates what the store needs while an extract is streamed, in compact arrays."""
+
+    def __init__(self):
+        self.node_id, self.node_x, self.node_y = array('q'), array('d'), array('d')
+        self.seg_u, self.seg_v, self.seg_way = array('q'), array('q'), array('q')
+        # Building ways as node refs (resolved to coordinates at the end); building nodes as points.
+        self.building_way, self.building_refs = [], []
+        self.point_id, self.point_x, self.point_y = array('q'), array('d'), array('d')
+        # Fire stations are few: node stations as finished records, way stations as (osmid, refs, tags).
+        self.fire_stations, self.station_ways = [], []
+
+    def node(self, osmid, x, y, tags):
+        self.node_id.append(osmid)
+        self.node_x.append(x)
+        self.node_y.append(y)
+        if is_building(tags):
+            self.point_id.append(building_node_id('node', osmid))
+            self.point_x.append(x)
+            self.point_y.append(y)
+        if is_fire_station(tags):
+            self.fire_stations.append(fire_station_record('node', osmid, x, y, tags))
+
+    def way(self, osmid, refs, tags):
+        if is_street(tags):
+            oneway = tags.get('oneway')
+            for a, b in zip(refs, refs[1:]):
+                if oneway in ONEWAY_REVERSE:
+                    a, b = b, a
+                self.seg_u.append(a)
+                self.seg_v.append(b)
+                self.seg_way.append(osmid)
+                if oneway not in ONEWAY_FORWARD and oneway not in ONEWAY_REVERSE:
+                    self.seg_u.append(b)
+                    self.seg_v.append(a)
+                    self.seg_way.append(osmid)
+        if is_building(tags) and len(refs) >= 4 and refs[0] == refs[-1]:
+            self.building_way.append(osmid)
+            self.building_refs.append(refs)
+        if is_fire_station(tags) and len(refs) >= 4 and refs[0] == refs[-1]:
+            self.station_ways.append((osmid, refs, tags))
+
+
+def _read_xml(path, collector):
+    """Stream an .osm XML file, clearing every element once it has been handled."""
+    context = ET.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    tags, refs = {}, []
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ('node', 'way', 'relation'):
+                tags, refs = {}, []
+            continue
+        if elem.tag == 'tag':
+            tags[elem.get('k')] = elem.get('v')
+        elif elem.tag == 'nd':
+            refs.append(int(elem.get('ref')))
+        elif elem.tag == 'node':
+            collector.node(int(elem.get('id')), float(elem.get('lon')), float(elem.get('lat')), tags)
+            root.clear()
+        elif elem.tag == 'way':
+            collector.way(int(elem.get('id')), refs, tags)
+            root.clear()
+        elif elem.tag == 'relation':
+            root.clear()
+
+
+def _read_pbf(path, collector):
+    if osmium is None:
+        raise RuntimeError("Reading .osm.pbf extracts needs the 'osmium' package (pip install osmium)")
+
+    class Handler(osmium.SimpleHandler):
+        def node(self, n):
+            collector.node(n.id, n.location.lon, n.location.lat, {t.k: t.v for t in n.tags})
+
+        def way(self, w):
+            collector.way(w.id, [nd.ref for nd in w.nodes], {t.k: t.v for t in w.tags})
+
+    Handler().apply_file(path)
+
+
+def _mercator(coords):
+    """(n, 2) lng/lat array to web mercator meters."""
+    x, y = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    return np.column_stack([x * MERCATOR_RADIUS, np.log(np.tan(np.pi / 4 + y / 2)) * MERCATOR_RADIUS])
+
+
+def _from_mercator(coords):
+    x, y = coords[:, 0] / MERCATOR_RADIUS, coords[:, 1] / MERCATOR_RADIUS
+    return np.column_stack([np.degrees(x), np.degrees(2 * np.arctan(np.exp(y)) - np.pi / 2)])
+
+
+def mercator_centroids(geometries):
+    """
+    Centroids of an array of lng/lat geometries taken in web mercator, as lng and
+    lat arrays: one vectorized pass over the coordinates, instead of reprojecting
+    whole GeoDataFrames to EPSG:3857 and the centroids back.
+    """
+    projected = shapely.transform(np.asarray(geometries, dtype=object), _mercator)
+    centroids = _from_mercator(shapely.get_coordinates(shapely.centroid(projected)))
+    return centroids[:, 0], centroids[:, 1]
+
+
+def _haversine(x1, y1, x2, y2):
+    """Great-circle distance in meters, like osmnx's edge lengths."""
+    x1, y1, x2, y2 = (np.radians(a) for a in (x1, y1, x2, y2))
+    a = np.sin((y2 - y1) / 2) ** 2 + np.cos(y1) * np.cos(y2) * np.sin((x2 - x1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def _ring_centroids(rings, locate, node_x, node_y):
+    """
+    Centroids of closed ways given as node ref lists (see mercator_centroids), with
+    the positions of the rings whose nodes were all found.
+    """
+    kept, coords, owner = [], [], []
+    for i, refs in enumerate(rings):
+        pos, found = locate(np.asarray(refs, dtype=np.int64))
+        if not np.all(found):
+            continue
+        owner.append(np.full(len(refs), len(kept)))
+        kept.append(i)
+        coords.append(np.column_stack([node_x[pos], node_y[pos]]))
+    if not kept:
+        return kept, np.empty(0), np.empty(0)
+    polygons = shapely.polygons(shapely.linearrings(np.concatenate(coords), indices=np.concatenate(owner)))
+    return (kept, *mercator_centroids(polygons))
+
+
+def _cells(x, y):
+    return (np.floor(x / INDEX_CELL_SIZE).astype(np.int64) * 1_000_003
+            + np.floor(y / INDEX_CELL_SIZE).astype(np.int64))
+
+
+def _index(cells):
+    """Order that sorts rows by cell, the distinct cells and the offsets of their rows."""
+    order = np.argsort(cells, kind='stable')
+    keys, starts = np.unique(cells[order], return_index=True)
+    return order, keys, np.r_[starts, len(cells)]
+
+
+def import_extract(path, output):
+    """Stream the extract at `path` and write the store to directory `output`."""
+    collector = _Collector()
+    if path.endswith('.pbf'):
+        _read_pbf(path, collector)
+    else:
+        _read_xml(path, collector)
+
+    node_id = np.frombuffer(collector.node_id, dtype=np.int64)
+    node_x = np.frombuffer(collector.node_x, dtype=np.float64)
+    node_y = np.frombuffer(collector.node_y, dtype=np.float64)
+    order = np.argsort(node_id)
+    node_id, node_x, node_y = node_id[order], node_x[order], node_y[order]
+
+    def locate(ids):
+        pos = np.clip(np.searchsorted(node_id, ids), 0, max(len(node_id) - 1, 0))
+        return pos, len(node_id) > 0 and node_id[pos] == ids
+
+    # Street segments, with both ends resolved to coordinates.
+    seg_u = np.frombuffer(collector.seg_u, dtype=np.int64)
+    seg_v = np.frombuffer(collector.seg_v, dtype=np.int64)
+    seg_way = np.frombuffer(collector.seg_way, dtype=np.int64)
+    pu, ok_u = locate(seg_u)
+    pv, ok_v = locate(seg_v)
+    ok = ok_u & ok_v
+    seg_u, seg_v, seg_way, pu, pv = seg_u[ok], seg_v[ok], seg_way[ok], pu[ok], pv[ok]
+    seg_length = _haversine(node_x[pu], node_y[pu], node_x[pv], node_y[pv])
+    used = np.unique(np.concatenate([pu, pv]))
+
+    kept, cx, cy = _ring_centroids(collector.building_refs, locate, node_x, node_y)
+    ring_ids = [building_node_id('way', collector.building_way[i]) for i in kept]
+    building_id = np.concatenate([np.asarray(ring_ids, dtype=np.int64),
+                                  np.frombuffer(collector.point_id, dtype=np.int64)])
+    building_x = np.concatenate([cx, np.frombuffer(collector.point_x, dtype=np.float64)])
+    building_y = np.concatenate([cy, np.frombuffer(collector.point_y, dtype=np.float64)])
+
+    # A segment is indexed under the cells of both of its ends.
+    seg_rows = np.r_[np.arange(len(seg_u)), np.arange(len(seg_u))]
+    seg_cells = np.r_[_cells(node_x[pu], node_y[pu]), _cells(node_x[pv], node_y[pv])]
+    seg_order, seg_keys, seg_offsets = _index(seg_cells)
+    building_order, building_keys, building_offsets = _index(_cells(building_x, building_y))
+
+    arrays = {
+        'node_id': node_id[used], 'node_x': node_x[used], 'node_y': node_y[used],
+        'seg_u': seg_u, 'seg_v': seg_v, 'seg_way': seg_way, 'seg_length': seg_length,
+        'seg_index': seg_rows[seg_order], 'seg_keys': seg_keys, 'seg_offsets': seg_offsets,
+        'building_id': building_id[building_order], 'building_x': building_x[building_order],
+        'building_y': building_y[building_order],
+        'building_keys': building_keys, 'building_offsets': building_offsets,
+    }
+    kept, sx, sy = _ring_centroids([refs for _, refs, _ in collector.station_ways], locate, node_x, node_y)
+    fire_stations = collector.fire_stations + [
+        fire_station_record('way', collector.station_ways[i][0], x, y, collector.station_ways[i][2])
+        for i, x, y in zip(kept, sx.tolist(), sy.tolist())]
+
+    xs = np.r_[node_x[used], building_x]
+    ys = np.r_[node_y[used], building_y]
+    meta = {
+        'version': STORE_VERSION,
+        'source': os.path.basename(path),
+        # (north, south, east, west), like the request bboxes.
+        'bounds': [float(ys.max()), float(ys.min()), float(xs.max()), float(xs.min())] if len(xs) else None,
+        'fire_stations': fire_stations,
+    }
+
+    parent = os.path.dirname(os.path.abspath(output))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp, f'{name}.npy'), arr)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp, output)
+    return meta
+
+
+class OSMStore:
+    """Read side of an imported store; arrays are memory-mapped."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.arrays = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r')
+                       for name in os.listdir(path) if name.endswith('.npy')}
+
+    def covers(self, bbox):
+        bounds = self.meta['bounds']
+        if bounds is None:
+            return False
+        north, south, east, west = (float(c) for c in bbox)
+        return north <= bounds[0] and south >= bounds[1] and east <= bounds[2] and west >= bounds[3]
+
+    def _rows(self, prefix, bbox):
+        """Row indices stored under the cells bbox overlaps (may repeat)."""
+        north, south, east, west = (float(c) for c in bbox)
+        i = np.arange(math.floor(west / INDEX_CELL_SIZE), math.floor(east / INDEX_CELL_SIZE) + 1)
+        j = np.arange(math.floor(south / INDEX_CELL_SIZE), math.floor(north / INDEX_CELL_SIZE) + 1)
+        cells = (i[:, None] * 1_000_003 + j[None, :]).ravel()
+        keys, offsets = self.arrays[f'{prefix}_keys'], self.arrays[f'{prefix}_offsets']
+        pos = np.searchsorted(keys, cells)
+        found = (pos < len(keys)) & (keys[np.minimum(pos, len(keys) - 1)] == cells)
+        spans = [np.arange(offsets[p], offsets[p + 1]) for p in pos[found].tolist()]
+        return np.concatenate(spans) if spans else np.empty(0, dtype=np.int64)
+
+    def streets(self, bbox, simplify=True, retain_all=False, truncate_by_edge=False):
+        """
+        The street network within (north, south, east, west) as an osmnx-style
+        MultiDiGraph, with the same options as ox.graph_from_bbox.
+        """
+        north, south, east, west = (float(c) for c in bbox)
+        a = self.arrays
+        rows = np.unique(a['seg_index'][self._rows('seg', bbox)])
+        seg_u, seg_v = a['seg_u'][rows], a['seg_v'][rows]
+        node_id = a['node_id']
+        pu, pv = np.searchsorted(node_id, seg_u), np.searchsorted(node_id, seg_v)
+        x, y = a['node_x'], a['node_y']
+
+        def within(p):
+            return (x[p] >= west) & (x[p] <= east) & (y[p] >= south) & (y[p] <= north)
+
+        inside_u, inside_v = within(pu), within(pv)
+        keep = (inside_u | inside_v) if truncate_by_edge else (inside_u & inside_v)
+        rows, pu, pv = rows[keep], pu[keep], pv[keep]
+
+        G = nx.MultiDiGraph(crs='epsg:4326')
+        nodes = np.unique(np.r_[pu, pv])
+        G.add_nodes_from((int(n), {'x': float(nx_), 'y': float(ny_)})
+                         for n, nx_, ny_ in zip(node_id[nodes].tolist(), x[nodes].tolist(), y[nodes].tolist()))
+        G.add_edges_from((u, v, {'osmid': way, 'length': length})
+                         for u, v, way, length in zip(node_id[pu].tolist(), node_id[pv].tolist(),
+                                                      a['seg_way'][rows].tolist(), a['seg_length'][rows].tolist()))
+        if not retain_all and len(G):
+            G = G.subgraph(max(nx.weakly_connected_components(G), key=len)).copy()
+        if not G.number_of_edges():
+            raise InsufficientResponseError('No street segments in the OSM store within the bbox')
+        if simplify:
+            G = ox.simplify_graph(G)
+        registry.incr('osm_store.street_queries')
+        return G
+
+    def buildings(self, bbox):
+        """
+        Building centroids within (north, south, east, west), shaped like
+        create_graph.fetch_features' buildings GeoDataFrame: indexed by (element, id),
+        with point geometries and a 'centroid' column.
+        """
+        north, south, east, west = (float(c) for c in bbox)
+        a = self.arrays
+        rows = self._rows('building', bbox)
+        x, y = a['building_x'][rows], a['building_y'][rows]
+        inside = (x >= west) & (x <= east) & (y >= south) & (y <= north)
+        ids = a['building_id'][rows][inside]
+        if not len(ids):
+            raise InsufficientResponseError('No buildings in the OSM store within the bbox')
+        codes = (-ids) % 4
+        elements = {code: element for element, code in ELEMENT_CODES.items()}
+        index = pd.MultiIndex.from_arrays([[elements[c] for c in codes.tolist()], ((-ids) // 4).tolist()],
+                                          names=['element', 'id'])
+        points = gpd.GeoSeries(shapely.points(x[inside], y[inside]), index=index, crs='epsg:4326')
+        registry.incr('osm_store.building_queries')
+        return gpd.GeoDataFrame({'centroid': points}, geometry=points, crs='epsg:4326')
+
+    def fire_stations(self, bbox):
+        """Fire stations within (north, south, east, west), as create_graph.fetch_features returns them."""
+        north, south, east, west = (float(c) for c in bbox)
+        return [dict(station) for station in self.meta.get('fire_stations', [])
+                if west <= station['lng'] <= east and south <= station['lat'] <= north]
+
+
+_store = None
+
+def open_store(path=OSM_STORE_DIR):
+    """The store at `path` (BP25_OSM_STORE by default), opened once; None if there is none."""
+    global _store
+    if _store is None and path and os.path.isfile(os.path.join(path, 'meta.json')):
+        _store = OSMStore(path)
+    return _store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('extract', help='.osm or .osm.pbf file')
+    parser.add_argument('--output', required=True, help='store directory to write')
+    args = parser.parse_args(argv)
+    meta = import_extract(args.extract, args.output)
+    print(json.dumps(meta))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import heapq
+
+
+class RouteStore:
+    """
+    The routes of a solution and their lengths, as the annealer mutates them.
+
+    Every route is one flat list of stops that is only ever changed in place:
+    positional lookups are O(1), a reversal is a slice assignment and moving a
+    stop is a pop plus an insert, each a single memmove. Nothing is allocated per
+    evaluated move, unlike rebuilding routes by slicing and concatenating.
+
+    Route lengths are kept next to the routes, with a lazily invalidated max-heap
+    so that the longest route is found in O(log k) amortized instead of a scan.
+    """
+
+    def __init__(self, routes, route_lengths):
+        self.routes = {key: list(stops) for key, stops in routes.items()}
+        self._keys = list(self.routes)
+        # Route every stop is on, for moves that start from a stop rather than a position.
+        self.route_of = {stop: key for key, stops in self.routes.items() for stop in stops}
+
+        self.lengths = {}
+        self._versions = {}
+        self._heap = []
+        for key in self._keys:
+            self.set_length(key, route_lengths[key])
+
+    # --- routes ---
+
+    def keys(self):
+        """Route keys; the list is shared, do not modify it."""
+        return self._keys
+
+    def route_len(self, key):
+        return len(self.routes[key])
+
+    def stop(self, key, i):
+        """The i-th stop of a route."""
+        return self.routes[key][i]
+
+    def reverse(self, key, l, r):
+        """Reverse stops l..r (inclusive) of a route."""
+        route = self.routes[key]
+        route[l:r + 1] = route[l:r + 1][::-1]
+
+    def index(self, key, stop):
+        """Position of a stop in its route."""
+        return self.routes[key].index(stop)
+
+    def pop(self, key, i):
+        """Remove the i-th stop of a route and return it."""
+        return self.routes[key].pop(i)
+
+    def insert(self, key, i, stop):
+        """Insert a stop so that it becomes the i-th stop of a route."""
+        self.routes[key].insert(i, stop)
+        self.route_of[stop] = key
+
+    def move_segment(self, key, i, j, dest_key, after):
+        """Move stops i..j (inclusive) of a route to just after the stop `after` in dest_key's route."""
+        route = self.routes[key]
+        segment = route[i:j + 1]
+        del route[i:j + 1]
+        dest = self.routes[dest_key]
+        p = dest.index(after) + 1
+        dest[p:p] = segment
+        for stop in segment:
+            self.route_of[stop] = dest_key
+
+    def swap_tails(self, a_key, i, b_key, j):
+        """Exchange the stops of route a_key from position i on with those of route b_key from j on."""
+        a, b = self.routes[a_key], self.routes[b_key]
+        a_tail, b_tail = a[i:], b[j:]
+        a[i:] = b_tail
+        b[j:] = a_tail
+        for stop in b_tail:
+            self.route_of[stop] = a_key
+        for stop in a_tail:
+            self.route_of[stop] = b_key
+
+    def swap_segments(self, a_key, i1, i2, b_key, j1, j2):
+        """Exchange stops i1..i2 of route a_key with stops j1..j2 of route b_key (inclusive)."""
+        a, b = self.routes[a_key], self.routes[b_key]
+        a_segment, b_segment = a[i1:i2 + 1], b[j1:j2 + 1]
+        a[i1:i2 + 1] = b_segment
+        b[j1:j2 + 1] = a_segment
+        for stop in b_segment:
+            self.route_of[stop] = a_key
+        for stop in a_segment:
+            self.route_of[stop] = b_key
+
+    def snapshot(self):
+        """Copy of the current routes, as a dict of key -> stop list."""
+        return {key: list(stops) for key, stops in self.routes.items()}
+
+    # --- lengths ---
+
+    def set_length(self, key, length):
+        self.lengths[key] = length
+        version = self._versions.get(key, 0) + 1
+        self._versions[key] = version
+        heapq.heappush(self._heap, (-length, version, key))
+        # Stale entries only leave the heap when they reach the top; rebuild before it bloats.
+        if len(self._heap) > 8 * len(self.lengths) + 64:
+            self._heap = [(-self.lengths[k], self._versions[k], k) for k in self.lengths]
+            heapq.heapify(self._heap)
+
+    def add_length(self, key, delta):
+        self.set_length(key, self.lengths[key] + delta)
+
+    def longest(self):
+        """Key of the longest route."""
+        heap = self._heap
+        while True:
+            length, version, key = heap[0]
+            if self._versions[key] == version:
+                return key
+            heapq.heappop(heap)
+
+    def max_length(self):
+        return self.lengths[self.longest()]
@@ -0,0 +1,264 @@
+import heapq
+
+import numpy as np
+from networkx import NetworkXNoPath
+from scipy.sparse import csr_matrix
+
+from metrics import registry
+
+# Same sentinel MultiTSP.dist returns for unreachable pairs.
+UNREACHABLE = 1e18
+
+
+class CSRGraph:
+    """
+    Compiled, array-backed copy of a create_graph MultiDiGraph for routing.
+
+    Nodes are renumbered 0..n-1 and the adjacency is stored in CSR form
+    (indptr / indices / weights), with parallel edges collapsed to the shortest
+    one. Buildings attached to streets through G.graph['building_attachments']
+    become chain nodes inside their street (see BuildingAttachments.splice).
+    Dijkstra runs on plain integer indices and reuses one distance and one
+    predecessor buffer across queries; only the entries a search touched are
+    reset before the next one, so a query costs what it explores rather than
+    O(|V|) allocations.
+
+    With a ContractionHierarchy attached (see contraction.py), point-to-point
+    distance and path queries are answered by it instead; nearest_unvisited
+    still runs Dijkstra, since it has no single target.
+    """
+
+    def __init__(self, G, weight='length'):
+        self.nodes = list(G.nodes())
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.is_building = [G.nodes[node].get('node_type') == 'building' for node in self.nodes]
+
+        rows, cols, weights = [], [], []
+        for u, v, data in G.edges(data=True):
+            rows.append(self.index[u])
+            cols.append(self.index[v])
+            weights.append(data.get(weight, 1))
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        # Buildings a path may pass by without stopping: those spliced into their street.
+        self.passed_by = list(self.is_building)
+        # (building, street_u, street_v) indices of every spliced building.
+        self.street_of = tuple(np.empty(0, dtype=np.int64) for _ in range(3))
+        attachments = G.graph.get('building_attachments')
+        if attachments is not None:
+            rows, cols, weights = attachments.splice(self.index, rows, cols, weights)
+            self.street_of = attachments.streets(self.index)
+        self._compile(rows, cols, weights)
+        self.hierarchy = None
+
+    def _compile(self, rows, cols, weights):
+        """Set up the CSR arrays and search buffers from an edge list of node indices."""
+        n = len(self.nodes)
+        # Sort by (row, col, weight) and keep the first entry of every (row, col) pair.
+        order = np.lexsort((weights, cols, rows))
+        rows, cols, weights = rows[order], cols[order], weights[order]
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols, weights = rows[keep], cols[keep], weights[keep]
+
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=self.indptr[1:])
+        self.indices = cols
+        self.weights = weights
+
+        # Python lists are much faster than numpy scalars inside the heap loop.
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+        self._weights = self.weights.tolist()
+
+        self._dist = [float('infinity')] * n
+        self._prev = [-1] * n
+        self._touched = []
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.index
+
+    def to_scipy(self):
+        """The adjacency as a scipy sparse matrix, for scipy.sparse.csgraph routines."""
+        n = len(self.nodes)
+        return csr_matrix((self.weights, self.indices, self.indptr), shape=(n, n))
+
+    def _reset(self):
+        dist, prev = self._dist, self._prev
+        inf = float('infinity')
+        for i in self._touched:
+            dist[i] = inf
+            prev[i] = -1
+        self._touched.clear()
+
+    def _path_to(self, i):
+        path = []
+        prev = self._prev
+        while i != -1:
+            path.append(i)
+            i = prev[i]
+        path.reverse()
+        return self.node_path(path)
+
+    def node_path(self, path):
+        """
+        Node ids of a path of indices. Buildings the path only passes by (they sit
+        inside their street) are left out; the endpoints are always kept.
+        """
+        nodes, passed_by = self.nodes, self.passed_by
+        return [nodes[path[0]]] + [nodes[i] for i in path[1:-1] if not passed_by[i]] + \
+            ([nodes[path[-1]]] if len(path) > 1 else [])
+
+    def _dijkstra(self, source, target=-1, stop=None):
+        """
+        Run Dijkstra from index `source` until `target` is settled, `stop(i)` is
+        true for a settled index, or the queue runs out. Returns the settled index
+        that ended the search (or -1) and its distance; predecessors are left in
+        the buffers for _path_to. Heap pops and edge relaxations are counted in
+        the metrics registry once per query.
+        """
+        self._reset()
+        dist, prev, touched = self._dist, self._prev, self._touched
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+
+        dist[source] = 0
+        touched.append(source)
+        pq = [(0, source)]
+        pops = relaxations = 0
+        found, found_dist = -1, float('infinity')
+        while pq:
+            curr_dist, i = heapq.heappop(pq)
+            pops += 1
+            if curr_dist > dist[i]:
+                continue
+            if i == target or (stop is not None and stop(i)):
+                found, found_dist = i, curr_dist
+                break
+            for e in range(indptr[i], indptr[i + 1]):
+                j = indices[e]
+                new_dist = curr_dist + weights[e]
+                if new_dist < dist[j]:
+                    if dist[j] == float('infinity'):
+                        touched.append(j)
+                    dist[j] = new_dist
+                    prev[j] = i
+                    heapq.heappush(pq, (new_dist, j))
+                    relaxations += 1
+
+        registry.incr('dijkstra.queries')
+        registry.incr('dijkstra.heap_pops', pops)
+        registry.incr('dijkstra.relaxations', relaxations)
+        return found, found_dist
+
+    def nearest_unvisited(self, start, visited):
+        """
+        Closest building node (by path length) from `start` that is not in `visited`.
+        Returns (node, distance, path) or None if no such building is reachable.
+        """
+        nodes, is_building = self.nodes, self.is_building
+        found, found_dist = self._dijkstra(
+            self.index[start], stop=lambda i: is_building[i] and nodes[i] not in visited)
+        if found == -1:
+            return None
+        return nodes[found], found_dist, self._path_to(found)
+
+    def street_chains(self, streets):
+        """
+        For every street (u, v) of node ids in `streets` (in either direction, each
+        street once), the indices of its ends and of the buildings spliced into it:
+        the nodes its links in the compiled arrays join.
+        """
+        b, street_u, street_v = self.street_of
+        chains = {}
+        for u, v in streets:
+            if u not in self.index or v not in self.index or frozenset((u, v)) in chains:
+                continue
+            i, j = self.index[u], self.index[v]
+            on_street = ((street_u == i) & (street_v == j)) | ((street_u == j) & (street_v == i))
+            chains[frozenset((u, v))] = np.concatenate([[i, j], b[on_street]]).astype(np.int64)
+        return list(chains.values())
+
+    def without(self, nodes, streets=()):
+        """
+        A copy of this graph with node ids `nodes` removed and the streets (u, v) in
+        `streets` closed in both directions, cut from the compiled arrays instead of
+        compiling the masked MultiDiGraph again. Removing nodes gives the same nodes,
+        buildings and distances as compiling (see BuildingAttachments.splice): a
+        building whose street lost one end stays reachable from the other, one whose
+        street lost both ends stays as an isolated building, and a removed building
+        on a street that is still there stays as a plain point the street passes
+        through. A closed street loses its whole chain, so its buildings are
+        isolated. The copy has no hierarchy.
+        """
+        n = len(self.nodes)
+        removed = np.zeros(n, dtype=bool)
+        removed[[self.index[node] for node in nodes if node in self.index]] = True
+        is_building = np.array(self.is_building, dtype=bool)
+        b, u, v = self.street_of
+        gone_u = (u < 0) | removed[np.maximum(u, 0)]
+        gone_v = (v < 0) | removed[np.maximum(v, 0)]
+        spliced = np.zeros(n, dtype=bool)
+        spliced[b] = True
+        cut = np.zeros(n, dtype=bool)
+        cut[b[gone_u & gone_v]] = True
+        passable = removed & spliced & ~cut
+        keep = ~removed | passable
+
+        new_index = np.cumsum(keep) - 1
+        rows = np.repeat(np.arange(n), np.diff(self.indptr))
+        edges = keep[rows] & keep[self.indices] & ~cut[rows] & ~cut[self.indices]
+        chains = self.street_chains(streets)
+        if chains:
+            closed = np.concatenate([(chain[:, None] * n + chain[None, :]).ravel() for chain in chains])
+            edges &= ~np.isin(rows * n + self.indices, closed)
+
+        graph = CSRGraph.__new__(CSRGraph)
+        graph.nodes = [node for node, k in zip(self.nodes, keep.tolist()) if k]
+        graph.index = {node: i for i, node in enumerate(graph.nodes)}
+        graph.is_building = (is_building & ~passable)[keep].tolist()
+        graph.passed_by = np.array(self.passed_by, dtype=bool)[keep].tolist()
+        attached = keep[b] & ~passable[b] & ~cut[b]
+        graph.street_of = (new_index[b[attached]],
+                           np.where(gone_u, -1, new_index[np.maximum(u, 0)])[attached],
+                           np.where(gone_v, -1, new_index[np.maximum(v, 0)])[attached])
+        graph._compile(new_index[rows[edges]], new_index[self.indices[edges]], self.weights[edges])
+        graph.hierarchy = None
+        return graph
+
+    def attach_hierarchy(self, hierarchy):
+        """Answer distance and path queries with `hierarchy`, which must have been built from this graph."""
+        if not hierarchy.matches(self):
+            raise ValueError("Contraction hierarchy was built for a different graph")
+        self.hierarchy = hierarchy
+
+    def distance(self, a, b):
+        if self.hierarchy is not None:
+            found_dist = self.hierarchy.distance(self.index[a], self.index[b])
+            return found_dist if found_dist != float('infinity') else UNREACHABLE
+        found, found_dist = self._dijkstra(self.index[a], target=self.index[b])
+        return found_dist if found != -1 else UNREACHABLE
+
+    def path(self, a, b):
+        """Shortest path from a to b as a list of node ids, raising NetworkXNoPath like networkx."""
+        return self.path_with_length(a, b)[0]
+
+    def path_with_length(self, a, b):
+        if self.hierarchy is not None:
+            result = self.hierarchy.path(self.index[a], self.index[b])
+            if result is None:
+                raise NetworkXNoPath(f"No path between {a} and {b}.")
+            path, length = result
+            return self.node_path(path), length
+        found, found_dist = self._dijkstra(self.index[a], target=self.index[b])
+        if found == -1:
+            raise NetworkXNoPath(f"No path between {a} and {b}.")
+        return self._path_to(found), found_dist
+
+
+def as_csr(G):
+    """Return G itself if it is already compiled, otherwise compile it."""
+    return G if isinstance(G, CSRGraph) else CSRGraph(G)
@@ -0,0 +1,181 @@
+import random
+
+NODE_TYPES = ['street', 'building', 'projection']
+EDGE_TYPES = ['street', 'perpendicular']
+
+
+def generate_route_colors(route_ids):
+    """Pick a random saturated, not-too-light hex color for every route."""
+    route_colors = {}
+    for route_id in route_ids:
+        while True:
+            # Generate a random color with more saturated values
+            r = random.randint(20, 180)
+            g = random.randint(20, 180)
+            b = random.randint(20, 180)
+
+            if max(r, g, b) < 120:
+                continue
+
+            # Make sure the color isn't too light overall (lower threshold)
+            if (r + g + b) > 450:
+                continue
+
+            route_colors[route_id] = "#{:02x}{:02x}{:02x}".format(r, g, b)
+            break
+    return route_colors
+
+
+def _route_index(routes):
+    """Map every node on a route to its route id; a node on several routes takes the last one."""
+    node_to_route = {}
+    for route_id, nodes in routes.items():
+        for node in nodes:
+            node_to_route[node] = route_id
+    return node_to_route
+
+
+def serialize_routes(routes, route_colors, only=None):
+    """Route objects for the response, numbered from 1 in route order; `only` restricts to those route ids."""
+    routes_data = []
+    for display_id, (route_id, node_list) in enumerate(routes.items(), 1):
+        if only is not None and route_id not in only:
+            continue
+        routes_data.append({
+            'id': str(route_id),
+            'display_id': display_id,
+            'nodes': [str(node) for node in node_list],
+            'color': route_colors[route_id],
+            'length': len(node_list)
+        })
+    return routes_data
+
+
+def serialize_graph(graph, routes, route_colors, columnar=False):
+    """
+    Build the 'graph_data' part of the allocation response in one pass over the
+    nodes and one over the edges.
+
+    A node is colored with the route it lies on; an edge is colored with the route
+    of the building at either end (source first). Projection nodes and the
+    building-to-street ('perpendicular') edges are drawn from the graph's building
+    attachments and take the building's route. Nodes without coordinates and
+    edges touching them are left out.
+
+    The default format is a list of objects per node/edge. With columnar=True the
+    nodes and edges are parallel arrays instead: node ids/lat/lng/type codes, edges
+    as indices into the node arrays, and route membership as an index into 'routes'
+    (-1 for none), which keeps the payload a fraction of the size.
+    """
+    node_to_route = _route_index(routes)
+    route_ids = list(routes.keys())
+    route_positions = {route_id: i for i, route_id in enumerate(route_ids)}
+
+    node_index = {}
+    building_route = {}
+    node_ids, node_lat, node_lng, node_type, node_route = [], [], [], [], []
+    for node_id, node_data in graph.nodes(data=True):
+        if 'x' not in node_data or 'y' not in node_data:
+            continue
+        node_index[node_id] = len(node_ids)
+        node_ids.append(str(node_id))
+        node_lat.append(node_data['y'])
+        node_lng.append(node_data['x'])
+        node_type.append(node_data.get('node_type', 'street'))
+        route_id = node_to_route.get(node_id)
+        node_route.append(route_id)
+        if route_id is not None and node_type[-1] == 'building':
+            building_route[node_id] = route_id
+
+    # Building attachments live in side arrays (see BuildingAttachments); draw every
+    # attached building's projection point and its building-to-street edges from them.
+    perpendicular = []
+    attachments = graph.graph.get('building_attachments')
+    if attachments is not None:
+        for building, x, y in zip(attachments.building.tolist(), attachments.proj_x.tolist(),
+                                  attachments.proj_y.tolist()):
+            if building not in node_index:
+                continue
+            projection = len(node_ids)
+            node_ids.append(f"proj_{building}")
+            node_lat.append(y)
+            node_lng.append(x)
+            node_type.append('projection')
+            node_route.append(building_route.get(building))
+            perpendicular.append((building, node_index[building], projection))
+
+    edge_source, edge_target, edge_type, edge_route = [], [], [], []
+    for building, building_index, projection in perpendicular:
+        route_id = building_route.get(building)
+        for source, target in ((building_index, projection), (projection, building_index)):
+            edge_source.append(source)
+            edge_target.append(target)
+            edge_type.append('perpendicular')
+            edge_route.append(route_id)
+    for u, v in graph.edges():
+        if u not in node_index or v not in node_index:
+            continue
+        edge_source.append(node_index[u])
+        edge_target.append(node_index[v])
+        edge_type.append('street')
+        route_id = building_route.get(u)
+        if route_id is None:
+            route_id = building_route.get(v)
+        edge_route.append(route_id)
+
+    routes_data = serialize_routes(routes, route_colors)
+
+    if columnar:
+        node_types = NODE_TYPES + sorted(set(node_type) - set(NODE_TYPES))
+        node_type_codes = {t: i for i, t in enumerate(node_types)}
+        edge_type_codes = {t: i for i, t in enumerate(EDGE_TYPES)}
+        return {
+            'format': 'columnar',
+            'node_types': node_types,
+            'edge_types': EDGE_TYPES,
+            'nodes': {
+                'id': node_ids,
+                'lat': node_lat,
+                'lng': node_lng,
+                'type': [node_type_codes[t] for t in node_type],
+                'route': [route_positions[r] if r is not None else -1 for r in node_route],
+            },
+            'edges': {
+                'source': edge_source,
+                'target': edge_target,
+                'type': [edge_type_codes[t] for t in edge_type],
+                'route': [route_positions[r] if r is not None else -1 for r in edge_route],
+            },
+            'routes': routes_data,
+        }
+
+    nodes_data = []
+    for i in range(len(node_ids)):
+        node_info = {
+            'id': node_ids[i],
+            'lat': node_lat[i],
+            'lng': node_lng[i],
+            'type': node_type[i]
+        }
+        if node_route[i] is not None:
+            node_info['route_id'] = str(node_route[i])
+            node_info['route_color'] = route_colors[node_route[i]]
+        nodes_data.append(node_info)
+
+    edges_data = []
+    for i in range(len(edge_source)):
+        edge_info = {
+            'source': node_ids[edge_source[i]],
+            'target': node_ids[edge_target[i]],
+            'type': edge_type[i]
+        }
+        if edge_route[i] is not None:
+            edge_info['route_id'] = str(edge_route[i])
+            edge_info['route_color'] = route_colors[edge_route[i]]
+        edges_data.append(edge_info)
+
+    return {
+        'nodes': nodes_data,
+        'edges': edges_data,
+        'routes': routes_data
+    }
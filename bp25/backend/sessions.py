@@ -0,0 +1,212 @@
+import threading
+import time
+import uuid
+
+from scipy.sparse.csgraph import breadth_first_order
+
+from distance_matrix import DistanceCache
+from hazards import hazard_nodes
+from MultiTSP import close_routes, simulated_annealing
+from serialize import serialize_routes
+
+# Sessions not touched for this many seconds are dropped.
+SESSION_TTL = 3600
+# Upper bound on live sessions; the least recently used one is dropped beyond it.
+MAX_SESSIONS = 16
+# Length of the short re-optimization run after every update.
+WARM_ANNEAL_STEPS = 5000
+
+
+class AllocationSession:
+    """
+    A solved allocation kept in memory so that road closures and new fires can be
+    applied incrementally: the graph, its compiled form, a lazily filled
+    DistanceCache and the current routes. update() cuts the change out of the
+    compiled graph and the cache, patches only the routes it touches and runs a
+    short warm anneal instead of rebuilding and re-solving from scratch.
+    """
+
+    def __init__(self, allocation):
+        self.graph = allocation.graph
+        self.csr = allocation.csr
+        # Created on the first update that changes the graph; nothing uses it before.
+        self.dist_fn = None
+        self.routes = allocation.routes
+        self.route_colors = allocation.route_colors
+        # The annealer works on open routes; the stored ones end back at their start.
+        self.pure_routes = {k: v[:-1] for k, v in allocation.pure_routes.items()}
+        self.route_lengths = dict(allocation.route_lengths)
+        self.node_ids = {str(node): node for node in self.graph.nodes}
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def _apply_deletions(self, data):
+        """Remove the requested nodes/edges and everything near new fires; return what was removed."""
+        graph = self.graph
+
+        removed_nodes = {self.node_ids[str(n)] for n in data.get('deleted_nodes', [])
+                         if str(n) in self.node_ids and graph.has_node(self.node_ids[str(n)])}
+
+        removed_edges = set()
+        for source, target in data.get('deleted_edges', []):
+            u = self.node_ids.get(str(source))
+            v = self.node_ids.get(str(target))
+            if u is None or v is None:
+                continue
+            # A closed road is closed in both directions.
+            for a, b in ((u, v), (v, u)):
+                if graph.has_edge(a, b):
+                    graph.remove_edges_from([(a, b, key) for key in list(graph[a][b])])
+                    removed_edges.add((a, b))
+
+        fires = data.get('fires', [])
+        hazard_polygons = data.get('hazard_polygons', [])
+        if fires or hazard_polygons:
+            removed_nodes.update(hazard_nodes(graph, fires, polygons=hazard_polygons))
+
+        graph.remove_nodes_from(removed_nodes)
+        return removed_nodes, removed_edges
+
+    def _patch_routes(self, removed_nodes):
+        """
+        Drop removed or now unreachable buildings from their routes. A removed building
+        on a street that is still there stays in the compiled graph as a point the street
+        passes through (see CSRGraph.without), so it is dropped for no longer being a
+        building. Buildings of a route whose starting point was removed are inserted
+        where they are cheapest elsewhere. Returns the ids of the routes that were dropped.
+        """
+        csr, dist_fn = self.csr, self.dist_fn
+        scipy_graph = csr.to_scipy()
+
+        def is_stop(node):
+            return node not in removed_nodes and node in csr.index and csr.is_building[csr.index[node]]
+
+        orphans = []
+        dropped = []
+        for start in list(self.pure_routes):
+            stops = self.pure_routes[start]
+            if start in removed_nodes:
+                orphans.extend(b for b in stops[1:] if is_stop(b))
+                dropped.append(start)
+                del self.pure_routes[start]
+                continue
+            reachable = breadth_first_order(scipy_graph, csr.index[start], return_predecessors=False)
+            reachable = {csr.nodes[i] for i in reachable.tolist()}
+            self.pure_routes[start] = [stops[0]] + [b for b in stops[1:] if b in reachable and is_stop(b)]
+
+        for building in orphans:
+            best = None
+            for start, stops in self.pure_routes.items():
+                for i in range(1, len(stops) + 1):
+                    before = dist_fn(csr, stops[i - 1], building)
+                    after = dist_fn(csr, building, stops[i]) - dist_fn(csr, stops[i - 1], stops[i]) \
+                        if i < len(stops) else 0
+                    cost = before + after
+                    if best is None or cost < best[0]:
+                        best = (cost, start, i)
+            if best is not None and best[0] < 1e17:
+                self.pure_routes[best[1]].insert(best[2], building)
+
+        for start in dropped:
+            self.route_lengths.pop(start, None)
+            self.routes.pop(start, None)
+        for start, stops in self.pure_routes.items():
+            self.route_lengths[start] = sum(dist_fn(csr, a, b) for a, b in zip(stops, stops[1:]))
+        return dropped
+
+    def _cut(self, removed_nodes, removed_edges):
+        """
+        Cut removed nodes and closed streets out of the compiled graph and the distance
+        cache, which keeps every cached distance the cut cannot change (see
+        DistanceCache.without).
+        """
+        old = self.csr
+        self.csr = old.without(removed_nodes, removed_edges)
+        if self.dist_fn is None:
+            stops = list(self.pure_routes) + [n for n, is_building in zip(self.csr.nodes, self.csr.is_building)
+                                              if is_building]
+            self.dist_fn = DistanceCache(self.csr, [n for n in stops if n in self.csr])
+            return
+        region = [old.index[node] for node in removed_nodes if node in old.index]
+        region.extend(i for chain in old.street_chains(removed_edges) for i in chain.tolist())
+        self.dist_fn = self.dist_fn.without(old, self.csr, region)
+
+    def update(self, data):
+        """
+        Apply deleted_nodes, deleted_edges, fires and hazard_polygons from data, re-optimize
+        with a short warm anneal and return only the routes that changed.
+        """
+        with self.lock:
+            self.last_used = time.monotonic()
+            before = {k: list(v) for k, v in self.pure_routes.items()}
+
+            removed_nodes, removed_edges = self._apply_deletions(data)
+            dropped = []
+            if removed_nodes or removed_edges:
+                self._cut(removed_nodes, removed_edges)
+                dropped = self._patch_routes(removed_nodes)
+
+                if self.pure_routes:
+                    self.pure_routes, self.route_lengths = simulated_annealing(
+                        self.csr, self.pure_routes, self.route_lengths,
+                        n_iter=data.get('anneal_steps', WARM_ANNEAL_STEPS),
+                        time_budget=data.get('time_budget'), dist_fn=self.dist_fn)
+
+            changed = set()
+            for start, stops in self.pure_routes.items():
+                old_path = self.routes.get(start, [])
+                path_broken = any(node in removed_nodes for node in old_path) or \
+                    any((a, b) in removed_edges for a, b in zip(old_path, old_path[1:]))
+                if stops != before.get(start) or path_broken:
+                    changed.add(start)
+
+            if changed:
+                new_routes = close_routes(self.csr, {k: list(self.pure_routes[k]) for k in changed}, self.dist_fn)
+                self.routes.update(new_routes)
+
+            return {
+                "status": "success",
+                "removed_nodes": [str(n) for n in removed_nodes],
+                "removed_edges": [[str(u), str(v)] for u, v in removed_edges],
+                "dropped_routes": [str(k) for k in dropped],
+                "routes": serialize_routes(self.routes, self.route_colors, only=changed),
+                "route_lengths": {str(k): v for k, v in self.route_lengths.items()},
+            }
+
+
+class SessionStore:
+    """Thread-safe in-memory map of session id -> AllocationSession with TTL and LRU bounds."""
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_used > self.ttl:
+                del self._sessions[session_id]
+        while len(self._sessions) > self.max_sessions:
+            oldest = min(self._sessions, key=lambda k: self._sessions[k].last_used)
+            del self._sessions[oldest]
+
+    def create(self, session):
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[session_id] = session
+            self._expire()
+        return session_id
+
+    def get(self, session_id):
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
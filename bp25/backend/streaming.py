@@ -0,0 +1,117 @@
+import json
+import queue
+import threading
+import time
+
+from allocation import allocation_response, choose_starting_points, prepare_graph, solve_allocation
+from serialize import generate_route_colors, serialize_graph
+
+# Improvements found faster than this (seconds) are coalesced into one event.
+STREAM_MIN_INTERVAL = 0.5
+
+
+class StreamClosed(Exception):
+    """Raised from the solver callback once the client has gone away, to stop the solve."""
+
+
+def format_event(name, payload):
+    return f"event: {name}\ndata: {json.dumps(payload)}\n\n"
+
+
+class AllocationStream:
+    """
+    Runs one allocation request in a background thread and turns its progress into
+    server-sent events:
+
+    - "graph": the serialized graph (no routes yet) and the color of every route
+    - "routes": after the greedy initialization and then for every improvement the
+      annealer finds, at most once per min_interval seconds. Only the pure_routes
+      (stop lists) that changed since the previous "routes" event are included;
+      route_lengths always covers every route.
+    - "result": the same body /api/process-allocation returns
+    - "error": the message if the solve failed
+
+    Iterating the stream yields the formatted events until the solve is done.
+    """
+
+    def __init__(self, data, min_interval=STREAM_MIN_INTERVAL):
+        self.data = data
+        self.min_interval = min_interval
+        self.events = queue.Queue()
+        self.closed = False
+        self._sent_routes = {}
+        self._pending = None
+        self._last_sent = 0.0
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _emit(self, name, payload):
+        self.events.put(format_event(name, payload))
+
+    def _flush(self):
+        """Send the pending improvement as a delta against the routes sent so far."""
+        info = self._pending
+        self._pending = None
+        changed = {k: v for k, v in info["pure_routes"].items() if self._sent_routes.get(k) != v}
+        self._sent_routes.update(changed)
+        self._last_sent = time.perf_counter()
+        self._emit("routes", {
+            "stage": info["type"],
+            "iteration": info.get("iteration", 0),
+            "elapsed": self._last_sent - self._started,
+            "best_max": info["best_max"],
+            "route_lengths": {str(k): v for k, v in info["route_lengths"].items()},
+            "routes": {str(k): [str(node) for node in stops] for k, stops in changed.items()},
+        })
+
+    def on_event(self, info):
+        """Solver callback: runs in the solver thread."""
+        if self.closed:
+            raise StreamClosed()
+        if "pure_routes" in info and info["type"] != "done":
+            # Solvers hand out snapshots they no longer modify, so no copy is needed.
+            self._pending = info
+        if self._pending is not None and (self._pending["type"] == "init"
+                                          or time.perf_counter() - self._last_sent >= self.min_interval):
+            self._flush()
+
+    def _run(self):
+        data = self.data
+        try:
+            graph = prepare_graph(data)
+            starting_pts = choose_starting_points(graph, data.get('num_routes'))
+            route_colors = generate_route_colors(starting_pts)
+            self._emit("graph", {
+                "bbox": data['bbox'],
+                "nodes_count": len(graph.nodes),
+                "edges_count": len(graph.edges),
+                "route_colors": {str(k): v for k, v in route_colors.items()},
+                "graph_data": serialize_graph(graph, {}, route_colors,
+                                              columnar=data.get('format') == 'columnar'),
+            })
+
+            allocation = solve_allocation(graph, data, starting_pts, route_colors=route_colors,
+                                          callback=self.on_event)
+            if self._pending is not None:
+                self._flush()
+            self._emit("result", allocation_response(data, allocation))
+        except StreamClosed:
+            pass
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self._emit("error", {"error": str(e)})
+        finally:
+            self.events.put(None)
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                event = self.events.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            # The client disconnected (or we are done); stop the solver at its next callback.
+            self.closed = True
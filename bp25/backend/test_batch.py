@@ -0,0 +1,14 @@
+import batch
+from benchmark import synthetic_graph
+
+
+def test_scenarios_where_every_building_is_a_start(monkeypatch):
+    """num_routes at or above the building count makes every building a start without failing the batch."""
+    G = synthetic_graph(4, 12, 0)
+    monkeypatch.setattr(batch, 'prepare_graph', lambda data: G)
+    response = batch.solve_batch({'bbox': [0, 0, 1, 1], 'anneal_steps': 300,
+                                  'scenarios': [{'num_routes': 2}, {'num_routes': 12}, {'num_routes': 30}]},
+                                 workers=1)
+
+    assert [scenario['routes_count'] for scenario in response['scenarios']] == [2, 12, 12]
+    assert all(length == 0 for length in response['scenarios'][1]['route_lengths'].values())
@@ -0,0 +1,24 @@
+import numpy as np
+
+from benchmark import synthetic_graph
+from contraction import ContractionHierarchy
+from routing_graph import CSRGraph
+
+
+def test_matches_only_the_graph_it_was_built_from(tmp_path):
+    """A hierarchy, also after a save/load round trip, rejects a graph of the same shape with other weights."""
+    graph = CSRGraph(synthetic_graph(6, 30, 0))
+    hierarchy = ContractionHierarchy.build(graph)
+    hierarchy.save(str(tmp_path))
+    loaded = ContractionHierarchy.load(str(tmp_path))
+
+    other = CSRGraph(synthetic_graph(6, 30, 0))
+    other.weights = other.weights.copy()
+    other.weights[0] += 1.0
+    assert len(other) == len(graph) and len(other.indices) == len(graph.indices)
+
+    assert hierarchy.matches(graph) and loaded.matches(graph)
+    assert not hierarchy.matches(other) and not loaded.matches(other)
+    a, b = graph.nodes[0], graph.nodes[-1]
+    graph.attach_hierarchy(loaded)
+    assert np.isclose(graph.distance(a, b), CSRGraph(synthetic_graph(6, 30, 0)).distance(a, b))
@@ -0,0 +1,34 @@
+import random
+
+import numpy as np
+import pytest
+
+from distance_matrix import DistanceCache, DistanceMatrix
+from routing_graph import CSRGraph
+from test_routing_graph import close_streets, masked_graph
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_cache_without_matches_a_fresh_matrix(seed):
+    """Distances looked up in DistanceCache.without(...) match a matrix built on the masked graph."""
+    G, removed, streets = masked_graph(seed, closed_streets=2)
+    csr = CSRGraph(G)
+    stops = [node for node, is_building in zip(csr.nodes, csr.is_building) if is_building]
+    cache = DistanceCache(csr, stops)
+    rnd = random.Random(seed)
+    for a in rnd.sample(stops, 50):
+        cache(csr, a, stops[0])
+
+    masked = csr.without(removed, streets)
+    region = [csr.index[node] for node in removed]
+    region.extend(i for chain in csr.street_chains(streets) for i in chain.tolist())
+    carried = cache.without(csr, masked, region)
+    assert set(carried._rows) == {a for a in cache._rows if a in masked}
+
+    expected_graph = G.copy()
+    expected_graph.remove_nodes_from(removed)
+    close_streets(expected_graph, streets)
+    nodes = [node for node in carried.nodes if node in expected_graph]
+    expected = DistanceMatrix.from_graph(CSRGraph(expected_graph), nodes)
+    actual = np.array([[carried(masked, a, b) for b in nodes] for a in nodes])
+    np.testing.assert_allclose(actual, expected.matrix)
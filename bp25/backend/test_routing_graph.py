@@ -0,0 +1,56 @@
+import random
+
+import numpy as np
+import pytest
+from scipy.sparse.csgraph import dijkstra
+
+from benchmark import synthetic_graph
+from hazards import hazard_nodes
+from routing_graph import CSRGraph
+
+
+def buildings(graph):
+    return {node for node, is_building in zip(graph.nodes, graph.is_building) if is_building}
+
+
+def masked_graph(seed, closed_streets=0):
+    """A synthetic graph, the nodes two random fires remove and closed_streets streets away from them."""
+    G = synthetic_graph(12, 200, seed)
+    xs = [data['x'] for _, data in G.nodes(data=True)]
+    ys = [data['y'] for _, data in G.nodes(data=True)]
+    rnd = random.Random(seed)
+    fires = [{'latitude': rnd.uniform(min(ys), max(ys)), 'longitude': rnd.uniform(min(xs), max(xs))}
+             for _ in range(2)]
+    removed = hazard_nodes(G, fires, radius=0.0015)
+    streets = [(u, v) for u, v in G.edges()
+               if u not in removed and v not in removed
+               and G.nodes[u].get('node_type') != 'building' and G.nodes[v].get('node_type') != 'building']
+    return G, removed, rnd.sample(streets, closed_streets)
+
+
+def close_streets(G, streets):
+    for u, v in streets:
+        for a, b in ((u, v), (v, u)):
+            if G.has_edge(a, b):
+                G.remove_edges_from([(a, b, key) for key in list(G[a][b])])
+
+
+@pytest.mark.parametrize('closed', [0, 3])
+@pytest.mark.parametrize('seed', range(5))
+def test_without_matches_compiling_the_masked_graph(seed, closed):
+    """CSRGraph.without(removed, streets) has the buildings and distances of compiling G minus both."""
+    G, removed, streets = masked_graph(seed, closed)
+    assert removed
+
+    masked = G.copy()
+    masked.remove_nodes_from(removed)
+    close_streets(masked, streets)
+    expected = CSRGraph(masked)
+    actual = CSRGraph(G).without(removed, streets)
+
+    assert buildings(actual) == buildings(expected)
+    common = sorted(buildings(expected))
+    expected_dist = dijkstra(expected.to_scipy(), indices=[expected.index[b] for b in common])
+    actual_dist = dijkstra(actual.to_scipy(), indices=[actual.index[b] for b in common])
+    np.testing.assert_allclose(expected_dist[:, [expected.index[b] for b in common]],
+                               actual_dist[:, [actual.index[b] for b in common]])
@@ -0,0 +1,43 @@
+import random
+
+import pytest
+
+from allocation import solve_allocation
+from benchmark import synthetic_graph
+from sessions import AllocationSession
+
+
+def routed_session(seed):
+    """A session on a synthetic graph and one building that is a stop of a route, not its start."""
+    G = synthetic_graph(10, 200, seed)
+    buildings = [node for node, data in G.nodes(data=True) if data.get('node_type') == 'building']
+    random.seed(seed)
+    allocation = solve_allocation(G, {'anneal_steps': 500}, random.sample(buildings, 3))
+    session = AllocationSession(allocation)
+    stop = next(b for stops in session.pure_routes.values() for b in stops[1:])
+    return session, stop
+
+
+def fire_on(session, node):
+    return {'fires': [{'latitude': session.graph.nodes[node]['y'], 'longitude': session.graph.nodes[node]['x']}]}
+
+
+def delete(session, node):
+    return {'deleted_nodes': [str(node)]}
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('update', [fire_on, delete])
+def test_update_drops_removed_routed_buildings(seed, update):
+    """A fire or deletion covering a routed building drops it from the routes instead of failing."""
+    session, stop = routed_session(seed)
+    response = session.update(update(session, stop))
+
+    assert response['status'] == 'success'
+    assert str(stop) in response['removed_nodes']
+    csr = session.csr
+    for start, stops in session.pure_routes.items():
+        assert stop not in stops
+        assert all(csr.is_building[csr.index[b]] for b in stops)
+        assert session.route_lengths[start] == pytest.approx(
+            sum(session.dist_fn(csr, a, b) for a, b in zip(stops, stops[1:])))
@@ -0,0 +1,181 @@
+"""
+Street network and building attachments stored as fixed geographic tiles.
+
+The world is cut into TILE_SIZE x TILE_SIZE degree tiles. A tile is built once
+(streets, its buildings and their attachments) and persisted in the graph cache
+format under TILE_DIR; a request bbox is then assembled by stitching the tiles
+it covers, so overlapping or slightly shifted bboxes reuse almost all prior work.
+
+Stitching is a plain union, which is consistent at tile borders because tiles
+keep the unsimplified OSM street segments (every node is an OSM node, every
+edge one segment between two of them): a segment crossing a border is stored
+identically in both tiles and merges into one. Street ids are OSM node ids and
+building ids are derived from the building's OSM element (see building_node_id),
+so they are the same in every tile and every stitched graph.
+"""
+import math
+import os
+import shutil
+import tempfile
+
+import networkx as nx
+import numpy as np
+from osmnx._errors import InsufficientResponseError
+
+from attachments import ARRAY_NAMES, BuildingAttachments
+from create_graph import fetch_features, fetch_streets, snap_buildings, snap_fire_stations
+from graph_cache import load_graph, save_graph
+from metrics import registry
+from osm_import import building_node_id
+
+# Tile side in degrees (~1.1 km north-south).
+TILE_SIZE = 0.01
+
+# Streets are fetched this far (degrees, ~220 m) beyond a tile, so that buildings near
+# its border snap to their true nearest street even if it lies in the next tile.
+SNAP_MARGIN = 0.002
+
+# Streets this far beyond the request bbox are kept in the stitched graph for routing.
+STREET_MARGIN = 0.002
+
+# Bump whenever build_tile changes what it produces.
+TILE_VERSION = 3
+
+TILE_DIR = os.environ.get(
+    'BP25_TILE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tiles'))
+
+def tile_of(lng, lat):
+    return math.floor(lng / TILE_SIZE), math.floor(lat / TILE_SIZE)
+
+
+def tile_bounds(tile):
+    """(north, south, east, west) of a tile, like the request bboxes."""
+    i, j = tile
+    return (j + 1) * TILE_SIZE, j * TILE_SIZE, (i + 1) * TILE_SIZE, i * TILE_SIZE
+
+
+def tiles_for_bbox(bbox):
+    """Every tile a (north, south, east, west) bbox overlaps."""
+    north, south, east, west = (float(c) for c in bbox)
+    first_i, first_j = tile_of(west, south)
+    last_i, last_j = tile_of(east, north)
+    return [(i, j) for i in range(first_i, last_i + 1) for j in range(first_j, last_j + 1)]
+
+
+def tile_path(tile, tile_dir=TILE_DIR):
+    return os.path.join(tile_dir, f'v{TILE_VERSION}', f'{tile[0]}_{tile[1]}')
+
+
+def build_tile(tile):
+    """
+    Streets (unsimplified, plus SNAP_MARGIN around the tile) and the buildings whose
+    centroid lies in the tile, attached to those streets, plus the fire stations in it.
+    """
+    north, south, east, west = tile_bounds(tile)
+    margin = (north + SNAP_MARGIN, south - SNAP_MARGIN, east + SNAP_MARGIN, west - SNAP_MARGIN)
+    try:
+        G = fetch_streets(margin, simplify=False, retain_all=True, truncate_by_edge=True)
+    except InsufficientResponseError:
+        G = nx.MultiDiGraph(crs='epsg:4326')
+    try:
+        buildings, fire_stations = fetch_features((north, south, east, west))
+    except InsufficientResponseError:
+        return G
+
+    # Footprints crossing the border are returned for both tiles; each belongs to the one
+    # holding its centroid (tiles are half-open, [west, east) x [south, north)).
+    G.graph['fire_stations'] = [station for station in fire_stations
+                                if west <= station['lng'] < east and south <= station['lat'] < north]
+    x = buildings['centroid'].x.to_numpy()
+    y = buildings['centroid'].y.to_numpy()
+    inside = (x >= west) & (x < east) & (y >= south) & (y < north)
+    ids = [building_node_id(element, osmid) for element, osmid in buildings.index[inside]]
+    G.add_nodes_from((b, {'x': bx, 'y': by, 'node_type': 'building'})
+                     for b, bx, by in zip(ids, x[inside].tolist(), y[inside].tolist()))
+    if G.number_of_edges():
+        with registry.timer('phase.snapping'):
+            snap_buildings(G, ids)
+    return G
+
+
+def load_tile(tile, tile_dir=TILE_DIR):
+    """A tile's graph from the store, building and storing it first if it is not there yet."""
+    path = tile_path(tile, tile_dir)
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+        try:
+            G = load_graph(path)
+            registry.incr('tiles.hits')
+            return G
+        except Exception as e:
+            print(f"Discarding unreadable tile {path}: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+
+    registry.incr('tiles.misses')
+    with registry.timer('phase.tile_build'):
+        G = build_tile(tile)
+    try:
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+        save_graph(G, tmp)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            # Another request stored the same tile first.
+            shutil.rmtree(tmp, ignore_errors=True)
+    except Exception as e:
+        print(f"Error writing tile {path}: {e}")
+    return G
+
+
+def stitch(graphs, bbox, street_margin=STREET_MARGIN):
+    """
+    Union of tile graphs, cropped to bbox: buildings and fire stations whose centroid
+    lies in it, and street segments with an end within street_margin of it.
+    """
+    north, south, east, west = (float(c) for c in bbox)
+
+    def inside(data, margin):
+        return (west - margin <= data.get('x', np.nan) <= east + margin
+                and south - margin <= data.get('y', np.nan) <= north + margin)
+
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    attachments = []
+    fire_stations = []
+    for tile_graph in graphs:
+        G.add_nodes_from((node, data) for node, data in tile_graph.nodes(data=True)
+                         if inside(data, 0.0 if data.get('node_type') == 'building' else street_margin))
+        G.add_edges_from((u, v, key, data) for u, v, key, data in tile_graph.edges(keys=True, data=True)
+                         if u in G or v in G)
+        if 'building_attachments' in tile_graph.graph:
+            attachments.append(tile_graph.graph['building_attachments'])
+        fire_stations.extend(dict(station) for station in tile_graph.graph.get('fire_stations', [])
+                             if west <= station['lng'] <= east and south <= station['lat'] <= north)
+    # Street segments leaving the cropped area bring their outer end along.
+    for node in [node for node in G if 'x' not in G.nodes[node]]:
+        for tile_graph in graphs:
+            if node in tile_graph:
+                G.nodes[node].update(tile_graph.nodes[node])
+                break
+
+    if attachments:
+        merged = BuildingAttachments.from_arrays(
+            {name: np.concatenate([a.arrays()[name] for a in attachments]) for name in ARRAY_NAMES})
+        keep = np.array([b in G for b in merged.building.tolist()], dtype=bool)
+        G.graph['building_attachments'] = BuildingAttachments.from_arrays(
+            {name: arr[keep] for name, arr in merged.arrays().items()})
+    # Depots are the nearest building of the stitched graph, not of the station's tile.
+    snap_fire_stations(G, fire_stations)
+    G.graph['fire_stations'] = fire_stations
+    return G
+
+
+def tiled_graph(bbox, tile_dir=TILE_DIR):
+    """
+    Graph for a (north, south, east, west) bbox, stitched from stored tiles; the
+    counterpart of graph_cache.cached_create_graph for the tiled store.
+    """
+    graphs = [load_tile(tile, tile_dir) for tile in tiles_for_bbox(bbox)]
+    with registry.timer('phase.tile_stitch'):
+        return stitch(graphs, bbox)